@@ -1,104 +1,108 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
 import csv
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
 import sys
+import tempfile
+import threading
 
 usage = '''Read one or more key:value files, and produce a CSV file.
   Useful options:
     --noheader      As it sounds, don't print a header.
     --2pass         Gather the names in one pass, convert the data in another.
                     Useful if the volume of data is huge.
+    --spill         Read the data once, spilling the parsed rows to a temporary file while the names
+                    are gathered, then write them out. Memory use doesn't grow with the data.
     --columns       Specify the columns to be output. Use '+' to also discover
-                    columns. The default is like 'timestamp operation +'.
+                    columns. The default is like 'timestamp operation +'. Without '+',
+                    rows are written as they are read, rather than held in memory.
     --output        Names the output file. Otherwise stdout.
+    --format        csv (the default) or parquet. Parquet output is typed, compressed, and written in
+                    row groups; it requires --output, and pyarrow. Values that can't be converted to
+                    their column's type are written as nulls, and counted per column.
+    --strict        With --format parquet, stop at a value that can't be converted, rather than writing
+                    a null.
+    --copy-to-db    Names a database table. Rather than writing a file, stream the data into the
+                    table with COPY ... FROM STDIN, while the input is being read.
+    --merge-keys    With --copy-to-db, copy into a temporary table, then replace the rows in the
+                    named table that match on these columns, as importStats.sh does with mstemp.
+    --jobs          Number of processes with which to read the input files. The results are
+                    merged in input file order, so the output is the same as with one process.
+    --manifest      Names a file recording the inputs already converted, by path, size, mtime, and
+                    content hash. Unchanged inputs are skipped; the manifest is updated when done.
+    --append        Append to an existing output file, rather than replacing it. The existing
+                    header must match the columns.
     --map           Specify a recipient_map file, mapping project+community to recipientid. If
                     specified, will fill missing recipientid from existing project+community.
 '''
 
 input_data = []
+spill_file = None
 column_names = []
 discover_columns = True
 recipient_map = None
-proj_warnings = {}
-comm_warnings = {}
-overrides_used = {}
-
-recipient_overrides = {
-
-    "MEDA": {
-        "KANDANBAMBO B - CHARINGU": "KANDANBAMBO B - CHARIGU",
-        "KANYIRI - CHARINGU": "KANYIRI - CHARIGU",
-        "KATIMEN-LINYE - FIAN": "KATIMEN - LINYE - FIAN",
-        "MWINISUMBO - KULKPONG": "MWINISUMBU - KULKPONG",
-        "POGBETIETAA - BUNAA": "POGBATIETAA - BUNAA",
-        "POG-OLO - BULEN": "POG - OLO - BULEN",
-        "SUNGTAAMAALITAA A - BULEN": "SUNTAAMAALITAA - A - BULEN",
-        "TIETAA - IRI - TAFALI": "TIETAA-IRI - TAFALI"
-    },
-    "UWR": {
-        "MOTHER TO MOTHER SUPPORT TAMPAALA": "TAMPAALA-JIRAPA",  # this is a bit of a stretch, going on Tampaala.
-        "KABERE-YOUTH TAMPAALA": "TAMPAALA-JIRAPA"
-    },
-    "CARE": {
-        "KPATUA NO": "KPATUA NO 1",
-        "SONGO ANONGTAABA": "SONGO ANONGTAABA 1"
-    }
+# Rows per recipient Resolution, summarized at the end of the run.
+recipient_counts = collections.Counter()
+pool = None
+# The header of an existing output file, when appending.
+append_header = None
+manifest = {}
+manifest_updates = {}
+output_format = 'csv'
+output_name = None
+columnar_output = None
+strict_types = False
+
+# Types of the playstatistics columns (see columns.txt), for columnar output. Other columns are strings.
+column_types = {
+    'started': 'int64',
+    'quarter': 'int64',
+    'half': 'int64',
+    'threequarters': 'int64',
+    'completed': 'int64',
+    'played_seconds': 'int64',
+    'survey_taken': 'int64',
+    'survey_applied': 'int64',
+    'survey_useless': 'int64'
 }
 
+# Load the recipient index for a recipients_map.csv. The index is compiled once per content of the file, and
+# saved beside it; worker processes map the same saved index.
 def load_recipient_map(filename):
     global recipient_map
-    map_file = open(filename, newline='')
-    csvfile = csv.reader(map_file, delimiter=',')
-    proj_ix = directory_ix = recip_ix = 0
-    recipient_map = {}
-
-    for row in csvfile:
-        if csvfile.line_num == 1:
-            proj_ix = row.index('project')
-            directory_ix = row.index('directory')
-            recip_ix = row.index('recipientid')
-        else:
-            proj = row[proj_ix].upper()
-            directory = row[directory_ix].upper()
-            recipientid = row[recip_ix]
-            if proj not in recipient_map:
-                recipient_map[proj] = {}
-            recipient_map[proj][directory] = recipientid
+    from recipientindex import RecipientIndex
+    recipient_map = RecipientIndex.load(filename)
+    resolve_recipient.cache_clear()
+
+
+# Resolve a project+community. There are few distinct pairs but many rows, so resolutions, found or not,
+# are memoized.
+@functools.lru_cache(maxsize=65536)
+def resolve_recipient(proj, directory):
+    return recipient_map.lookup(proj, directory)
 
 
 def lookup_recipient(proj, directory):
-    global recipient_map, recipient_overrides, proj_warnings, comm_warnings, overrides_used
+    global recipient_map, recipient_counts
     if not recipient_map:
         return None
-    proj = proj.upper().strip('"')
-    directory = directory.upper().strip('"')
-    if proj in recipient_overrides and directory in recipient_overrides[proj]:
-        override = recipient_overrides[proj][directory]
-        if proj not in overrides_used or directory not in overrides_used[proj]:
-            if proj not in overrides_used: overrides_used[proj] = {}
-            overrides_used[proj][directory] = True
-            sys.stdout.write('Using {} as override for {}.\n'.format(override, directory))
-        directory = override
-    if proj not in recipient_map:
-        if proj not in proj_warnings:
-            proj_warnings[proj] = True
-            sys.stdout.write('Project {} is not in recipient map.\n'.format(proj))
-        return None
-    if directory not in recipient_map[proj]:
-        if proj not in comm_warnings or directory not in comm_warnings[proj]:
-            if proj not in comm_warnings: comm_warnings[proj] = {}
-            comm_warnings[proj][directory] = True
-            sys.stdout.write('directory {} is not in map for {}.\n'.format(directory, proj))
-        return None
-    return recipient_map[proj][directory]
+    resolution = resolve_recipient(proj, directory)
+    recipient_counts[resolution] += 1
+    return resolution.recipientid
 
 # Read a key:value file; comma-separated key:value pairs.
 def read_input(kv_file, gather=True, process=True):
     global column_names, input_data, discover_columns
 
-    lines = [line.strip() for line in kv_file]
-    for line in lines:
+    for line in kv_file:
+        line = line.strip()
         if len(line) < 1:
             continue
         #  First two fields are timestamp,operation, then k:v pairs separated by commas.
@@ -126,30 +130,91 @@ def read_input(kv_file, gather=True, process=True):
                 if recipientid:
                     data['recipientid'] = recipientid
 
-            if gather:
-                # If gathering and processing in one pass, accumulate data until the end.
-                input_data.append(data)
-            else:
-                write_line(data)
+            keep_data(data, gather)
 
 
-def process_inputs_list(names, two_pass):
-    if two_pass:
-        for name in names:
-            kv_file = open(name, 'r')
-            read_input(kv_file, process=False)
-        for name in names:
-            kv_file = open(name, 'r')
-            read_input(kv_file, gather=False)
+# Keep one line of data. If gathering and processing in one pass, accumulate data until the end, otherwise
+# write it now.
+def keep_data(data, gather):
+    global input_data, spill_file
+    if gather:
+        if spill_file:
+            spill_line(data)
+        else:
+            input_data.append(data)
     else:
+        write_line(data)
+
+
+# Set up a worker process with the parent's settings.
+def init_worker(discover, map):
+    global discover_columns, recipient_map, spill_file, outfile
+    discover_columns = discover
+    recipient_map = map
+    spill_file = outfile = None
+
+
+# Read one file in a worker process. Returns the columns found, in the order found, the data, and the
+# recipient lookup counts. The parent merges these exactly as if it had read the file itself.
+def read_input_task(task):
+    global column_names, input_data, discover_columns, recipient_counts
+    name, gather, process = task
+    discover = discover_columns
+    column_names = []
+    input_data = []
+    recipient_counts = collections.Counter()
+    # Always gather here, so the data comes back to the parent.
+    discover_columns = discover and gather
+    with open(name, 'r') as kv_file:
+        read_input(kv_file, process=process)
+    discover_columns = discover
+    return column_names, input_data, recipient_counts
+
+
+# Read the named files, in this process or in the worker pool. The results from the pool are merged in
+# the order of the names.
+def read_inputs(names, gather=True, process=True):
+    global pool, column_names, discover_columns, recipient_counts
+    if not pool:
         for name in names:
             kv_file = open(name, 'r')
-            read_input(kv_file)
+            read_input(kv_file, gather=gather, process=process)
+        return
+
+    tasks = [(name, gather, process) for name in names]
+    for (columns, rows, counts) in pool.imap(read_input_task, tasks):
+        recipient_counts.update(counts)
+        if gather and discover_columns:
+            for column in columns:
+                if column not in column_names:
+                    column_names.append(column)
+        for data in rows:
+            keep_data(data, gather)
+
+
+def process_inputs_list(names, two_pass):
+    global discover_columns, spill_file
+    if not discover_columns:
+        # The columns are already known, so there is nothing to gather; write the data as it is read.
+        read_inputs(names, gather=False)
+    elif two_pass:
+        read_inputs(names, process=False)
+        read_inputs(names, gather=False)
+    else:
+        read_inputs(names)
         write_all()
 
-# Write one line of data to the output. Write the header if (still) required.
-def write_line(data):
-    global column_names, outfile, needHeader
+# Write one line of values to the output. Write the header if (still) required.
+def write_vals(vals):
+    global column_names, outfile, needHeader, append_header
+    if append_header is not None:
+        h = ",".join(column_names)
+        if h != append_header:
+            sys.exit('Columns "{}" do not match the existing output header "{}".'.format(h, append_header))
+        append_header = None
+    if output_format == 'parquet':
+        open_columnar_output().add_row(vals)
+        return
     if needHeader:
         # csv header
         h = ",".join(column_names)
@@ -157,16 +222,218 @@ def write_line(data):
         outfile.write('\n')
         needHeader = False
 
-    # The data; use an empty string for missing data.
-    vals = [data[k] if k in data else '' for k in column_names]
     outfile.write(','.join(vals))
     outfile.write('\n')
 
-# Writes the deployments data that has been collected, to a .csv file appropriate to import to the tbsdeployed table.
+# Open the columnar output, if not already open. The column names are known by the time anything is written.
+def open_columnar_output():
+    global columnar_output, output_name, column_names, column_types
+    if not columnar_output:
+        from columnar import ParquetOutput
+        columnar_output = ParquetOutput(output_name, column_names, column_types, strict=strict_types)
+    return columnar_output
+
+# Write one line of data to the output.
+def write_line(data):
+    global column_names
+    # The data; use an empty string for missing data.
+    vals = [data[k] if k in data else '' for k in column_names]
+    write_vals(vals)
+
+# Save one line of data to the spill file. The line is the count of columns known so far, followed by the
+# values of those columns. Columns are only ever appended, so the values stay in the right place as more
+# columns are discovered. If still discovering, any other values (like 'operation', or a looked-up
+# 'recipientid') follow as key:value, in case they become columns later.
+def spill_line(data):
+    global column_names, spill_file, discover_columns
+    vals = [data[k] if k in data else '' for k in column_names]
+    spilled = [str(len(vals))] + vals
+    if discover_columns:
+        spilled.extend(['{}:{}'.format(k, v) for k, v in data.items() if k not in column_names])
+    spill_file.write(','.join(spilled))
+    spill_file.write('\n')
+
+# Write one line from the spill file, filling in any columns discovered after it was spilled.
+def write_spilled(line):
+    global column_names
+    parts = line.rstrip('\n').split(',')
+    num_vals = int(parts[0])
+    vals = parts[1:num_vals + 1]
+    if len(column_names) > num_vals:
+        extras = dict(part.split(':', 1) for part in parts[num_vals + 1:])
+        vals.extend([extras[k] if k in extras else '' for k in column_names[num_vals:]])
+    write_vals(vals)
+
+# Writes the data that has been collected, from memory or from the spill file.
 def write_all():
-    global input_data
-    for data in input_data:
-        write_line(data)
+    global input_data, spill_file
+    if spill_file:
+        spill_file.seek(0)
+        for line in spill_file:
+            write_spilled(line)
+        spill_file.close()
+    else:
+        for data in input_data:
+            write_line(data)
+
+
+# Read the manifest of previously converted files, if there is one.
+def load_manifest(filename):
+    global manifest
+    if os.path.exists(filename):
+        with open(filename, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+
+
+# Save the manifest, with the files converted in this run.
+def save_manifest(filename):
+    global manifest, manifest_updates
+    manifest.update(manifest_updates)
+    temp_name = filename + '.new'
+    with open(temp_name, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(temp_name, filename)
+
+
+def hash_file(name):
+    digest = hashlib.sha256()
+    with open(name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Given a list of input files, return those that are new or changed since they were recorded in the
+# manifest. A file with the same size and mtime is taken as unchanged without reading it; otherwise the
+# content hash decides.
+def filter_inputs(names):
+    global manifest, manifest_updates
+    changed = []
+    for name in names:
+        path = os.path.abspath(name)
+        stat = os.stat(name)
+        entry = manifest.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            continue
+        digest = hash_file(name)
+        update = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': digest}
+        if entry and entry['size'] == stat.st_size and entry['sha256'] == digest:
+            # Touched, but not changed.
+            manifest[path] = update
+            continue
+        manifest_updates[path] = update
+        changed.append(name)
+    return changed
+
+
+# Make a connection to the SQL database. As in DbUtils, the credentials come from the secrets store, and
+# may be overridden from the command line.
+def get_db_connection(args):
+    import boto3
+    import pg8000
+
+    parms = {'database': args.db_name, 'user': args.db_user, 'password': args.db_password,
+             'host': args.db_host, 'port': args.db_port}
+    if not all(parms.values()):
+        session = boto3.session.Session()
+        client = session.client(service_name='secretsmanager', region_name='us-west-2')
+        secret = json.loads(client.get_secret_value(SecretId='lb_stats_access2')['SecretString'])
+        parms = {'database': args.db_name or 'dashboard', 'user': args.db_user or secret['username'],
+                 'password': args.db_password or secret['password'], 'host': args.db_host or secret['host'],
+                 'port': args.db_port or secret['port']}
+    parms['port'] = int(parms['port'])
+    return pg8000.connect(**parms)
+
+
+# An output file that streams the data into a database table with COPY ... FROM STDIN. Lines are collected
+# into chunks, and the chunks are passed through a bounded queue to a thread running the COPY. Loading
+# overlaps with reading the input, and memory use is bounded by the size of the queue.
+class CopyToDb:
+    TEMP_TABLE = 'kv2csv_temp'
+
+    def __init__(self, connection, table, merge_keys=None, chunk_size=1_000_000, max_chunks=8):
+        self._connection = connection
+        self._table = table
+        self._merge_keys = merge_keys
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(max_chunks)
+        self._chunk = []
+        self._chunk_len = 0
+        self._thread = None
+        self._error = None
+        self._done = False
+        self.rowcount = 0
+
+    # Start the COPY, now that the column names are known.
+    def _start(self):
+        global column_names
+        target = self._table
+        if self._merge_keys:
+            target = CopyToDb.TEMP_TABLE
+            cursor = self._connection.cursor()
+            cursor.execute('CREATE TEMPORARY TABLE {} AS SELECT * FROM {} WHERE false;'.format(target, self._table))
+        command = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv);'.format(target, ','.join(column_names))
+        self._thread = threading.Thread(target=self._copy, args=(command,), daemon=True)
+        self._thread.start()
+
+    # Runs in the COPY thread.
+    def _copy(self, command):
+        try:
+            cursor = self._connection.cursor()
+            # pg8000 sends each item of an iterable as it is produced.
+            cursor.execute(command, stream=self._chunks())
+            self.rowcount = cursor.rowcount
+        except Exception as ex:
+            self._error = ex
+
+    def _put(self, data):
+        while True:
+            try:
+                self._queue.put(data, timeout=1)
+                return
+            except queue.Full:
+                if self._error or not self._thread.is_alive():
+                    raise self._error or Exception('COPY to {} stopped unexpectedly.'.format(self._table))
+
+    def _flush(self):
+        if self._chunk:
+            self._put(''.join(self._chunk).encode('utf-8'))
+            self._chunk = []
+            self._chunk_len = 0
+
+    def write(self, text):
+        if not self._thread:
+            self._start()
+        self._chunk.append(text)
+        self._chunk_len += len(text)
+        if self._chunk_len >= self._chunk_size:
+            self._flush()
+
+    # Iterated by the database driver, in the COPY thread, for the chunks of data.
+    def _chunks(self):
+        while not self._done:
+            data = self._queue.get()
+            if data is None:
+                self._done = True
+            else:
+                yield data
+
+    def close(self):
+        if self._thread:
+            self._flush()
+            self._put(None)
+            self._thread.join()
+            if self._error:
+                raise self._error
+            if self._merge_keys:
+                cursor = self._connection.cursor()
+                matches = ' AND '.join(['d.{0}=t.{0}'.format(k) for k in self._merge_keys])
+                cursor.execute('DELETE FROM {} d USING {} t WHERE {};'.format(self._table, CopyToDb.TEMP_TABLE, matches))
+                cursor.execute('INSERT INTO {} SELECT * FROM {} ON CONFLICT DO NOTHING;'.format(self._table,
+                                                                                              CopyToDb.TEMP_TABLE))
+            self._connection.commit()
+        self._connection.close()
+        sys.stdout.write('Copied {} rows into {}.\n'.format(self.rowcount, self._table))
 
 
 # Parse the the '--arg x @y z' argument. Expands any @filename args.
@@ -197,31 +464,106 @@ def set_columns(columns):
         column_names = ['timestamp', 'operation']
 
 def main():
-    global needHeader, outfile
+    global needHeader, outfile, spill_file, pool, append_header, output_format, output_name, strict_types
     arg_parser = argparse.ArgumentParser(description="Extract deployments data", usage=usage)
     arg_parser.add_argument('data', nargs='*', help='File name(s), contain(s) the key:value data.')
     arg_parser.add_argument('--no-header', '--noheader', action='store_false', dest='header')
     arg_parser.add_argument('--columns', nargs='*', help='List of column names, in order, or @filename with list')
     arg_parser.add_argument('--output', help='Output file (default is stdout)')
+    arg_parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='Output format.')
+    arg_parser.add_argument('--strict', action='store_true', default=False,
+                            help='With --format parquet, stop at a value that can\'t be converted to its column\'s '
+                                 'type, rather than writing a null.')
+    arg_parser.add_argument('--copy-to-db', metavar='TABLE', help='Stream the data into this database table.')
+    arg_parser.add_argument('--merge-keys', nargs='+', metavar='COLUMN',
+                            help='With --copy-to-db, replace rows in the table that match on these columns.')
     arg_parser.add_argument('--2pass', action='store_true', default=False, dest='two_pass', help='Two pass operation; don\'t load all data into memory.')
+    arg_parser.add_argument('--spill', action='store_true', default=False,
+                            help='One pass operation, spilling rows to a temporary file; don\'t load all data into memory.')
+    arg_parser.add_argument('--jobs', type=int, default=1, help='Number of processes to read the input files.')
+    arg_parser.add_argument('--manifest', help='Optional file of inputs already converted, to be skipped.')
+    arg_parser.add_argument('--append', action='store_true', default=False,
+                            help='Append to the output file; don\'t write a header if the file has one.')
     arg_parser.add_argument('--map', help='Optional csv file of project+community => recipientid.')
     # arg_parser.add_argument('--tbdata', help='Parse data extracted from tbdataoperations table.')
+    # database overrides, for --copy-to-db
+    arg_parser.add_argument('--db-host', default=None, metavar='HOST',
+                            help='Optional host name, default from secrets store.')
+    arg_parser.add_argument('--db-port', default=None, metavar='PORT',
+                            help='Optional host port, default from secrets store.')
+    arg_parser.add_argument('--db-user', default=None, metavar='USER',
+                            help='Optional user name, default from secrets store.')
+    arg_parser.add_argument('--db-password', default=None, metavar='PWD',
+                            help='Optional password, default from secrets store.')
+    arg_parser.add_argument('--db-name', default='dashboard', metavar='DB',
+                            help='Optional database name, default "dashboard".')
     args = arg_parser.parse_args()
+    if args.two_pass and args.spill:
+        arg_parser.error('--2pass and --spill are mutually exclusive.')
+    if args.copy_to_db and args.output:
+        arg_parser.error('--copy-to-db and --output are mutually exclusive.')
+    if args.merge_keys and not args.copy_to_db:
+        arg_parser.error('--merge-keys requires --copy-to-db.')
+    if args.append and not args.output:
+        arg_parser.error('--append requires --output.')
+    if args.format == 'parquet' and (not args.output or args.append):
+        arg_parser.error('--format parquet requires --output, and can\'t --append.')
 
     set_columns(args.columns)
 
     if args.map:
         load_recipient_map(args.map)
 
-    outfile = sys.stdout
-    if args.output:
-        outfile = open(args.output, 'w')
+    names = args.data
+    if args.manifest:
+        load_manifest(args.manifest)
+        names = filter_inputs(names)
+        if args.output:
+            sys.stdout.write('{} of {} files are new or changed.\n'.format(len(names), len(args.data)))
 
+    outfile = sys.stdout
     needHeader = args.header
+    output_format = args.format
+    output_name = args.output
+    strict_types = args.strict
+    if output_format == 'parquet':
+        outfile = None
+    elif args.output:
+        if args.append and args.header and os.path.exists(args.output) and os.path.getsize(args.output) > 0:
+            with open(args.output, 'r') as existing:
+                append_header = existing.readline().rstrip('\n')
+            needHeader = False
+        outfile = open(args.output, 'a' if args.append else 'w')
+
+    if args.copy_to_db:
+        outfile = CopyToDb(get_db_connection(args), args.copy_to_db, merge_keys=args.merge_keys)
+        needHeader = False
+
+    if args.spill:
+        spill_file = tempfile.TemporaryFile('w+', newline='')
+
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(discover_columns, recipient_map))
+
+    process_inputs_list(names, args.two_pass)
+
+    if pool:
+        pool.close()
+        pool.join()
+    if output_format == 'parquet':
+        open_columnar_output().close()
+        sys.stdout.write(''.join(line + '\n' for line in columnar_output.coercion_summary()))
+    else:
+        outfile.close()
 
-    process_inputs_list(args.data, args.two_pass)
+    if args.manifest:
+        save_manifest(args.manifest)
 
-    outfile.close()
+    if recipient_counts:
+        from recipientindex import summarize
+        # Don't mix the summary into the data, if that went to stdout.
+        summary_file = sys.stdout if args.output or args.copy_to_db else sys.stderr
+        summary_file.write(''.join(line + '\n' for line in summarize(recipient_counts)))
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,306 @@
+"""
+recipientindex.py
+
+A compiled index of a recipients_map.csv file, mapping (project, directory) to recipientid. Shared by
+kv2csv.py, tbsdeployed.py, and ufUtility.py.
+
+The index is built once per content of the .csv file (and of the recipient_overrides table), and saved next to
+the .csv file. Later loads just memory-map the saved index, which takes milliseconds, and which lets parallel
+worker processes share one copy of the index through the page cache.
+
+Keys are normalized when the index is built (upper case, no quotes), and the entries from recipient_overrides
+are added as their own keys, so a lookup is a single binary search.
+
+File layout, all integers little-endian uint32:
+    magic (8 bytes), N, key_offsets[N+1], value_offsets[N+1], flags[N] (bytes), keys, values
+Keys are 'PROJECT\\x1fDIRECTORY', sorted. A value is the recipientid; for an override entry it is followed by
+'\\x1f' and the directory the override maps to.
+"""
+import csv
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import time
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, Iterable, List, Mapping, Tuple, Union
+
+# Some community names, as recorded on Talking Books, that don't match the recipients_map directory.
+recipient_overrides = {
+
+    "MEDA": {
+        "KANDANBAMBO B - CHARINGU": "KANDANBAMBO B - CHARIGU",
+        "KANYIRI - CHARINGU": "KANYIRI - CHARIGU",
+        "KATIMEN-LINYE - FIAN": "KATIMEN - LINYE - FIAN",
+        "MWINISUMBO - KULKPONG": "MWINISUMBU - KULKPONG",
+        "POGBETIETAA - BUNAA": "POGBATIETAA - BUNAA",
+        "POG-OLO - BULEN": "POG - OLO - BULEN",
+        "SUNGTAAMAALITAA A - BULEN": "SUNTAAMAALITAA - A - BULEN",
+        "TIETAA - IRI - TAFALI": "TIETAA-IRI - TAFALI"
+    },
+    "UWR": {
+        "MOTHER TO MOTHER SUPPORT TAMPAALA": "TAMPAALA-JIRAPA",  # this is a bit of a stretch, going on Tampaala.
+        "KABERE-YOUTH TAMPAALA": "TAMPAALA-JIRAPA"
+    },
+    "CARE": {
+        "KPATUA NO": "KPATUA NO 1",
+        "SONGO ANONGTAABA": "SONGO ANONGTAABA 1"
+    }
+}
+
+FORMAT_VERSION = b'LBRIDX01'
+SEP = '\x1f'
+_U32 = struct.Struct('<I')
+_FLAG_OVERRIDE = 1
+# Indices of earlier versions of a .csv file are removed once they are this old, by which time no other
+# process should still be writing or opening them.
+STALE_INDEX_SECONDS = 24 * 60 * 60
+
+# Lookup statuses.
+FOUND = 0
+NO_PROJECT = 1
+NO_DIRECTORY = 2
+
+# The result of a lookup. project and directory are normalized; directory is after any override. override is
+# the directory as given, if an override was applied, otherwise None.
+Resolution = namedtuple('Resolution', ['recipientid', 'status', 'project', 'directory', 'override'])
+
+
+def normalize(name: str) -> str:
+    return name.upper().strip('"')
+
+
+def _build(entries: Dict[str, Tuple[str, int]]) -> bytes:
+    """
+    Build the bytes of an index from {key: (value, flags)}.
+    """
+    keys = sorted(entries.keys())
+    key_blob = bytearray()
+    value_blob = bytearray()
+    key_offsets = [0]
+    value_offsets = [0]
+    flags = bytearray()
+    for key in keys:
+        value, flag = entries[key]
+        key_blob += key.encode('utf-8')
+        value_blob += value.encode('utf-8')
+        key_offsets.append(len(key_blob))
+        value_offsets.append(len(value_blob))
+        flags.append(flag)
+    n = len(keys)
+    return b''.join([FORMAT_VERSION, _U32.pack(n), struct.pack(f'<{n + 1}I', *key_offsets),
+                     struct.pack(f'<{n + 1}I', *value_offsets), bytes(flags), bytes(key_blob), bytes(value_blob)])
+
+
+def _entries_from_rows(rows: Iterable[Tuple[str, str, str]]) -> Dict[str, Tuple[str, int]]:
+    """
+    Given (project, directory, recipientid) rows, compute the normalized entries, including the overrides.
+    """
+    entries: Dict[str, Tuple[str, int]] = {}
+    for project, directory, recipientid in rows:
+        entries[normalize(project) + SEP + normalize(directory)] = (recipientid, 0)
+    for project, overrides in recipient_overrides.items():
+        for directory, override in overrides.items():
+            target = entries.get(project + SEP + override)
+            recipientid = target[0] if target else ''
+            entries[project + SEP + directory] = (recipientid + SEP + override, _FLAG_OVERRIDE)
+    return entries
+
+
+def _read_csv_rows(csv_data: bytes) -> List[Tuple[str, str, str]]:
+    lines = csv_data.decode('utf-8').splitlines()
+    reader = csv.reader(lines, delimiter=',')
+    rows = []
+    proj_ix = directory_ix = recip_ix = 0
+    for row in reader:
+        if reader.line_num == 1:
+            proj_ix = row.index('project')
+            directory_ix = row.index('directory')
+            recip_ix = row.index('recipientid')
+        elif row:
+            rows.append((row[proj_ix], row[directory_ix], row[recip_ix]))
+    return rows
+
+
+def _content_hash(csv_data: bytes) -> str:
+    digest = hashlib.sha256(FORMAT_VERSION)
+    digest.update(repr(sorted((p, sorted(o.items())) for p, o in recipient_overrides.items())).encode('utf-8'))
+    digest.update(csv_data)
+    return digest.hexdigest()[:16]
+
+
+class RecipientIndex:
+    def __init__(self, buffer: Union[bytes, mmap.mmap], path: Union[Path, None] = None):
+        """
+        Wraps the bytes of an index. Use load() or from_rows() to create one.
+        :param buffer: The index bytes, or a mmap of an index file.
+        :param path: The file, if the index is memory-mapped from a file.
+        """
+        if buffer[:len(FORMAT_VERSION)] != FORMAT_VERSION:
+            raise ValueError('Not a recipient index, or an unknown version.')
+        self._buffer = buffer
+        self.path = path
+        offset = len(FORMAT_VERSION)
+        self._n = _U32.unpack_from(buffer, offset)[0]
+        offset += 4
+        self._key_offsets = offset
+        offset += 4 * (self._n + 1)
+        self._value_offsets = offset
+        offset += 4 * (self._n + 1)
+        self._flags = offset
+        offset += self._n
+        self._keys = offset
+        self._values = offset + _U32.unpack_from(buffer, self._value_offsets - 4)[0]
+        if len(buffer) < self._values + _U32.unpack_from(buffer, self._flags - 4)[0]:
+            raise ValueError('Truncated recipient index.')
+
+    def __len__(self):
+        return self._n
+
+    def __reduce__(self):
+        # Worker processes re-open the file, rather than receiving a copy of the index.
+        if self.path:
+            return RecipientIndex.open, (self.path,)
+        return RecipientIndex, (bytes(self._buffer),)
+
+    @staticmethod
+    def open(path: Path) -> 'RecipientIndex':
+        with open(path, 'rb') as index_file:
+            buffer = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return RecipientIndex(buffer, path)
+
+    @staticmethod
+    def from_rows(rows: Iterable[Tuple[str, str, str]]) -> 'RecipientIndex':
+        """
+        Builds an in-memory index from (project, directory, recipientid) rows.
+        """
+        return RecipientIndex(_build(_entries_from_rows(rows)))
+
+    @staticmethod
+    def load(csv_path: Union[Path, str], cache_dir: Union[Path, str, None] = None) -> 'RecipientIndex':
+        """
+        Loads the index for a recipients_map.csv file, building and saving it if there isn't already an index
+        for the file's content.
+        :param csv_path: The recipients_map.csv file, with columns project, directory, and recipientid.
+        :param cache_dir: Optional directory for the saved index. Default is the directory of the .csv file.
+        :return: The index.
+        """
+        csv_path = Path(csv_path)
+        csv_data = csv_path.read_bytes()
+        cache_dir = Path(cache_dir) if cache_dir else csv_path.parent
+        index_path = Path(cache_dir, f'.{csv_path.stem}.{_content_hash(csv_data)}.idx')
+        if index_path.exists():
+            try:
+                return RecipientIndex.open(index_path)
+            except (OSError, ValueError, struct.error):
+                # Unreadable, or damaged; build it again.
+                pass
+        index_bytes = _build(_entries_from_rows(_read_csv_rows(csv_data)))
+        try:
+            # A temporary file of our own, so that concurrent loads don't write into the same file.
+            with tempfile.NamedTemporaryFile(dir=cache_dir, prefix=f'.{csv_path.stem}.', suffix='.new',
+                                             delete=False) as temp_file:
+                temp_file.write(index_bytes)
+            try:
+                os.replace(temp_file.name, index_path)
+            except OSError:
+                os.unlink(temp_file.name)
+                raise
+            # Remove any stale indices of earlier versions of the .csv file. A recent one may still be in use
+            # by another process with the earlier .csv file.
+            stale = time.time() - STALE_INDEX_SECONDS
+            for old in cache_dir.glob(f'.{csv_path.stem}.*.idx'):
+                try:
+                    if old != index_path and old.stat().st_mtime < stale:
+                        old.unlink()
+                except OSError:
+                    pass
+            return RecipientIndex.open(index_path)
+        except OSError:
+            # Can't save it; use it from memory.
+            return RecipientIndex(index_bytes)
+
+    def _key(self, ix: int) -> bytes:
+        start = _U32.unpack_from(self._buffer, self._key_offsets + 4 * ix)[0]
+        end = _U32.unpack_from(self._buffer, self._key_offsets + 4 * ix + 4)[0]
+        return self._buffer[self._keys + start:self._keys + end]
+
+    def _value(self, ix: int) -> str:
+        start = _U32.unpack_from(self._buffer, self._value_offsets + 4 * ix)[0]
+        end = _U32.unpack_from(self._buffer, self._value_offsets + 4 * ix + 4)[0]
+        return self._buffer[self._values + start:self._values + end].decode('utf-8')
+
+    def _lower_bound(self, key: bytes) -> int:
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, key: bytes) -> int:
+        ix = self._lower_bound(key)
+        return ix if ix < self._n and self._key(ix) == key else -1
+
+    def has_project(self, project: str) -> bool:
+        prefix = (normalize(project) + SEP).encode('utf-8')
+        ix = self._lower_bound(prefix)
+        # Skip the project's override entries; they don't mean that the project is in the map.
+        while ix < self._n and self._key(ix).startswith(prefix):
+            if not self._buffer[self._flags + ix] & _FLAG_OVERRIDE:
+                return True
+            ix += 1
+        return False
+
+    def lookup(self, project: str, directory: str) -> Resolution:
+        """
+        Look up the recipientid for a project and directory (aka community).
+        :return: a Resolution, with the recipientid (or None), and how it was, or wasn't, found.
+        """
+        project = normalize(project)
+        directory = normalize(directory)
+        ix = self._find((project + SEP + directory).encode('utf-8'))
+        if ix < 0:
+            status = NO_DIRECTORY if self.has_project(project) else NO_PROJECT
+            return Resolution(None, status, project, directory, None)
+        value = self._value(ix)
+        if not self._buffer[self._flags + ix] & _FLAG_OVERRIDE:
+            return Resolution(value, FOUND, project, directory, None)
+        recipientid, override = value.split(SEP, 1)
+        if recipientid:
+            return Resolution(recipientid, FOUND, project, override, directory)
+        status = NO_DIRECTORY if self.has_project(project) else NO_PROJECT
+        return Resolution(None, status, project, override, directory)
+
+    def get(self, project: str, directory: str, default: str = None) -> Union[str, None]:
+        return self.lookup(project, directory).recipientid or default
+
+
+def summarize(counts: Mapping[Resolution, int]) -> List[str]:
+    """
+    Summarize the lookups of a run, in place of a warning per name as it is first seen.
+    :param counts: {Resolution: number of rows so resolved}
+    :return: Lines of text: totals, then the overrides used, and the names not found, with their row counts.
+    """
+    rows = sum(counts.values())
+    found = sum(n for r, n in counts.items() if r.recipientid)
+    overridden = sum(n for r, n in counts.items() if r.override)
+    lines = [f'Recipient lookups: {rows:,} rows, {len(counts):,} distinct names; {found:,} found, '
+             f'{rows - found:,} not found, {overridden:,} by override.']
+    ordered = sorted(counts.items(), key=lambda item: (item[0].project, item[0].directory, item[0].override or ''))
+    projects: Dict[str, int] = {}
+    for r, n in ordered:
+        if r.override:
+            lines.append(f'  Using {r.directory} as override for {r.override} in {r.project}: {n:,} rows.')
+        if r.status == NO_PROJECT:
+            projects[r.project] = projects.get(r.project, 0) + n
+    for project, n in projects.items():
+        lines.append(f'  Project {project} is not in recipient map: {n:,} rows.')
+    for r, n in ordered:
+        if r.status == NO_DIRECTORY:
+            lines.append(f'  directory {r.directory} is not in map for {r.project}: {n:,} rows.')
+    return lines
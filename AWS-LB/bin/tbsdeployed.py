@@ -1,6 +1,14 @@
 import argparse
+import collections
+import contextlib
 import csv
 from datetime import datetime
+import functools
+import itertools
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import operator
 import os
 import re
 import sys
@@ -11,231 +19,443 @@ Create a tbsdeployed.csv, suitable for insertion into a database.'''
 # tbsdeployed table column names, in order
 columns = ['talkingbookid', 'recipientid', 'deployedtimestamp', 'project', 'deployment', 'contentpackage', 'firmware',
            'location', 'coordinates', 'username', 'tbcdid', 'action', 'newsn', 'testing']
+# Types of the tbsdeployed columns, for columnar output. Other columns are strings.
+column_types = {'deployedtimestamp': 'timestamp', 'newsn': 'bool', 'testing': 'bool'}
 
-deployments = []
 outFile = None
 needHeader = True
 UNKNOWN = 'Unknown'
 non_specifics = {}
-
-recipient_map = {}
-proj_warnings = {}
-comm_warnings = {}
-overrides_used = {}
-
-recipient_overrides = {
-
-    "MEDA": {
-        "KANDANBAMBO B - CHARINGU": "KANDANBAMBO B - CHARIGU",
-        "KANYIRI - CHARINGU": "KANYIRI - CHARIGU",
-        "KATIMEN-LINYE - FIAN": "KATIMEN - LINYE - FIAN",
-        "MWINISUMBO - KULKPONG": "MWINISUMBU - KULKPONG",
-        "POGBETIETAA - BUNAA": "POGBATIETAA - BUNAA",
-        "POG-OLO - BULEN": "POG - OLO - BULEN",
-        "SUNGTAAMAALITAA A - BULEN": "SUNTAAMAALITAA - A - BULEN",
-        "TIETAA - IRI - TAFALI": "TIETAA-IRI - TAFALI"
-    },
-    "UWR": {
-        "MOTHER TO MOTHER SUPPORT TAMPAALA": "TAMPAALA-JIRAPA",  # this is a bit of a stretch, going on Tampaala.
-        "KABERE-YOUTH TAMPAALA": "TAMPAALA-JIRAPA"
-    },
-    "CARE": {
-        "KPATUA NO": "KPATUA NO 1",
-        "SONGO ANONGTAABA": "SONGO ANONGTAABA 1"
-    }
-}
+duplicates = 0
+# Per tbcdid, the deployedtimestamp key of the latest deployment emitted by earlier runs; see --watermark.
+watermarks = {}
+new_watermarks = {}
+already_emitted_count = 0
+# Threads listing directories, for --scan. Listing is I/O bound, and the tree may be on a network file system.
+SCAN_THREADS = 16
+
+recipient_map = None
+# Rows per recipient Resolution, summarized at the end of the run.
+recipient_counts = collections.Counter()
 
 # Ignore leading spaces or (, take number, ignore spaces and comma, take number,
 # ignore trailing spaces or )
 COORDINATES_PATTERN = re.compile('^\\s*\\(?\\s*([+-]?[\\d.]+)[\\s,]*([+-]?[\\d.]+)\\s*\\)?\\s*$')
+TIMESTAMP_DIGITS = re.compile('\\d+')
+# A tbdataoperations updatedatetime that is already 'YYYY-MM-DD HH:MM:SS' in its first 19 characters.
+TBDATA_TIMESTAMP_PATTERN = re.compile('\\d{4}-\\d\\d-\\d\\d[ T]\\d\\d:\\d\\d:\\d\\d')
 
+# Load the recipient index for the recipients_map.csv; it is compiled once per content of the file.
 def parse_map_file(filename):
     global recipient_map
+    from recipientindex import RecipientIndex
     try:
-        map_file = open(filename, 'rt')
-        csvfile = csv.reader(map_file, delimiter=',')
-        proj_ix = directory_ix = recip_ix = 0
-
-        for row in csvfile:
-            if csvfile.line_num == 1:
-                proj_ix = row.index('project')
-                directory_ix = row.index('directory')
-                recip_ix = row.index('recipientid')
-            else:
-                proj = row[proj_ix].upper()
-                directory = row[directory_ix].upper()
-                recipientid = row[recip_ix]
-                if proj not in recipient_map:
-                    recipient_map[proj] = {}
-                recipient_map[proj][directory] = recipientid
+        recipient_map = RecipientIndex.load(filename)
     except Exception as ignored:
-        pass
+        recipient_map = RecipientIndex.from_rows([])
+    resolve_recipient.cache_clear()
+
+# Resolve a project+community. There are few distinct pairs but many rows, so resolutions, found or not,
+# are memoized.
+@functools.lru_cache(maxsize=65536)
+def resolve_recipient(proj, directory):
+    return recipient_map.lookup(proj, directory)
 
 def lookup_recipient(proj, directory):
-    global recipient_overrides, recipient_map, proj_warnings, comm_warnings, overrides_used
-    proj = proj.upper()
-    directory = directory.upper()
-    if proj in recipient_overrides and directory in recipient_overrides[proj]:
-        override = recipient_overrides[proj][directory]
-        if proj not in overrides_used or directory not in overrides_used[proj]:
-            if proj not in overrides_used: overrides_used[proj] = {}
-            overrides_used[proj][directory] = True
-            sys.stdout.write('Using {} as override for {}.\n'.format(override, directory))
-        directory = override
-    if proj not in recipient_map:
-        if proj not in proj_warnings:
-            proj_warnings[proj] = True
-            sys.stdout.write('Project {} is not in recipient map.\n'.format(proj))
-        return None
-    if directory not in recipient_map[proj]:
-        if proj not in comm_warnings or directory not in comm_warnings[proj]:
-            if proj not in comm_warnings: comm_warnings[proj] = {}
-            comm_warnings[proj][directory] = True
-            sys.stdout.write('directory {} is not in map for {}.\n'.format(directory, proj))
-        return None
-    return recipient_map[proj][directory]
-
-
-# Read and process an extract of tbdataoperations,
+    global recipient_counts
+    resolution = resolve_recipient(proj, directory)
+    recipient_counts[resolution] += 1
+    return resolution.recipientid
+
+
+# tbsdeployed.py is a pipeline of generators: read, normalize, skip non-specific, resolve recipient, keep
+# complete records, write. Each record is a dict keyed by column name. Only one record at a time is in
+# flight, so memory stays flat however many deploymentsAll.log files are read.
+
+# Read the data extracted from the tbdataoperations table. Yields records with the fields renamed, but
+# otherwise as in the table.
 def read_tbdataactions(filename):
-    global deployments
-    tbdata_file = open(filename, 'rt')
-    tbdata_csv = csv.reader(tbdata_file, delimiter=',')
-    # These two lines are stupid, but quiet lint.
-    outsn_ix = updatedatetime_ix = project_ix = deployment_ix = package_ix = community_ix = 0
-    firmware_ix = syncdir_ix = location_ix = action_ix = 0
-
-    for row in tbdata_csv:
-        if tbdata_csv.line_num == 1:
-            # First line, extract the column indices. Column names as in tbdataoperations.
-            outsn_ix = row.index("outsn")
-            updatedatetime_ix = row.index("updatedatetime")
-            project_ix = row.index("project")
-            deployment_ix = row.index("outdeployment")
-            package_ix = row.index("outimage")
-            community_ix = row.index("outcommunity")
-            firmware_ix = row.index("outfwrev")
-            syncdir_ix = row.index("outsyncdir")
-            location_ix = row.index("location")
-            action_ix = row.index("action")
-        else:
-            # Subsequent lines: reformat the data as needed.
-            sn = row[outsn_ix]
-            if len(sn) == 0 or sn == '-- TO BE ASSIGNED --':
-                sn = UNKNOWN
-            community = row[community_ix]
-            if community.upper() == 'NON-SPECIFIC':
-                project = row[project_ix]
-                if project not in non_specifics:
-                    non_specifics[project] = 1
-                else:
-                    non_specifics[project] = non_specifics[project] + 1
-                continue
-            out_row = {'talkingbookid': sn}
-            ts = row[updatedatetime_ix]
-            year = int(ts[0:4])
-            month = int(ts[5:7])
-            day = int(ts[8:10])
-            hour = int(ts[11:13])
-            minute = int(ts[14:16])
-            second = int(ts[17:19])
-            deployment_ts = str(datetime(year, month, day, hour, minute, second))
-            out_row['deployedtimestamp'] = deployment_ts
-            out_row['project'] = row[project_ix]
-            out_row['deployment'] = row[deployment_ix]
-            out_row['contentpackage'] = row[package_ix]
-
-            out_row['community'] = row[community_ix]
-            fw = row[firmware_ix]
-            if len(fw) == 0:
-                fw = UNKNOWN
-            out_row['firmware'] = fw
-            out_row['location'] = row[location_ix]
-            out_row['coordinates'] = ''
-            out_row['username'] = UNKNOWN
-
-            out_row['recipientid'] = lookup_recipient(row[project_ix], row[community_ix])
-
-            syncdir = row[syncdir_ix]
-            tbcdid = UNKNOWN
-            if len(syncdir) > 0:
-                tbcdid = syncdir[-4:]
-            out_row['tbcdid'] = tbcdid
-
-            out_row['action'] = row[action_ix]
-            out_row['newsn'] = 'f'
-            out_row['testing'] = 'f'
-
-            deployments.append(out_row)
-
-
-# Read an deploymentsAll.log file; comma-separated key:value pairs.
+    with open(filename, 'rt') as tbdata_file:
+        tbdata_csv = csv.reader(tbdata_file, delimiter=',')
+        # These two lines are stupid, but quiet lint.
+        outsn_ix = updatedatetime_ix = project_ix = deployment_ix = package_ix = community_ix = 0
+        firmware_ix = syncdir_ix = location_ix = action_ix = 0
+
+        for row in tbdata_csv:
+            if tbdata_csv.line_num == 1:
+                # First line, extract the column indices. Column names as in tbdataoperations.
+                outsn_ix = row.index("outsn")
+                updatedatetime_ix = row.index("updatedatetime")
+                project_ix = row.index("project")
+                deployment_ix = row.index("outdeployment")
+                package_ix = row.index("outimage")
+                community_ix = row.index("outcommunity")
+                firmware_ix = row.index("outfwrev")
+                syncdir_ix = row.index("outsyncdir")
+                location_ix = row.index("location")
+                action_ix = row.index("action")
+            else:
+                yield {'talkingbookid': row[outsn_ix], 'deployedtimestamp': row[updatedatetime_ix],
+                       'project': row[project_ix], 'deployment': row[deployment_ix],
+                       'contentpackage': row[package_ix], 'community': row[community_ix],
+                       'firmware': row[firmware_ix], 'syncdir': row[syncdir_ix], 'location': row[location_ix],
+                       'action': row[action_ix]}
+
+
+# Reformat a tbdataoperations updatedatetime, like '2017-09-30 12:34:56.789', as '2017-09-30 12:34:56'.
+def format_tbdata_timestamp(ts):
+    year = int(ts[0:4])
+    month = int(ts[5:7])
+    day = int(ts[8:10])
+    hour = int(ts[11:13])
+    minute = int(ts[14:16])
+    second = int(ts[17:19])
+    return str(datetime(year, month, day, hour, minute, second))
+
+
+# Reformat records from tbdataoperations as needed, and fill in the fields it doesn't have.
+def normalize_tbdataactions(records):
+    for out_row in records:
+        sn = out_row['talkingbookid']
+        if len(sn) == 0 or sn == '-- TO BE ASSIGNED --':
+            out_row['talkingbookid'] = UNKNOWN
+        out_row['deployedtimestamp'] = format_tbdata_timestamp(out_row['deployedtimestamp'])
+        if len(out_row['firmware']) == 0:
+            out_row['firmware'] = UNKNOWN
+        out_row['coordinates'] = ''
+        out_row['username'] = UNKNOWN
+        syncdir = out_row.pop('syncdir')
+        out_row['tbcdid'] = syncdir[-4:] if len(syncdir) > 0 else UNKNOWN
+        out_row['newsn'] = 'f'
+        out_row['testing'] = 'f'
+        yield out_row
+
+
+# Batch mode for the tbdataoperations extract, which can be millions of rows. Reads the extract in chunks of
+# batch_size rows, transposes each chunk into columns, and does the work of read_tbdataactions,
+# normalize_tbdataactions, skip_emitted, skip_non_specific, resolve_recipients and keep_complete a column at a
+# time, in that order. Yields the same records, and counts the same skipped ones, as those would. A row without
+# all of the columns is an error.
+def read_tbdataactions_batched(filename, batch_size):
+    global already_emitted_count
+    # Fields that are the same in every record from tbdataoperations.
+    constants = {'coordinates': '', 'username': UNKNOWN, 'newsn': 'f', 'testing': 'f'}
+    keys = ['talkingbookid', 'deployedtimestamp', 'project', 'deployment', 'contentpackage', 'community',
+            'firmware', 'location', 'action', 'recipientid', 'tbcdid']
+    is_formatted = TBDATA_TIMESTAMP_PATTERN.match
+
+    with open(filename, 'rt') as tbdata_file:
+        tbdata_csv = csv.reader(tbdata_file, delimiter=',')
+        header = next(tbdata_csv, None)
+        if header is None:
+            return
+        # Column names as in tbdataoperations.
+        indices = [header.index(name) for name in ['outsn', 'updatedatetime', 'project', 'outdeployment', 'outimage',
+                                                   'outcommunity', 'outfwrev', 'outsyncdir', 'location', 'action']]
+        # Every row must have the columns we use; zip() would silently drop any column a short row lacks.
+        width = max(indices) + 1
+        n_rows = 0
+        while True:
+            chunk = list(itertools.islice(tbdata_csv, batch_size))
+            if not chunk:
+                break
+            for row_num, row in enumerate(chunk, n_rows + 1):
+                if len(row) < width:
+                    raise ValueError('{}: data row {} has {} fields, but at least {} are needed.'.format(
+                        filename, row_num, len(row), width))
+            n_rows += len(chunk)
+            data_columns = list(zip(*chunk))
+            sn, ts, project, deployment, package, community, fw, syncdir, location, action = \
+                [data_columns[ix] for ix in indices]
+
+            sn = [UNKNOWN if len(s) == 0 or s == '-- TO BE ASSIGNED --' else s for s in sn]
+            # Almost every timestamp can be reformatted by slicing; anything else takes the slow path.
+            ts = [t[:10] + ' ' + t[11:19] if is_formatted(t) else format_tbdata_timestamp(t) for t in ts]
+            fw = [f or UNKNOWN for f in fw]
+            tbcdid = [d[-4:] or UNKNOWN for d in syncdir]
+
+            # In the same order as the other readers: first skip what earlier runs emitted...
+            if watermarks:
+                new = [not already_emitted(t, d) for t, d in zip(tbcdid, ts)]
+                if not all(new):
+                    already_emitted_count += len(new) - sum(new)
+                    sn, ts, project, deployment, package, community, fw, location, action, tbcdid = \
+                        [list(itertools.compress(c, new)) for c in
+                         (sn, ts, project, deployment, package, community, fw, location, action, tbcdid)]
+
+            # ...then, as we can't know the recipient for 'NON-SPECIFIC', count them, and drop them from every
+            # column.
+            specific = [c.upper() != 'NON-SPECIFIC' for c in community]
+            if not all(specific):
+                for p, keep in zip(project, specific):
+                    if not keep:
+                        non_specifics[p] = non_specifics.get(p, 0) + 1
+                sn, ts, project, deployment, package, community, fw, location, action, tbcdid = \
+                    [list(itertools.compress(c, specific)) for c in
+                     (sn, ts, project, deployment, package, community, fw, location, action, tbcdid)]
+
+            resolutions = list(map(resolve_recipient, project, community))
+            recipient_counts.update(resolutions)
+            recipientid = [r.recipientid for r in resolutions]
+
+            # Keep the records with a recipient; like keep_complete, as every other field is present.
+            for values in itertools.compress(zip(sn, ts, project, deployment, package, community, fw, location,
+                                                 action, recipientid, tbcdid), recipientid):
+                record = dict(zip(keys, values))
+                record.update(constants)
+                yield record
+
+
+# Read a deploymentsAll.log file; comma-separated key:value pairs. Yields a record per line, of the fields
+# we keep.
 def read_deployments(filename):
-    global deployments
-    deployments_file = open(filename, 'rt')
-    found = 0
     # Map of fields we want to keep to the names by which we wish to keep them.
     keepers = {'sn': 'talkingbookid', 'timestamp': 'deployedtimestamp', 'project': 'project',
                'deployment': 'deployment', 'package': 'contentpackage', 'recipientid': 'recipientid',
                'community': 'community',
                'firmware': 'firmware', 'location': 'location', 'coordinates': 'coordinates', 'username': 'username',
                'tbcdid': 'tbcdid', 'action': 'action', 'newsn': 'newsn', 'testing': 'testing'}
-    optionals = {'newsn': 'f', 'testing': 'f', 'coordinates': ''}
 
-    lines = [line.strip() for line in deployments_file]
-    for line in lines:
-        if len(line) < 1:
-            continue
-        #  First two fields are timestamp,operation, then k:v pairs separated by commas.
-        parts = line.split(',')
-        if len(parts) < 3:
-            continue
-        # Map into a csv line.
-        data = {}
-        for ix in range(2, len(parts)):
-            (k, v) = parts[ix].split(':', 1)
-            if k in keepers:
-                data[keepers[k]] = v
-                found += 1
+    with open(filename, 'rt') as deployments_file:
+        for line in deployments_file:
+            line = line.strip()
+            if len(line) < 1:
+                continue
+            #  First two fields are timestamp,operation, then k:v pairs separated by commas.
+            parts = line.split(',')
+            if len(parts) < 3:
+                continue
+            # Map into a csv line.
+            data = {}
+            for ix in range(2, len(parts)):
+                (k, v) = parts[ix].split(':', 1)
+                if k in keepers:
+                    data[keepers[k]] = v
+            yield data
+
+
+def read_deployments_list(names):
+    for name in names:
+        yield from read_deployments(name)
+
+
+# Apply default values to records from deploymentsAll.log, and reformat the coordinates.
+def normalize_deployments(records):
+    optionals = {'newsn': 'f', 'testing': 'f', 'coordinates': ''}
+    for data in records:
         # Apply default values for missing but optional fields
         for o in optionals:
             if o not in data:
                 data[o] = optionals[o]
-        # We can't know the recipient for 'NON-SPECIFIC'.
-        if data['community'].upper() == 'NON-SPECIFIC':
-            project = data['project']
+        if data.get('username') == '':
+            data['username'] = 'UNKNOWN'
+        coordinate = ''
+        match = COORDINATES_PATTERN.match(data['coordinates']) if data['coordinates'] else None
+        if match:
+            coordinate = '"({},{})"'.format(match.group(1), match.group(2))
+        data['coordinates'] = coordinate
+        yield data
+
+
+# --watermark: the latest deployedtimestamp emitted per tbcdid is saved after each run. Later runs skip the
+# deployments that are no newer, as early in the pipeline as possible, so that a run costs time in proportion
+# to the new deployments.
+def load_watermarks(filename):
+    global watermarks, new_watermarks
+    if os.path.exists(filename):
+        with open(filename, 'r') as watermark_file:
+            watermarks = json.load(watermark_file)
+    new_watermarks = dict(watermarks)
+
+
+def save_watermarks(filename):
+    temp_name = filename + '.new'
+    with open(temp_name, 'w') as watermark_file:
+        json.dump(new_watermarks, watermark_file, indent=2, sort_keys=True)
+    os.replace(temp_name, filename)
+
+
+# True if a deployment is no newer than the watermark for its tbcdid, so an earlier run emitted it.
+def already_emitted(tbcdid, timestamp):
+    mark = watermarks.get(tbcdid)
+    return mark is not None and timestamp_key(timestamp) <= mark
+
+
+# Drop the records that an earlier run emitted. Records without a timestamp are left for keep_complete.
+def skip_emitted(records):
+    global already_emitted_count
+    for data in records:
+        if 'deployedtimestamp' in data and already_emitted(data.get('tbcdid', ''), data['deployedtimestamp']):
+            already_emitted_count += 1
+            continue
+        yield data
+
+
+# Note the latest deployedtimestamp of the records being emitted, per tbcdid.
+def advance_watermarks(records):
+    for data in records:
+        key = timestamp_key(data['deployedtimestamp'])
+        if key > new_watermarks.get(data['tbcdid'], ''):
+            new_watermarks[data['tbcdid']] = key
+        yield data
+
+
+# Returns the sorted paths of the subdirectories of path, ignoring hidden ones.
+def list_subdirs(path):
+    with os.scandir(path) as it:
+        return sorted(entry.path for entry in it if not entry.name.startswith('.') and entry.is_dir())
+
+
+# Find the year/month/day directories under a collected-data-processed directory, in chronological order.
+# Each level is listed concurrently. Days before since ('YYYY-MM-DD') are skipped.
+def find_days(root, threads, since=None):
+    months = [m for ms in threads.map(list_subdirs, list_subdirs(root)) for m in ms]
+    days = [d for ds in threads.map(list_subdirs, months) for d in ds]
+    if since:
+        since = since.replace('-', '/')
+        days = [d for d in days if os.path.relpath(d, root) >= since]
+    return days
+
+
+# Find the deploymentsAll.log files anywhere within one day's directory.
+def find_day_logs(day_path):
+    logs = []
+    dirs = [day_path]
+    while dirs:
+        with os.scandir(dirs.pop()) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                elif entry.name.lower() == 'deploymentsall.log':
+                    logs.append(entry.path)
+    return sorted(logs)
+
+
+# Read and normalize one day's deploymentsAll.log files, in a worker process or not. Returns the records sorted
+# by deployedtimestamp, and the number skipped as already emitted. That number is left to the caller to count.
+def parse_day_logs(logs):
+    global already_emitted_count
+    emitted_before = already_emitted_count
+    records = list(normalize_deployments(skip_emitted(read_deployments_list(logs))))
+    records.sort(key=lambda data: data.get('deployedtimestamp', ''))
+    skipped = already_emitted_count - emitted_before
+    already_emitted_count = emitted_before
+    return records, skipped
+
+
+# Set up a worker process with the parent's watermarks.
+def init_worker(marks):
+    global watermarks
+    watermarks = marks
+
+
+# Scan a collected-data-processed tree for deploymentsAll.log files, and read them. The directories are
+# listed by a pool of threads, and then each day's logs parsed by a pool of processes. The listing is finished,
+# and its threads gone, before the processes are forked, as forking with threads running can deadlock the
+# children. The days are yielded in order, each sorted by timestamp, as soon as they are ready. With only one
+# job, there's no point in a pool.
+def read_scanned_deployments(root, jobs=None, since=None):
+    global already_emitted_count
+    jobs = jobs or os.cpu_count() or 1
+    with ThreadPool(SCAN_THREADS) as threads:
+        day_logs = threads.map(find_day_logs, find_days(root, threads, since))
+    with (multiprocessing.Pool(jobs, initializer=init_worker, initargs=(watermarks,)) if jobs > 1
+          else contextlib.nullcontext()) as workers:
+        for records, skipped in (workers.imap if workers else map)(parse_day_logs, day_logs):
+            already_emitted_count += skipped
+            yield from records
+
+
+# We can't know the recipient for 'NON-SPECIFIC'. Count those, per project, and drop them.
+def skip_non_specific(records):
+    for data in records:
+        if data.get('community', '').upper() == 'NON-SPECIFIC':
+            project = data.get('project')
             if project not in non_specifics:
                 non_specifics[project] = 1
             else:
                 non_specifics[project] = non_specifics[project] + 1
             continue
-        if data['username'] == '':
-            data['username'] = 'UNKNOWN'
-        if 'recipientid' not in data:
-            recipientid = lookup_recipient(data['project'], data['community'])
-            if not recipientid:
-                continue
-            data['recipientid'] = recipientid
-        if 'coordinates' in data:
-            coordinate = ''
-            match = COORDINATES_PATTERN.match(data['coordinates']) if data['coordinates'] else None
-            if match:
-                coordinate = '"({},{})"'.format(match.group(1), match.group(2))
-            data['coordinates'] = coordinate
+        yield data
 
-        # If we got every required field, keep the row.
-        if all(x in data for x in columns):
-            deployments.append(data)
 
+# Fill in the recipientid of records that don't have one.
+def resolve_recipients(records):
+    for data in records:
+        if 'recipientid' not in data and 'project' in data and 'community' in data:
+            data['recipientid'] = lookup_recipient(data['project'], data['community'])
+        yield data
+
+
+# If we got every required field, keep the record.
+def keep_complete(records):
+    for data in records:
+        if None not in map(data.get, columns):
+            yield data
 
-def read_deployments_list(names):
-    for name in names:
-        read_deployments(name)
 
+# The primary key of the tbsdeployed table, for de-duplication. The timestamp is reduced to its first 17 digits,
+# YYYYMMDDhhmmssfff, so that '2017-09-30 12:34:56' and '20170930T123456.000Z' are the same key, as they are
+# to the database.
+def deployment_key(data):
+    return data['talkingbookid'], timestamp_key(data['deployedtimestamp'])
 
-# Writes the deployments data that has been collected, to a .csv file appropriate to import to the tbsdeployed table.
-def write_tbsdeployed(output_name):
+
+def timestamp_key(ts):
+    digits = ''.join(TIMESTAMP_DIGITS.findall(ts))
+    return digits[:17].ljust(17, '0')
+
+
+# Drop records with the same primary key as another. With 'first', the first record for a key wins, and the
+# records stream through. With 'last', the last record for a key wins, in the place of the first; that means
+# holding every record until the end.
+def dedup_records(records, rule='first'):
+    global duplicates
+    if rule == 'first':
+        seen = set()
+        for data in records:
+            key = deployment_key(data)
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            yield data
+    else:
+        kept = {}
+        for data in records:
+            key = deployment_key(data)
+            if key in kept:
+                duplicates += 1
+            kept[key] = data
+        yield from kept.values()
+
+
+# Build the pipeline of records from the tbdataoperations extract, if any, the named deploymentsAll.log files,
+# and those found by scanning scan_root, if given. With a batch_size, the extract is read in batches.
+# With a dedup rule, 'first' or 'last', records with duplicate primary keys are dropped.
+def tbsdeployed_records(tbdata_name, deployments_names, batch_size=None, scan_root=None, jobs=None, since=None,
+                        dedup=None):
+    records = normalize_deployments(skip_emitted(read_deployments_list(deployments_names)))
+    if scan_root:
+        records = itertools.chain(records, read_scanned_deployments(scan_root, jobs, since))
+    if tbdata_name and not batch_size:
+        records = itertools.chain(skip_emitted(normalize_tbdataactions(read_tbdataactions(tbdata_name))), records)
+    records = keep_complete(resolve_recipients(skip_non_specific(records)))
+    if tbdata_name and batch_size:
+        records = itertools.chain(read_tbdataactions_batched(tbdata_name, batch_size), records)
+    if dedup:
+        records = dedup_records(records, dedup)
+    return advance_watermarks(records)
+
+
+# Writes the deployments records, to a .csv file appropriate to import to the tbsdeployed table.
+def write_tbsdeployed(records, output_name, output_format='csv', strict=False):
     global needHeader, outFile
+    if output_format == 'parquet':
+        write_tbsdeployed_parquet(records, output_name, strict)
+        return
     if not outFile:
         outFile = open(output_name, 'wt')
 
@@ -247,12 +467,51 @@ def write_tbsdeployed(output_name):
         outFile.write('\n')
         needHeader = False
 
-    for depl in deployments:
-        vals = [depl[k] for k in columns]
-        outFile.write(','.join(vals))
+    values = operator.itemgetter(*columns)
+    for depl in records:
+        outFile.write(','.join(values(depl)))
         outFile.write('\n')
 
 
+# Writes the deployments records to a Parquet file, typed per column_types. With strict, a value that can't be
+# converted to its column's type is an error; otherwise it is written as a null, and reported.
+def write_tbsdeployed_parquet(records, output_name, strict=False):
+    from columnar import ParquetOutput
+    out = ParquetOutput(output_name, columns, column_types, strict=strict)
+    for depl in records:
+        vals = [depl[k] for k in columns]
+        # Coordinates are quoted for .csv files; there's no need here.
+        vals[columns.index('coordinates')] = depl['coordinates'].strip('"')
+        out.add_row(vals)
+    out.close()
+    sys.stdout.write(''.join(line + '\n' for line in out.coercion_summary()))
+
+
+# Writes a psql script to upsert the .csv file into tbsdeployed: copy it into a temporary table, then insert
+# the rows, updating any that are already there. The rows must have unique keys (see --dedup), or the insert
+# would fail on the second row for a key.
+def write_upsert_sql(sql_name, csv_name, header=True):
+    csv_path = os.path.abspath(csv_name).replace("'", "''")
+    updates = ',\n        '.join('{0} = EXCLUDED.{0}'.format(c) for c in columns
+                                   if c not in ('talkingbookid', 'deployedtimestamp'))
+    with open(sql_name, 'wt') as sql_file:
+        sql_file.write("""\\set ON_ERROR_STOP on
+\\timing
+BEGIN;
+
+CREATE TEMPORARY TABLE tbtemp (LIKE tbsdeployed INCLUDING DEFAULTS) ON COMMIT DROP;
+
+\\copy tbtemp ({columns}) from '{csv_path}' with delimiter ',' csv{header};
+
+INSERT INTO tbsdeployed ({columns})
+    SELECT {columns} FROM tbtemp
+    ON CONFLICT (talkingbookid, deployedtimestamp) DO UPDATE SET
+        {updates};
+
+COMMIT;
+""".format(columns=','.join(columns), csv_path=csv_path, header=' header' if header else '', updates=updates))
+
+
 # Given the command line args, determine the output file name
 def make_output_name(args):
     if args.output:
@@ -269,18 +528,67 @@ def main():
     arg_parser.add_argument('--output', default='out.csv', help='Output file name (default is inputname-out.csv)')
     arg_parser.add_argument('--map', required=True, help='Required csv file of project+directory => recipientid.')
     arg_parser.add_argument('--tbdata', help='Parse data extracted from tbdataoperations table.')
+    arg_parser.add_argument('--batch', type=int, metavar='ROWS',
+                            help='Parse the --tbdata extract in batches of this many rows, a column at a time.')
+    arg_parser.add_argument('--scan', metavar='ROOT',
+                            help='Also read every deploymentsAll.log in this collected-data-processed tree.')
+    arg_parser.add_argument('--since', metavar='YYYY-MM-DD', help='With --scan, skip days before this one.')
+    arg_parser.add_argument('--jobs', type=int, help='With --scan, number of processes parsing the logs '
+                                                     '(default is the number of CPUs).')
+    arg_parser.add_argument('--dedup', choices=['first', 'last'],
+                            help='Drop deployments with duplicate (talkingbookid, deployedtimestamp), keeping the '
+                                 'first or the last one. "last" holds every deployment in memory until the end.')
+    arg_parser.add_argument('--upsert-sql', metavar='FILE',
+                            help='Also write a psql script to upsert the output into tbsdeployed. Implies '
+                                 '--dedup first, unless --dedup is given.')
+    arg_parser.add_argument('--watermark', metavar='FILE',
+                            help='JSON file of the latest deployment emitted, per tbcdid. Deployments no newer are '
+                                 'skipped, and the file is updated after the output is written. With --upsert-sql, '
+                                 'the updated marks are written to FILE.new instead, to be moved to FILE once the '
+                                 'upsert succeeds.')
+    arg_parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                            help='Output format. Parquet is typed and compressed, and requires pyarrow. Values '
+                                 'that can\'t be converted to their column\'s type are written as nulls, and '
+                                 'counted per column.')
+    arg_parser.add_argument('--strict', action='store_true', default=False,
+                            help='With --format parquet, stop at a value that can\'t be converted to its column\'s '
+                                 'type, rather than writing a null.')
     args = arg_parser.parse_args()
 
     needHeader = args.header
 
     parse_map_file(args.map)
+    if args.watermark:
+        load_watermarks(args.watermark)
 
     output_name = make_output_name(args)
-    if args.tbdata:
-        read_tbdataactions(args.tbdata)
-    read_deployments_list(args.data)
-    write_tbsdeployed(output_name)
-
+    if args.upsert_sql and args.format != 'csv':
+        arg_parser.error('--upsert-sql requires --format csv.')
+    # An upsert can't have duplicate keys; default to the same rule as the import always had ("on conflict do
+    # nothing"), first wins. That also lets the records stream through.
+    dedup = args.dedup or ('first' if args.upsert_sql else None)
+    records = tbsdeployed_records(args.tbdata, args.data, args.batch, args.scan, args.jobs, args.since, dedup)
+    write_tbsdeployed(records, output_name, args.format, args.strict)
+    if args.upsert_sql:
+        write_upsert_sql(args.upsert_sql, output_name, args.header)
+    if args.watermark:
+        if outFile:
+            outFile.close()
+            outFile = None
+        if args.upsert_sql:
+            # The output isn't in the database yet; if the upsert fails, the next run must read it all again.
+            save_watermarks(args.watermark + '.new')
+            sys.stdout.write('Wrote the new marks to {}.new; move it to {} after the upsert.\n'.format(
+                args.watermark, args.watermark))
+        else:
+            save_watermarks(args.watermark)
+        sys.stdout.write('Skipped {} deployments emitted by earlier runs.\n'.format(already_emitted_count))
+    if duplicates:
+        sys.stdout.write('Dropped {} deployments with duplicate keys ({} wins).\n'.format(duplicates, dedup))
+
+    if recipient_counts:
+        from recipientindex import summarize
+        sys.stdout.write(''.join(line + '\n' for line in summarize(recipient_counts)))
     if len(non_specifics) > 0:
         for p in non_specifics.keys():
             sys.stdout.write('Project {} had {} non-specific TB deployments.\n'.format(p, non_specifics[p]))
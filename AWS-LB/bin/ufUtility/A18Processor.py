@@ -1,26 +1,187 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Union, Any, Tuple, Dict
+from typing import List, Union, Any, Tuple, Dict, Callable
 
 from UfMetadata import UfMetadata
-from a18file import A18File, MD_MESSAGE_UUID_TAG
+from a18file import A18File, MD_MESSAGE_UUID_TAG, RECIPIENTID_TAG
+from audioconverter import AudioConverter, ConversionJob, make_converter, BATCH_SIZE
+from dbutils import DbUtils
+from conversioncache import CachingConverter, ConversionCache, DEFAULT_MAX_BYTES
 from filesprocessor import FilesProcessor
+from instrumentation import Instrumentation, PHASE_AUDIO_EXPORT, PHASE_RECIPIENT_PREFETCH, \
+    PHASE_SIDECAR_UPDATE
 
 
 class A18Processor(FilesProcessor):
-    def __init__(self, files: List[Path]):
+    def __init__(self, files: List[Path], **kwargs):
+        """
+        :param files: Files and directories to be processed.
+        :param kwargs: 'converter', an AudioConverter to use for the audio conversions. Otherwise,
+            'converter_command', 'ffmpeg', 'pipe' and 'verbose' choose one; see make_converter().
+            'cache_dir' and 'cache_max_bytes' to use a ConversionCache.
+        """
         super().__init__(files)
+        verbose = kwargs.get('verbose', 0)
+        converter_args = {'command': kwargs.get('converter_command'), 'ffmpeg': kwargs.get('ffmpeg', False),
+                          'pipe': kwargs.get('pipe', False), 'verbose': verbose}
+        self._converter: AudioConverter = kwargs.get('converter') or make_converter(**converter_args)
+        self._cache: Union[ConversionCache, None] = None
+        if kwargs.get('cache_dir'):
+            self._cache = ConversionCache(kwargs.get('cache_dir'),
+                                          kwargs.get('cache_max_bytes') or DEFAULT_MAX_BYTES, verbose=verbose)
+            self._converter = CachingConverter(self._converter, self._cache, verbose=verbose)
+        # Conversions waiting to be performed, by source directory: [(a18_file, [jobs], on_converted)]
+        self._pending: Dict[Path, List[Tuple[A18File, List[ConversionJob], Callable]]] = {}
+        # Files whose sidecars were read while prefetching their recipients, waiting to be processed.
+        self._prepared: Dict[Path, A18File] = {}
+        self._a18_args: Dict[str, Any] = {'converter': self._converter}
+        self._lock = threading.Lock()
 
     @staticmethod
     def _a18_acceptor(p: Path) -> bool:
         return p.suffix.lower() == '.a18'
 
+    def _queue_conversion(self, a18_file: A18File, targets: List[Path],
+                          on_converted: Callable[[A18File, Union[Path, None]], Any]) -> None:
+        """
+        Queues the conversion of an .a18 file, to be performed with other files from the same directory, when the
+        walk leaves the directory, or when BATCH_SIZE files are queued.
+        :param a18_file: The file to be converted.
+        :param targets: The file(s) to be created, one per format.
+        :param on_converted: Called with the A18File and the converted file (or None) for each target, once
+            converted.
+        """
+        directory = a18_file.path.parent
+        with self._lock:
+            pending = self._pending.setdefault(directory, [])
+            pending.append((a18_file, [ConversionJob(a18_file.path, target) for target in targets], on_converted))
+            full = len(pending) >= BATCH_SIZE
+        if full:
+            self._flush_conversions(directory)
+
+    def _flush_conversions(self, directory: Path = None) -> None:
+        """
+        Performs the queued conversions for the given directory, or for all directories.
+        """
+        with self._lock:
+            directories = [directory] if directory else list(self._pending.keys())
+            batches = [self._pending.pop(d) for d in directories if d in self._pending]
+        for batch in batches:
+            batch_jobs = [job for _, jobs, _ in batch for job in jobs]
+            # One timing per batch; the files of a batch are converted together.
+            with Instrumentation().timer(PHASE_AUDIO_EXPORT):
+                results = self._converter.convert(batch_jobs)
+            n_converted = sum(1 for job in batch_jobs if results.get(job))
+            Instrumentation().count('audio_files_exported', n_converted)
+            Instrumentation().count('audio_export_failures', len(batch_jobs) - n_converted)
+            for a18_file, jobs, on_converted in batch:
+                for job in jobs:
+                    on_converted(a18_file, results.get(job))
+
+    def _a18_file(self, a18_path: Path) -> A18File:
+        """
+        The A18File for a file to be processed; the one read by _prefetch_recipients(), if there is one.
+        """
+        with self._lock:
+            a18_file = self._prepared.pop(a18_path, None)
+        return a18_file or A18File(a18_path, **self._a18_args)
+
+    def _prefetch_recipients(self, directory: Path) -> None:
+        """
+        Reads the RECIPIENTID from the sidecars of the .a18 files in a directory, and looks up all of those
+        recipients with one query, so that processing the files doesn't query for them one at a time. The files
+        are kept, with their sidecars loaded, to be processed. A file whose sidecar can't be read is left to be
+        reported when it is processed, and a failed query leaves the recipients to be looked up one at a time.
+        :param directory: The directory, as the walk enters it.
+        """
+        verbose = self._a18_args.get('verbose', 0)
+        recipientids = set()
+        prepared: Dict[Path, A18File] = {}
+        try:
+            with os.scandir(directory) as it:
+                a18_paths = [Path(entry.path) for entry in it if entry.is_file() and
+                             self._a18_acceptor(Path(entry.path))]
+        except OSError:
+            return
+        for a18_path in a18_paths:
+            a18_file = A18File(a18_path, **self._a18_args)
+            try:
+                if a18_file.has_sidecar:
+                    recipientid = a18_file.property(RECIPIENTID_TAG)
+                    if recipientid:
+                        recipientids.add(recipientid)
+            except Exception as ex:
+                if verbose > 1:
+                    print(f'Couldn\'t read sidecar for \'{str(a18_path)}\': {str(ex)}')
+                continue
+            prepared[a18_path] = a18_file
+        with self._lock:
+            self._prepared.update(prepared)
+        if recipientids:
+            if verbose > 1:
+                print(f'Prefetching {len(recipientids)} recipients for \'{str(directory)}\'.')
+            try:
+                DbUtils().query_recipients_info(recipientids)
+            except Exception as ex:
+                print(f'Couldn\'t prefetch recipients for \'{str(directory)}\': {str(ex)}')
+                return
+            Instrumentation().count('recipients_prefetched', len(recipientids))
+
+    def _process_a18_files(self, processor: Callable[[Path], Any], **kwargs) -> Tuple[int, int, int, int, int]:
+        """
+        Runs the processor on the .a18 files, then performs any conversions still queued. As the walk enters each
+        directory, the recipients of the files in it are looked up together.
+        :param processor: Called for each .a18 file. Returns False if there was an error with the file. Gets the
+            A18File with _a18_file().
+        :param kwargs: 'jobs', to run the processor, and the conversions, on a pool of that many threads. The
+            files processed, and the counts returned, are the same as with one job. Also 'limit', 'verbose',
+            and 'files', for process_files(), and 'verbose' and 'dry_run' for the A18Files.
+        :return: the counts from process_files()
+        """
+        jobs = kwargs.get('jobs', 1) or 1
+        kw: Dict[str, Any] = {k: v for k, v in kwargs.items() if k in ['limit', 'verbose', 'files']}
+        self._a18_args.update(verbose=kwargs.get('verbose', 0), dry_run=kwargs.get('dry_run', False))
+
+        def on_dir(directory: Path) -> None:
+            with Instrumentation().timer(PHASE_RECIPIENT_PREFETCH):
+                self._prefetch_recipients(directory)
+
+        kw['on_dir'] = on_dir
+        # Convert each directory's files as soon as the walk leaves it. Any left, from files given by name, or
+        # from stopping at the limit, are converted at the end.
+        kw['on_dir_done'] = self._flush_conversions
+        self._prepared.clear()
+        if jobs <= 1:
+            ret = self.process_files(A18Processor._a18_acceptor, processor, **kw)
+            self._flush_conversions()
+            self._print_cache()
+            return ret
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            # Don't let the directory walk get too far ahead of the workers.
+            ret = self.process_files(A18Processor._a18_acceptor, processor, executor=executor, max_pending=2 * jobs,
+                                     **kw)
+            with self._lock:
+                directories = list(self._pending.keys())
+            for future in [executor.submit(self._flush_conversions, d) for d in directories]:
+                future.result()
+        self._print_cache()
+        return ret
+
+    def _print_cache(self) -> None:
+        if self._cache:
+            self._cache.print()
+
     def extract_uf_files(self, out_dir:Path, **kwargs) -> Tuple[int, int, int, int, int]:
         def _a18_processor(a18_path: Path) -> Union[None,bool]:
             if verbose > 0:
                 print(f'Processing file \'{str(a18_path)}\'.')
-            a18_file = A18File(a18_path, verbose=verbose, dry_run=dry_run)
-            if a18_file.update_sidecar():
+            a18_file = self._a18_file(a18_path)
+            with Instrumentation().timer(PHASE_SIDECAR_UPDATE):
+                updated = a18_file.update_sidecar()
+            if updated:
                 message_uuid = a18_file.property(MD_MESSAGE_UUID_TAG)
                 programid = a18_file.property('PROJECT')
                 deploymentnumber = a18_file.property('DEPLOYMENT_NUMBER')
@@ -29,45 +190,58 @@ class A18Processor(FilesProcessor):
                     return False
                 fb_dir = Path(out_dir, programid, deploymentnumber)
                 fb_path = Path(fb_dir, message_uuid).with_suffix(audio_format)
-                md_path = fb_path.with_suffix('.properties')
                 if dry_run:
+                    md_path = fb_path.with_suffix('.properties')
                     print(f'Dry run, not exporting \'{str(fb_path)}\'.')
                     print(f'Dry run, not saving metadata \'{str(md_path)}\'.')
                 else:
-                    # Converts the audio directly to the target location.
-                    audio_path: Union[Path, Any] = a18_file.export_audio(audio_format, output=fb_path)
-                    # Save the size of the file, to be used when assembling bundles of uf files.
-                    if audio_path and audio_path.exists():
-                        # Save a copy of the metadata, augmented with the audio file size.
-                        metadata = a18_file.save_sidecar(save_as=md_path, extra_data={
-                            'metadata.BYTES': str(os.path.getsize(audio_path))})
-                        if not no_db:
-                            if verbose > 1:
-                                print(f'Adding metadata properties for {str(a18_path)}.')
-                            propertiesProcessor.add_from_dict(metadata)
+                    # Converts the audio directly to the target location, along with the rest of the directory.
+                    self._queue_conversion(a18_file, [fb_path], _a18_converted)
             else:
                 print(f'Couldn\'t update sidecar for \'{str(a18_path)}\'.')
+
+        def _a18_converted(a18_file: A18File, audio_path: Union[Path, Any]) -> None:
+            # Save the size of the file, to be used when assembling bundles of uf files.
+            if audio_path and audio_path.exists():
+                md_path = audio_path.with_suffix('.properties')
+                # Save a copy of the metadata, augmented with the audio file size.
+                metadata = a18_file.save_sidecar(save_as=md_path, extra_data={
+                    'metadata.BYTES': str(os.path.getsize(audio_path))})
+                if not no_db:
+                    if verbose > 1:
+                        print(f'Adding metadata properties for {str(a18_file.path)}.')
+                    propertiesProcessor.add_from_dict(metadata)
+
         propertiesProcessor = UfMetadata()
         no_db = kwargs.get('no_db', False)
         audio_format = kwargs.get('format')
         verbose = kwargs.get('verbose', 0)
         dry_run = kwargs.get('dry_run', False)
-        kw: Dict[str, str] = {k: v for k, v in kwargs.items() if k in ['limit', 'verbose', 'files']}
 
-        return self.process_files(A18Processor._a18_acceptor, _a18_processor, **kw)
+        return self._process_a18_files(_a18_processor, **kwargs)
 
     def convert_a18_files(self, **kwargs) -> Tuple[int, int, int, int, int]:
         def _a18_processor(a18_path: Path) -> None:
             if verbose > 0:
                 print(f'Processing file \'{str(a18_path)}\'.')
-            a18_file = A18File(a18_path, verbose=verbose, dry_run=dry_run)
+            a18_file = self._a18_file(a18_path)
             # TODO: Why do we need to update the sidecar to export the audio in a new format?
-            if a18_file.update_sidecar():
-                a18_file.export_audio(audio_format)
+            with Instrumentation().timer(PHASE_SIDECAR_UPDATE):
+                updated = a18_file.update_sidecar()
+            if updated:
+                targets = [a18_path.with_suffix(audio_format) for audio_format in audio_formats]
+                if dry_run:
+                    for target in targets:
+                        print(f'Dry run, not exporting audio as \'{str(target)}\'.')
+                else:
+                    # All the formats are converted together, decoding the file only once.
+                    self._queue_conversion(a18_file, targets, lambda f, p: None)
 
-        audio_format = kwargs.get('format')
+        # One format, like '.mp3', or a list of them.
+        audio_formats = kwargs.get('format')
+        if isinstance(audio_formats, str):
+            audio_formats = [audio_formats]
         verbose = kwargs.get('verbose', 0)
         dry_run = kwargs.get('dry_run', False)
-        kw: Dict[str, str] = {k: v for k, v in kwargs.items() if k in ['limit', 'verbose', 'files']}
 
-        return self.process_files(A18Processor._a18_acceptor, _a18_processor, **kw)
+        return self._process_a18_files(_a18_processor, **kwargs)
@@ -1,7 +1,7 @@
 import argparse
 from os.path import expanduser
 from pathlib import Path
-from typing import Union
+from typing import List, Union
 
 
 class StorePathAction(argparse.Action):
@@ -56,4 +56,31 @@ class StoreFileExtension(argparse.Action):
 
     def __call__(self, parser, namespace, values, option_string=None):
         values = [self._fix(v) for v in values] if isinstance(values, list) else self._fix(values)
-        setattr(namespace, self.dest, values)
\ No newline at end of file
+        setattr(namespace, self.dest, values)
+
+class StoreFileExtensions(StoreFileExtension):
+    """
+    An argparse.Action to store a list of file extensions, each with leading dot, given as a comma separated
+    list, like 'mp3,ogg'. If 'allowed' is given, each extension must be one of those (without the dot).
+    """
+
+    def __init__(self, option_strings, dest, nargs=None, default=None, allowed=None, **kwargs):
+        self._allowed = allowed
+        super(StoreFileExtensions, self).__init__(option_strings, dest, nargs=nargs, default=default, **kwargs)
+
+    def _fix(self, v: str) -> Union[None, List[str]]:
+        """
+        Split the list, and make sure there's a leading dot on each.
+        """
+        if v is None or not isinstance(v, str):
+            return None
+        return [super(StoreFileExtensions, self)._fix(x.strip()) for x in v.split(',') if x.strip()]
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        values = self._fix(values)
+        if self._allowed:
+            for v in values:
+                if v[1:] not in self._allowed:
+                    raise argparse.ArgumentError(self, f'invalid choice: \'{v[1:]}\' (choose from '
+                                                       f'{", ".join(self._allowed)})')
+        setattr(namespace, self.dest, values)
@@ -1,11 +1,13 @@
+import threading
 from _testcapi import INT_MAX
 from datetime import datetime
 from pathlib import Path
-from typing import Callable, Dict, List, Tuple
+from typing import Callable, Dict, List, Tuple, Union
 
 from UfRecord import uf_column_map, uf_column_tweaks_map
 from dbutils import DbUtils
 from filesprocessor import FilesProcessor
+from sidecarstore import SidecarStore, STORE_NAME
 
 MD_MESSAGE_UUID_TAG = 'metadata.MESSAGE_UUID'
 
@@ -20,6 +22,8 @@ class UfMetadata():
             print('Creating the UfPropertiesProcessor object')
             cls._instance = super(UfMetadata, cls).__new__(cls)
             cls._props: List[Tuple] = []
+            # Metadata may be added from several worker threads (ufUtility.py --jobs).
+            cls._lock = threading.Lock()
         return cls._instance
 
     def print(self):
@@ -59,7 +63,8 @@ class UfMetadata():
                 if column_name in uf_column_tweaks_map:
                     val = uf_column_tweaks_map[column_name](val)
                 columns[column_name] = val
-            self._props.append(tuple([columns[k] for k in uf_column_map.keys()]))
+            with self._lock:
+                self._props.append(tuple([columns[k] for k in uf_column_map.keys()]))
 
     def _process_file(self, path: Path) -> None:
         """
@@ -78,20 +83,40 @@ class UfMetadata():
     def add_from_files(self, files: List[Path] = None, **kwargs) -> Tuple[int, int, int, int, int]:
         """
         Given a Path to an a18 file, or a directory containing a18 files, process the file(s).
+        Sidecar stores (see sidecarstore.py) are read as well as .properties files; where a store has a
+        sidecar, it replaces the .properties file of the same name.
         :param files: An optional list of files to process.
         :return: a tuple of the counts of directories and files processed, and the files skipped.
         """
+        stores: Dict[Path, Union[SidecarStore, None]] = {}
+
+        def store_for(directory: Path) -> Union[SidecarStore, None]:
+            if directory not in stores:
+                stores[directory] = SidecarStore(directory) if Path(directory, STORE_NAME).exists() else None
+            return stores[directory]
 
         def file_acceptor(p: Path) -> bool:
-            return p.suffix.lower() == '.properties'
+            if p.name == STORE_NAME:
+                return True
+            store = store_for(p.parent)
+            return p.suffix.lower() == '.properties' and not (store and p.name in store)
 
         def file_processor(p: Path) -> None:
-            self._process_file(p)
+            if p.name == STORE_NAME:
+                store = store_for(p.parent)
+                for name in store.names():
+                    self._add_props(store.read(name)[1])
+            else:
+                self._process_file(p)
 
         processor: FilesProcessor = FilesProcessor(files)
 
-        return processor.process_files(file_acceptor, file_processor, limit=kwargs.get('limit', INT_MAX),
-                                       verbose=kwargs.get('verbose', 0), files=files)
+        ret = processor.process_files(file_acceptor, file_processor, limit=kwargs.get('limit', INT_MAX),
+                                      verbose=kwargs.get('verbose', 0), files=files)
+        for store in stores.values():
+            if store:
+                store.close()
+        return ret
 
     def add_from_dict(self, props: Dict[str, str]) -> None:
         self._add_props(props)
\ No newline at end of file
@@ -1,12 +1,14 @@
-import platform
+import os
 import struct
-import subprocess
-import tempfile
 import uuid as uuid
 from pathlib import Path
-from typing import Dict, Union, List, Any
+from typing import Dict, Union, List, Any, Iterable, Iterator, Tuple
 
 import dbutils
+from audioconverter import AudioConverter, ConversionJob, make_converter
+from instrumentation import Instrumentation, PHASE_METADATA, PHASE_DB_LOOKUP, PHASE_SIDECAR_SAVE
+from mdindex import MetadataIndex
+from sidecarstore import SidecarStore, write_properties
 
 PUBLISHER_TAG = 'PUBLISHER'
 COMMUNITY_TAG = 'COMMUNITY'
@@ -25,28 +27,29 @@ class BinaryReader:
     Helper class for reading binary data, providing those functions (and only those)
     required to read TB metadata from an .a18 file.
     """
+    # Compiled once; adjust these if we ever need to support big-endian
+    _I32 = struct.Struct('<l')
+    _I16 = struct.Struct('<h')
+    _I8 = struct.Struct('<b')
 
-    def __init__(self, buffer: bytes):
+    def __init__(self, buffer: Union[bytes, memoryview], offset: int = 0):
         """
-        Initialize with a bytes object; keep track of where we are in that object.
+        Initialize with a bytes object, or a memoryview; keep track of where we are in that object.
         :param buffer: bytes of metadata.
+        :param offset: where in the buffer the metadata starts.
         """
         self._buffer = buffer
-        self._offset = 0
-        # adjust these if we ever need to support big-endian
-        self._I32 = '<l'
-        self._I16 = '<h'
-        self._I8 = '<b'
+        self._offset = offset
 
     # noinspection PyShadowingBuiltins
-    def _read_x(self, format: str) -> any:
+    def _read_x(self, format: struct.Struct) -> any:
         """
-        Read value(s) per the format string, and advance the offset (consume the data read).
+        Read value(s) per the compiled format, and advance the offset (consume the data read).
         :param format: specification of one or more values to read.
-        :return: the raw result from struct.unpack_from(), a tuple of values
+        :return: the raw result from Struct.unpack_from(), a tuple of values
         """
-        values = struct.unpack_from(format, self._buffer, self._offset)
-        self._offset += struct.calcsize(format)
+        values = format.unpack_from(self._buffer, self._offset)
+        self._offset += format.size
         return values
 
     def read_i32(self) -> int:
@@ -77,14 +80,18 @@ class BinaryReader:
         :return: the string.
         """
         str_len = self.read_i16()
-        str_format: str = f'<{str_len}s'
-        str_bytes: bytes = self._read_x(str_format)[0]
+        end = self._offset + str_len
+        if str_len < 0 or end > len(self._buffer):
+            raise struct.error(f'string of length {str_len} does not fit in the metadata')
+        # A slice of a memoryview is not a copy; str() decodes straight from it.
+        str_bytes = self._buffer[self._offset:end]
+        self._offset = end
         # noinspection PyUnusedLocal
         try:
-            return str_bytes.decode('utf-8')
+            return str(str_bytes, 'utf-8')
         except Exception:
             # extract as much of an ASCII string as we can. Possibly corrupted on Talking Book.
-            chars = [chr(b) for b in str_bytes if 32 <= b <= 0x7f]
+            chars = [chr(b) for b in bytes(str_bytes) if 32 <= b <= 0x7f]
             return ''.join(chars)
 
 
@@ -93,33 +100,11 @@ class MetadataReader:
     Class to parse .a18 metadata.
     """
 
+    # The header of an .a18 file: 32-bit length-of-audio-data, 16-bit bits-per-second.
+    _HEADER = struct.Struct('<lh')
+
     def __init__(self, buffer: BinaryReader):
         self._buffer = buffer
-        # The known metadata types. From LBMetadataIDs.java.
-        self._md_parsers = {
-            0: (self._string_md_parser, 'CATEGORY'),
-            1: (self._string_md_parser, 'TITLE'),
-            5: (self._string_md_parser, 'PUBLISHER'),
-            10: (self._string_md_parser, 'IDENTIFIER'),
-            11: (self._string_md_parser, 'SOURCE'),
-            12: (self._string_md_parser, 'LANGUAGE'),
-            13: (self._string_md_parser, 'RELATION'),
-            16: (self._string_md_parser, 'REVISION'),
-            22: (self._string_md_parser, 'DURATION'),
-            23: (self._string_md_parser, 'MESSAGE_FORMAT'),
-            24: (self._string_md_parser, 'TARGET_AUDIENCE'),
-            25: (self._string_md_parser, 'DATE_RECORDED'),
-            26: (self._string_md_parser, 'KEYWORDS'),
-            27: (self._string_md_parser, 'TIMING'),
-            28: (self._string_md_parser, 'PRIMARY_SPEAKER'),
-            29: (self._string_md_parser, 'GOAL'),
-            30: (self._string_md_parser, 'ENGLISH_TRANSCRIPTION'),
-            31: (self._string_md_parser, 'NOTES'),
-            32: (self._string_md_parser, 'BENEFICIARY'),
-            33: (self._integer_md_parser, 'STATUS'),
-            35: (self._string_md_parser, 'SDG_GOALS'),
-            36: (self._string_md_parser, 'SDG_TARGETS'),
-        }
 
     def _string_md_parser(self, joiner: str = ';'):
         """
@@ -164,58 +149,145 @@ class MetadataReader:
             # noinspection PyUnusedLocal
             field_len = self._buffer.read_i32()
 
-            if field_id in self._md_parsers:
-                fn, name = self._md_parsers.get(field_id)
-                result = fn()
+            if field_id in self._MD_PARSERS:
+                fn, name = self._MD_PARSERS[field_id]
+                result = fn(self)
                 metadata[name] = result
             else:
                 print(f'undecoded field {field_id}')
         return metadata
 
+    # The known metadata types. From LBMetadataIDs.java. Built once, rather than per file.
+    _MD_PARSERS = {
+        0: (_string_md_parser, 'CATEGORY'),
+        1: (_string_md_parser, 'TITLE'),
+        5: (_string_md_parser, 'PUBLISHER'),
+        10: (_string_md_parser, 'IDENTIFIER'),
+        11: (_string_md_parser, 'SOURCE'),
+        12: (_string_md_parser, 'LANGUAGE'),
+        13: (_string_md_parser, 'RELATION'),
+        16: (_string_md_parser, 'REVISION'),
+        22: (_string_md_parser, 'DURATION'),
+        23: (_string_md_parser, 'MESSAGE_FORMAT'),
+        24: (_string_md_parser, 'TARGET_AUDIENCE'),
+        25: (_string_md_parser, 'DATE_RECORDED'),
+        26: (_string_md_parser, 'KEYWORDS'),
+        27: (_string_md_parser, 'TIMING'),
+        28: (_string_md_parser, 'PRIMARY_SPEAKER'),
+        29: (_string_md_parser, 'GOAL'),
+        30: (_string_md_parser, 'ENGLISH_TRANSCRIPTION'),
+        31: (_string_md_parser, 'NOTES'),
+        32: (_string_md_parser, 'BENEFICIARY'),
+        33: (_integer_md_parser, 'STATUS'),
+        35: (_string_md_parser, 'SDG_GOALS'),
+        36: (_string_md_parser, 'SDG_TARGETS'),
+    }
+
+    # The same table, as (is-string, name), for _parse_fields. (A comprehension in a class body can't see the
+    # other names in the class, so the parsers are told apart by name.)
+    _FIELDS = {field_id: (fn.__name__ == '_string_md_parser', name) for field_id, (fn, name) in _MD_PARSERS.items()}
+    _FIELD_HEADER = struct.Struct('<hl')
+    _MD_HEADER = struct.Struct('<ll')
+
     @staticmethod
-    def read_from_file(a18_path: Path) -> Dict[str, str]:
+    def _parse_fields(buffer: memoryview, offset: int) -> Union[Dict[str, str], None]:
         """
-        Extract the metadata from an .a18 file. The file consists of a 32-bit length-of-audio-data, length bytes of
-        audio data, bytes-til-eof of metadata
+        The same as parse(), but straight-line code, with no per-value method calls. Used for the common case
+        of well-formed metadata.
+        :param buffer: The metadata, or the whole file.
+        :param offset: Where in the buffer the metadata starts.
+        :return: The metadata, or None if there is anything unusual, for parse() to deal with.
+        """
+        i32 = BinaryReader._I32.unpack_from
+        i16 = BinaryReader._I16.unpack_from
+        i8 = BinaryReader._I8.unpack_from
+        field_header = MetadataReader._FIELD_HEADER.unpack_from
+        fields = MetadataReader._FIELDS
+        buffer_len = len(buffer)
+        version, num_fields = MetadataReader._MD_HEADER.unpack_from(buffer, offset)
+        if version != 1:
+            return None
+        offset += 8
+        metadata: Dict[str, str] = {}
+        for i in range(num_fields):
+            field_id, field_len = field_header(buffer, offset)
+            if field_id not in fields:
+                return None
+            is_string, name = fields[field_id]
+            num_values = i8(buffer, offset + 6)[0]
+            offset += 7
+            values = []
+            for v in range(num_values):
+                if is_string:
+                    end = offset + 2 + i16(buffer, offset)[0]
+                    if end < offset + 2 or end > buffer_len:
+                        return None
+                    try:
+                        values.append(str(buffer[offset + 2:end], 'utf-8'))
+                    except UnicodeDecodeError:
+                        return None
+                    offset = end
+                else:
+                    values.append(str(i32(buffer, offset)[0]))
+                    offset += 4
+            metadata[name] = ';'.join(values)
+        return metadata
+
+    @staticmethod
+    def _read_one(a18_path: Path) -> Dict[str, str]:
+        """
+        Extract the metadata from an .a18 file. The file consists of a 32-bit length-of-audio-data,
+        length bytes of audio data (starting with a 16-bit bits-per-second), bytes-til-eof of metadata.
+        Only the header and the metadata are read, each with a single pread(), and the metadata is parsed
+        in place.
         :param a18_path: path to the .a18 file.
         :return: a Dict[str,str] of the metadata
         """
-
-        def _t(a, b, c):
-            """
-            return a ? b : c
-            :param a: The condition.
-            :param b: Value if True.
-            :param c: Value if False.
-            :return: the value.
-            """
-            return b if a else c
-
-        file_len = a18_path.stat().st_size
-        with open(a18_path, 'rb') as f:
-            # First 4 bytes is unsigned long 'size of audio'. Skip the audio, load the binary metadata.
-            buffer = f.read(4)
-            audio_len = struct.unpack('<l', buffer)[0]
-            buffer = f.read(2)
-            audio_bps = struct.unpack('<h', buffer)[0]
-
+        fd = os.open(a18_path, os.O_RDONLY)
+        try:
+            file_len = os.fstat(fd).st_size
+            audio_len, audio_bps = MetadataReader._HEADER.unpack(os.pread(fd, MetadataReader._HEADER.size, 0))
             md_offset = audio_len + 4
-            md_len = file_len - md_offset
-            f.seek(md_offset)
-            md_bytes = f.read(md_len)
-        bytes_reader = BinaryReader(md_bytes)
-        md_parser = MetadataReader(bytes_reader)
-        md: Dict[str, str] = md_parser.parse()
+            md_bytes = memoryview(os.pread(fd, max(0, file_len - md_offset), md_offset))
+        finally:
+            os.close(fd)
+        md = MetadataReader._parse_fields(md_bytes, 0)
+        if md is None:
+            md = MetadataReader(BinaryReader(md_bytes)).parse()
         total_seconds = int(audio_len * 8 / audio_bps + 0.5)
         if 'DURATION' not in md:
             minutes, seconds = divmod(total_seconds, 60)
-            duration = f'{minutes:02}:{seconds:02} {_t(audio_bps == 16000, "l", "h")}'
+            duration = f'{minutes:02}:{seconds:02} {"l" if audio_bps == 16000 else "h"}'
             md['DURATION'] = duration
         if 'SECONDS' not in md:
             md['SECONDS'] = str(total_seconds)
 
         return md
 
+    @staticmethod
+    def read_from_file(a18_path: Path) -> Dict[str, str]:
+        """
+        Extract the metadata from an .a18 file.
+        :param a18_path: path to the .a18 file.
+        :return: a Dict[str,str] of the metadata
+        """
+        return MetadataReader._read_one(a18_path)
+
+    @staticmethod
+    def read_from_files(a18_paths: Iterable[Path]) -> Iterator[Tuple[Path, Union[Dict[str, str], None]]]:
+        """
+        Extract the metadata from many .a18 files.
+        :param a18_paths: paths of the .a18 files.
+        :return: yields (path, metadata) for each file, in order. The metadata is None if the file could not
+                 be read or parsed.
+        """
+        for a18_path in a18_paths:
+            try:
+                md = MetadataReader._read_one(a18_path)
+            except (OSError, ValueError, ZeroDivisionError, struct.error):
+                md = None
+            yield a18_path, md
+
 
 class A18File:
     """
@@ -230,6 +302,7 @@ class A18File:
         self._verbose = kwargs.get('verbose', 0)
         self._dry_run = kwargs.get('dry_run', False)
         self._local_ffmpeg = kwargs.get('ffmpeg', False)
+        self._converter: Union[AudioConverter, None] = kwargs.get('converter')
         self._db_utils = dbutils.DbUtils()
         self._file_path: Path = file_path
         self._metadata: Union[Dict[str, str], None] = None
@@ -242,10 +315,17 @@ class A18File:
     def path(self) -> Path:
         return self._file_path
 
+    @property
+    def converter(self) -> AudioConverter:
+        if self._converter is None:
+            self._converter = make_converter(ffmpeg=self._local_ffmpeg, verbose=self._verbose)
+        return self._converter
+
     @property
     def metadata(self) -> Dict[str, str]:
         if self._metadata is None:
-            self._metadata = MetadataReader.read_from_file(self._file_path)
+            with Instrumentation().timer(PHASE_METADATA):
+                self._metadata = MetadataIndex().metadata(self._file_path, MetadataReader.read_from_file)
         return self._metadata
 
     @property
@@ -254,7 +334,8 @@ class A18File:
 
     @property
     def has_sidecar(self) -> bool:
-        return self.sidecar_path.exists()
+        store = SidecarStore.for_path(self.sidecar_path)
+        return (store is not None and self.sidecar_path.name in store) or self.sidecar_path.exists()
 
     def property(self, name: str, default: str = None) -> Any:
         if not self._sidecar_loaded:
@@ -285,13 +366,15 @@ class A18File:
 
                 # Ensure deployment number is in the sidecar. This is performed at most one time.
                 if not self.property(DEPLOYMENT_NUMBER_TAG):
-                    deployment_number = self._db_utils.query_deployment_number(self.property(PROJECT_TAG),
-                                                                               self.property(DEPLOYMENT_TAG))
+                    with Instrumentation().timer(PHASE_DB_LOOKUP):
+                        deployment_number = self._db_utils.query_deployment_number(self.property(PROJECT_TAG),
+                                                                                   self.property(DEPLOYMENT_TAG))
                     self.add_to_sidecar({DEPLOYMENT_NUMBER_TAG: deployment_number})
 
                 # Ensure the recipient info is in the sidecar, tagged with 'recipient.' This operation is not idempotent
                 # because the recipient values on the server could have changed.
-                recipient_info = self._db_utils.query_recipient_info(self.property(RECIPIENTID_TAG))
+                with Instrumentation().timer(PHASE_DB_LOOKUP):
+                    recipient_info = self._db_utils.query_recipient_info(self.property(RECIPIENTID_TAG))
                 self.add_to_sidecar(recipient_info, 'recipient')
 
                 if save:
@@ -333,15 +416,24 @@ class A18File:
     def _load_sidecar(self) -> None:
         header: List[str] = []
         props: Dict[str, str] = {}
-        with open(self.sidecar_path, "r") as sidecar_file:
-            for line in sidecar_file:
-                line = line.strip()
-                if line[0] == '#':
-                    header.append(line)
-                else:
-                    parts = line.split('=', maxsplit=1)
-                    if len(parts) == 2:
-                        props[parts[0].strip()] = parts[1].strip()
+        # From the directory's sidecar store, if there is one, and it has this sidecar. Otherwise, and for the
+        # .properties files that come from the Talking Books, from the .properties file.
+        store = SidecarStore.for_path(self.sidecar_path)
+        stored = store.read(self.sidecar_path.name) if store else None
+        if stored:
+            header, props = stored
+        else:
+            with open(self.sidecar_path, "r") as sidecar_file:
+                for line in sidecar_file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if line[0] == '#':
+                        header.append(line)
+                    else:
+                        parts = line.split('=', maxsplit=1)
+                        if len(parts) == 2:
+                            props[parts[0].strip()] = parts[1].strip()
         self._sidecar_needs_save = False
         self._sidecar_loaded = True
         self._sidecar_header = header
@@ -367,13 +459,14 @@ class A18File:
             if self._dry_run:
                 print(f'Dry run, not saving sidecar \'{str(save_path)}\'.')
             else:
-                temp_path = save_path.with_suffix('.new')
-                with open(temp_path, "w") as properties_file:
-                    for h in self._sidecar_header:
-                        print(h, file=properties_file, end='\x0d\x0a')  # microsoft's original sin
-                    for k in sorted(to_write.keys()):
-                        print(f'{k}={to_write[k]}', file=properties_file, end='\x0d\x0a')
-                temp_path.replace(save_path)
+                with Instrumentation().timer(PHASE_SIDECAR_SAVE):
+                    # Only the file's own sidecar goes in the store. A copy saved elsewhere, as with an exported
+                    # file, is always a .properties file, for whatever consumes the export.
+                    store = SidecarStore.for_writing(save_path) if save_as is None else None
+                    if store:
+                        store.write(save_path.name, self._sidecar_header, to_write)
+                    else:
+                        write_properties(save_path, self._sidecar_header, to_write)
             # If we saved to the default location, the metadata is no longer "dirty".
             if save_as is not None:
                 self._sidecar_needs_save = False
@@ -403,19 +496,10 @@ class A18File:
 
         if audio_format[0] != '.':
             audio_format = '.' + audio_format
-        # if audio_format is ".mp3"
-        # If _file_path is "/user/phil/uf/file1.a18"...
-        audio_path = self._file_path.parent  # /user/phil/uf
-        source_name: str = self._file_path.name  # file1.a18
         target_path = output
         target_path = output if target_path is not None else self._file_path
         target_dir = target_path.parent
         target_path = target_path.with_suffix(audio_format)
-        target_name: str = target_path.name
-
-        tdp = Path(target_dir, '.')
-        print(f'Target dir: {target_dir}, exists:{target_dir.exists()}, is_dir:{target_dir.is_dir()}')
-        print(f'tdp dir: {tdp}, exists:{tdp.exists()}, is_dir:{tdp.is_dir()}')
 
         if not target_dir.exists() and not mk_dirs:
             print(f'Target directory does not exist: \'{str(target_dir)}\'.')
@@ -427,51 +511,10 @@ class A18File:
             print(f'Dry run, not exporting audio as \'{str(target_path)}\'.')
             return target_path
 
-        if not target_dir.exists():
-            target_dir.mkdir(parents=True, exist_ok=True)
-
-        if self._local_ffmpeg:
-            if self._verbose > 0:
-                print(f'Exporting audio as \'{str(target_path)}\'.')
-            # Run locally installed ffmpeg
-            container = 'amplionetwork/abc:1.0'
-            tmp_dir: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory()
-            abc_command = ['docker', 'run', '--rm', '--platform', 'linux/386',
-                           '--mount', f'type=bind,source={audio_path}/.,target=/audio',
-                           '--mount', f'type=bind,source={tmp_dir.name},target=/out',
-                           container, '-o', '/out', source_name]
-            abc_result = subprocess.run(abc_command, capture_output=True)
-            if abc_result.returncode != 0:
-                return None
-
-            tempfile_pathname: str = f'{tmp_dir.name}/{source_name}.wav'  # ...tmp/foo.a18.wav
-            target_pathname: str = str(self._file_path.with_suffix(audio_format))
-            ff_command = ['ffmpeg', '-hide_banner', '-y', '-i', tempfile_pathname, target_pathname]
-            if self._verbose > 1:
-                print(' '.join(ff_command))
-            ff_result = subprocess.run(ff_command, capture_output=True)
-            return target_path if ff_result.returncode == 0 else None
-
-        else:
-            if self._verbose > 0:
-                print(f'Exporting audio as \'{str(target_path)}\'.')
-            # Run container provided ffmpeg
-            platform_args = ['--platform', 'linux/386'] if platform.system().lower() == 'darwin' else []
-            container = 'amplionetwork/ac:1.0'
-            ac_command = ['docker', 'run', '--rm'] + platform_args + \
-                         ['--mount', f'type=bind,source={audio_path}/.,target=/audio', \
-                          '--mount', f'type=bind,source={target_dir}/.,target=/out',
-                          container, source_name, '/out/' + target_name]
-            if self._verbose > 1:
-                print(' '.join(ac_command))
-            ac_result = subprocess.run(ac_command, capture_output=True)
-            if ac_result.returncode != 0:
-                if 'cannot connect to the docker daemon' in ac_result.stderr.decode('utf-8').lower():
-                    print('It appears that Docker is not running.')
-                    raise (Exception('It appears that Docker is not running.'))
-            if self._verbose > 1:
-                print(ac_result)
-            return target_path if ac_result.returncode == 0 else None
+        if self._verbose > 0:
+            print(f'Exporting audio as \'{str(target_path)}\'.')
+        job = ConversionJob(self._file_path, target_path)
+        return self.converter.convert([job]).get(job)
 
     def _compute_message_uuid(self):
         """
@@ -0,0 +1,316 @@
+"""
+audioconverter.py
+
+Converts .a18 files to other audio formats, a batch of files at a time.
+
+Starting a container is much more expensive than converting a typical user feedback file, so rather than
+starting a container for every file, a converter is given a list of conversions, and starts one container (or
+other converter process) per batch of files from the same directory. The results are returned per conversion,
+so that the caller can map them back to its A18File objects. A file may be converted to several formats at
+once, by giving a conversion for each format; where the converter allows, the file is only decoded once.
+
+The converters:
+- ContainerConverter, the default, uses the amplionetwork/ac container, which needs nothing installed locally
+  but Docker.
+- CommandConverter runs a command once per batch to decode the .a18 files to .wav, and then a locally
+  installed ffmpeg to produce the desired format. By default the command is the amplionetwork/abc container;
+  any other command, like a local stand-in for testing, can be used in its place.
+"""
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Union
+
+# Files per container launch. Bounds the length of the command line.
+BATCH_SIZE = 200
+# Files per container launch when piping to ffmpeg. Bounds the number of ffmpeg processes.
+PIPE_BATCH_SIZE = 50
+
+ABC_COMMAND = ['docker', 'run', '--rm', '--platform', 'linux/386',
+               '--mount', 'type=bind,source={in}/.,target=/audio',
+               '--mount', 'type=bind,source={out},target=/out',
+               'amplionetwork/abc:1.0', '-o', '/out', '{files}']
+# '{files}' is the target file(s); ffmpeg writes every target in one pass.
+FFMPEG_COMMAND = ['ffmpeg', '-hide_banner', '-y', '-i', '{in}', '{files}']
+
+
+class ConversionJob(NamedTuple):
+    source: Path  # The .a18 file.
+    target: Path  # The file to be created. The suffix determines the format.
+
+
+def _expand(template: List[str], **kwargs) -> List[str]:
+    """
+    Fills in a command template. '{in}' and '{out}' are replaced in any argument; an argument '{files}' is
+    replaced by the list of file names.
+    """
+    command = []
+    for arg in template:
+        if arg == '{files}':
+            command.extend(kwargs.get('files', []))
+        else:
+            command.append(arg.replace('{in}', kwargs.get('in', '')).replace('{out}', kwargs.get('out', '')))
+    return command
+
+
+def _check_docker(result: subprocess.CompletedProcess) -> None:
+    if result.returncode != 0 and 'cannot connect to the docker daemon' in result.stderr.decode('utf-8').lower():
+        print('It appears that Docker is not running.')
+        raise (Exception('It appears that Docker is not running.'))
+
+
+class AudioConverter:
+    """
+    Base class of the converters. Subclasses implement _convert_batch().
+    """
+
+    def __init__(self, **kwargs):
+        self._verbose = kwargs.get('verbose', 0)
+        self._batch_size = kwargs.get('batch_size', BATCH_SIZE)
+
+    def convert(self, jobs: List[ConversionJob]) -> Dict[ConversionJob, Union[Path, None]]:
+        """
+        Performs the conversions, in batches of files from the same directory. All the conversions of a file are
+        in the same batch.
+        :param jobs: The conversions to perform.
+        :return: {job: target} for each job, with a target of None if the conversion failed.
+        """
+        # {directory: {source: [jobs]}}
+        by_directory: Dict[Path, Dict[Path, List[ConversionJob]]] = {}
+        for job in jobs:
+            by_directory.setdefault(job.source.parent, {}).setdefault(job.source, []).append(job)
+        results: Dict[ConversionJob, Union[Path, None]] = {}
+        for source_dir, by_source in by_directory.items():
+            sources = list(by_source.keys())
+            for start in range(0, len(sources), self._batch_size):
+                batch = [job for source in sources[start:start + self._batch_size] for job in by_source[source]]
+                for job in batch:
+                    job.target.parent.mkdir(parents=True, exist_ok=True)
+                if self._verbose > 0:
+                    print(f'Converting {len(sources[start:start + self._batch_size])} files from '
+                          f'\'{str(source_dir)}\'.')
+                results.update(self._convert_batch(source_dir, batch))
+        return results
+
+    def _convert_batch(self, source_dir: Path, jobs: List[ConversionJob]) -> Dict[ConversionJob, Union[Path, None]]:
+        raise NotImplementedError
+
+    @property
+    def identity(self) -> str:
+        """
+        Identifies what produces the converted audio, such as the decoder and encoder commands, so that output
+        cached from one converter isn't used in place of another's. Anything that doesn't change the output,
+        like batching or piping, is left out.
+        """
+        raise NotImplementedError
+
+    def _run(self, command: List[str]) -> subprocess.CompletedProcess:
+        if self._verbose > 1:
+            print(' '.join(command))
+        return subprocess.run(command, capture_output=True)
+
+
+class CommandConverter(AudioConverter):
+    """
+    Runs a command once per batch, which must write, for each file 'name.a18', either 'name.a18.wav' or
+    'name.a18' with the target's suffix, into the '{out}' directory. .wav files are then converted to the
+    desired format with ffmpeg.
+
+    With 'pipe', 'name.a18.wav' is a FIFO, with ffmpeg already reading from it, so the .wav is streamed from the
+    decoder to the encoder and never written to disk. Since there is an ffmpeg waiting for every file of a batch,
+    batches are limited to PIPE_BATCH_SIZE files. This only works with a decoder that writes its output
+    sequentially, in a single pass, and, since FIFOs in a bind-mounted directory don't work through Docker
+    Desktop's VM, only on Linux; so it must be asked for.
+    """
+
+    def __init__(self, command: Union[List[str], str] = None, **kwargs):
+        super().__init__(**kwargs)
+        if isinstance(command, str):
+            command = shlex.split(command)
+        self._command = command or ABC_COMMAND
+        self._pipe = kwargs.get('pipe', False)
+        if self._pipe:
+            self._batch_size = min(self._batch_size, PIPE_BATCH_SIZE)
+
+    @property
+    def identity(self) -> str:
+        return json.dumps([type(self).__name__, self._command, FFMPEG_COMMAND])
+
+    @staticmethod
+    def _by_source(jobs: List[ConversionJob]) -> Dict[Path, List[ConversionJob]]:
+        by_source: Dict[Path, List[ConversionJob]] = {}
+        for job in jobs:
+            by_source.setdefault(job.source, []).append(job)
+        return by_source
+
+    def _start_encoders(self, out_dir: str, jobs: List[ConversionJob]) -> Dict[Path, subprocess.Popen]:
+        """
+        Starts an ffmpeg for every file that needs encoding, reading from a FIFO in place of the .wav file, and
+        writing all of the file's targets.
+        """
+        encoders: Dict[Path, subprocess.Popen] = {}
+        for source, source_jobs in self._by_source(jobs).items():
+            if any(job.target.suffix != '.wav' for job in source_jobs):
+                fifo = Path(out_dir, source.name + '.wav')
+                os.mkfifo(fifo)
+                command = _expand(FFMPEG_COMMAND, files=[str(job.target) for job in source_jobs],
+                                  **{'in': str(fifo)})
+                if self._verbose > 1:
+                    print(' '.join(command))
+                encoders[source] = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return encoders
+
+    @staticmethod
+    def _finish_encoders(out_dir: str, encoders: Dict[Path, subprocess.Popen]) -> Dict[Path, int]:
+        """
+        Waits for the encoders. Any encoder whose file the decoder didn't write is still waiting for a writer
+        to open its FIFO; it is given one that writes nothing, so that it fails, rather than waiting forever.
+        :return: {source: encoder's return code}
+        """
+        for source in encoders.keys():
+            try:
+                fd = os.open(Path(out_dir, source.name + '.wav'), os.O_WRONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+        return {source: encoder.wait() for source, encoder in encoders.items()}
+
+    def _convert_batch(self, source_dir: Path, jobs: List[ConversionJob]) -> Dict[ConversionJob, Union[Path, None]]:
+        results: Dict[ConversionJob, Union[Path, None]] = {job: None for job in jobs}
+        by_source = self._by_source(jobs)
+        with tempfile.TemporaryDirectory() as out_dir:
+            encoders = self._start_encoders(out_dir, jobs) if self._pipe else {}
+            command = _expand(self._command, files=[source.name for source in by_source.keys()], out=out_dir,
+                              **{'in': str(source_dir)})
+            try:
+                result = self._run(command)
+            finally:
+                encoded = self._finish_encoders(out_dir, encoders)
+            _check_docker(result)
+            if result.returncode != 0:
+                print(f'Converter failed for \'{str(source_dir)}\': {result.stderr.decode("utf-8").strip()}')
+            # Even if the command reported failure, keep whatever it did produce.
+            for source, source_jobs in by_source.items():
+                decoded = Path(out_dir, source.name + '.wav')
+                # Targets the command produced itself (including .wav) need only be moved into place. (In pipe
+                # mode, the .wav is the FIFO, not a file.)
+                produced = [job for job in source_jobs if Path(out_dir, source.name + job.target.suffix).is_file()]
+                to_encode = [job for job in source_jobs if job not in produced]
+                if to_encode and source in encoded:
+                    encoded_ok = encoded[source] == 0
+                elif to_encode and decoded.is_file():
+                    ff_command = _expand(FFMPEG_COMMAND, files=[str(job.target) for job in to_encode],
+                                         **{'in': str(decoded)})
+                    encoded_ok = self._run(ff_command).returncode == 0
+                else:
+                    encoded_ok = False
+                for job in to_encode:
+                    if encoded_ok:
+                        results[job] = job.target
+                for job in produced:
+                    shutil.move(str(Path(out_dir, source.name + job.target.suffix)), str(job.target))
+                    results[job] = job.target
+        return results
+
+
+class ContainerConverter(AudioConverter):
+    """
+    Converts with the amplionetwork/ac container, which converts one file per invocation. Rather than a
+    'docker run' per file, starts one container per batch, and runs the image's entrypoint in it with
+    'docker exec' for each file. Falls back to 'docker run' per file if a container can't be started that way.
+    """
+    IMAGE = 'amplionetwork/ac:1.0'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._platform_args = ['--platform', 'linux/386'] if platform.system().lower() == 'darwin' else []
+        self._entrypoint: Union[List[str], None] = None
+
+    @property
+    def identity(self) -> str:
+        return json.dumps([type(self).__name__, self.IMAGE])
+
+    def _inspect_entrypoint(self) -> Union[List[str], None]:
+        result = self._run(['docker', 'image', 'inspect', '--format', '{{json .Config.Entrypoint}}', self.IMAGE])
+        _check_docker(result)
+        return json.loads(result.stdout) if result.returncode == 0 else None
+
+    def _image_entrypoint(self) -> Union[List[str], None]:
+        if self._entrypoint is None:
+            entrypoint = self._inspect_entrypoint()
+            if entrypoint is None:
+                # Probably not pulled yet; 'docker run' would pull it, but 'docker image inspect' doesn't.
+                if self._verbose > 0:
+                    print(f'Pulling {self.IMAGE}.')
+                pulled = self._run(['docker', 'pull'] + self._platform_args + [self.IMAGE])
+                _check_docker(pulled)
+                if pulled.returncode == 0:
+                    entrypoint = self._inspect_entrypoint()
+            if not entrypoint:
+                print(f'Warning: can\'t find the entrypoint of {self.IMAGE}; converting with a \'docker run\' per '
+                      f'file, which is much slower.')
+            self._entrypoint = entrypoint or []
+        return self._entrypoint
+
+    def _start_container(self, source_dir: Path, out_dir: str) -> Union[str, None]:
+        if not self._image_entrypoint():
+            return None
+        result = self._run(['docker', 'run', '-d', '--rm'] + self._platform_args +
+                           ['--mount', f'type=bind,source={source_dir}/.,target=/audio',
+                            '--mount', f'type=bind,source={out_dir},target=/out',
+                            '--entrypoint', 'sleep', self.IMAGE, 'infinity'])
+        _check_docker(result)
+        if result.returncode != 0:
+            print(f'Warning: can\'t start a container for \'{str(source_dir)}\'; converting with a \'docker run\' '
+                  f'per file: {result.stderr.decode("utf-8").strip()}')
+            return None
+        return result.stdout.decode('utf-8').strip()
+
+    def _convert_batch(self, source_dir: Path, jobs: List[ConversionJob]) -> Dict[ConversionJob, Union[Path, None]]:
+        # The ac container decodes the file for every target; at least it does so in the same container.
+        results: Dict[ConversionJob, Union[Path, None]] = {job: None for job in jobs}
+        with tempfile.TemporaryDirectory() as out_dir:
+            container_id = self._start_container(source_dir, out_dir)
+            try:
+                for job in jobs:
+                    target_name = job.source.stem + job.target.suffix
+                    if container_id:
+                        command = ['docker', 'exec', container_id] + self._entrypoint + \
+                                  [job.source.name, '/out/' + target_name]
+                    else:
+                        command = ['docker', 'run', '--rm'] + self._platform_args + \
+                                  ['--mount', f'type=bind,source={source_dir}/.,target=/audio',
+                                   '--mount', f'type=bind,source={out_dir},target=/out',
+                                   self.IMAGE, job.source.name, '/out/' + target_name]
+                    result = self._run(command)
+                    _check_docker(result)
+                    if self._verbose > 1:
+                        print(result)
+                    converted = Path(out_dir, target_name)
+                    if result.returncode == 0 and converted.exists():
+                        shutil.move(str(converted), str(job.target))
+                        results[job] = job.target
+            finally:
+                if container_id:
+                    self._run(['docker', 'rm', '-f', container_id])
+        return results
+
+
+def make_converter(**kwargs) -> AudioConverter:
+    """
+    Creates the converter for the given options.
+    :param kwargs: 'command', a command to use in place of the abc container; 'ffmpeg', True to use the
+        abc container and a locally installed ffmpeg; 'pipe', True to stream the .wav from the decoder to
+        ffmpeg; 'verbose'.
+    :return: The converter.
+    """
+    if kwargs.get('command'):
+        return CommandConverter(**kwargs)
+    if kwargs.get('ffmpeg'):
+        return CommandConverter(ABC_COMMAND, **kwargs)
+    return ContainerConverter(**kwargs)
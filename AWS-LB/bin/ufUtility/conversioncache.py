@@ -0,0 +1,198 @@
+"""
+conversioncache.py
+
+A cache of converted audio, so that re-importing user feedback that was already imported doesn't convert
+the same .a18 files again.
+
+Entries are keyed by the SHA-256 of the .a18 file's content and the identity of the converter (its decoder
+and encoder commands; see AudioConverter.identity), plus the target format, and are stored as
+{cache_dir}/{key[:2]}/{key}{.format}. A hit is copied to the target, never linked, so that the delivered file
+and the cache entry are independent: a later change to one can't affect the other.
+The cache is kept under a size limit by evicting the least recently used entries; an entry's mtime is its
+last use, so the order survives from one run to the next.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Union
+
+from audioconverter import AudioConverter, ConversionJob
+
+DEFAULT_MAX_BYTES = 10_000_000_000  # 10 GB
+
+
+def content_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(source_hash: str, converter_identity: str) -> str:
+    """
+    The key of a conversion in the cache.
+    :param source_hash: content_hash() of the .a18 file.
+    :param converter_identity: AudioConverter.identity of the converter.
+    """
+    return hashlib.sha256(f'{converter_identity}\n{source_hash}'.encode('utf-8')).hexdigest()
+
+
+def _copy(source: Path, target: Path) -> None:
+    """
+    Copies source to target, through a temporary file in target's directory. Replaces any existing target.
+    """
+    with tempfile.NamedTemporaryFile(dir=target.parent, prefix=target.name, suffix='.new', delete=False) as temp:
+        temp_path = Path(temp.name)
+    try:
+        shutil.copyfile(source, temp_path)
+        temp_path.replace(target)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+class ConversionCache:
+    def __init__(self, cache_dir: Path, max_bytes: int = DEFAULT_MAX_BYTES, **kwargs):
+        """
+        Opens, or creates, a cache.
+        :param cache_dir: Directory of the cache.
+        :param max_bytes: The size to which the cache is trimmed.
+        """
+        self._verbose = kwargs.get('verbose', 0)
+        self._dir = cache_dir
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # {entry path: size}, least recently used first.
+        self._entries: 'OrderedDict[Path, int]' = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._dir.mkdir(parents=True, exist_ok=True)
+        found = []
+        for sub_dir in os.scandir(self._dir):
+            if sub_dir.is_dir():
+                for entry in os.scandir(sub_dir.path):
+                    if entry.is_file() and not entry.name.endswith('.new'):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime_ns, Path(entry.path), stat.st_size))
+        for _, path, size in sorted(found):
+            self._entries[path] = size
+            self._bytes += size
+        # In case the limit is lower than it was.
+        self._evict()
+
+    def _entry_path(self, key: str, audio_format: str) -> Path:
+        return Path(self._dir, key[:2], key + audio_format)
+
+    def fetch(self, key: str, target: Path) -> bool:
+        """
+        If the cache has the conversion of the source to target's format, puts a copy of it at target.
+        :param key: cache_key() of the conversion.
+        :param target: The file to be created.
+        :return: True if it did.
+        """
+        entry = self._entry_path(key, target.suffix)
+        with self._lock:
+            if entry not in self._entries:
+                self.misses += 1
+                return False
+            self._entries.move_to_end(entry)
+        try:
+            _copy(entry, target)
+            os.utime(entry)
+        except OSError:
+            # Perhaps evicted by another process sharing the cache.
+            with self._lock:
+                self._bytes -= self._entries.pop(entry, 0)
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key: str, converted: Path) -> None:
+        """
+        Adds a copy of a conversion to the cache, evicting old entries as needed.
+        :param key: cache_key() of the conversion.
+        :param converted: The converted file.
+        """
+        entry = self._entry_path(key, converted.suffix)
+        size = converted.stat().st_size
+        if size > self._max_bytes:
+            return
+        try:
+            entry.parent.mkdir(exist_ok=True)
+            _copy(converted, entry)
+        except OSError:
+            # Not cached, but the conversion itself is fine.
+            return
+        with self._lock:
+            self._bytes += size - self._entries.pop(entry, 0)
+            self._entries[entry] = size
+            self._evict()
+
+    def _evict(self) -> None:
+        """
+        Removes least recently used entries until the cache is within its size limit. Called with the lock held.
+        """
+        while self._bytes > self._max_bytes:
+            evicted, evicted_size = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            try:
+                evicted.unlink()
+            except OSError:
+                pass
+            if self._verbose > 2:
+                print(f'Evicted \'{str(evicted)}\' from conversion cache.')
+
+    def print(self):
+        print(f'Conversion cache: {self.hits} hits, {self.misses} misses, {len(self._entries)} entries, '
+              f'{self._bytes:,} bytes.')
+
+
+class CachingConverter(AudioConverter):
+    """
+    Wraps a converter with a ConversionCache. Conversions found in the cache are not passed to the converter;
+    the others are, and their results added to the cache.
+    """
+
+    def __init__(self, converter: AudioConverter, cache: ConversionCache, **kwargs):
+        super().__init__(**kwargs)
+        self._converter = converter
+        self._cache = cache
+
+    @property
+    def cache(self) -> ConversionCache:
+        return self._cache
+
+    def convert(self, jobs: List[ConversionJob]) -> Dict[ConversionJob, Union[Path, None]]:
+        results: Dict[ConversionJob, Union[Path, None]] = {}
+        to_convert: List[ConversionJob] = []
+        hashes: Dict[Path, str] = {}
+        for job in jobs:
+            job.target.parent.mkdir(parents=True, exist_ok=True)
+            if job.source not in hashes:
+                try:
+                    hashes[job.source] = cache_key(content_hash(job.source), self._converter.identity)
+                except OSError:
+                    # Let the converter deal with (and report) an unreadable file.
+                    to_convert.append(job)
+                    continue
+            if self._cache.fetch(hashes[job.source], job.target):
+                if self._verbose > 1:
+                    print(f'Found \'{str(job.target.name)}\' for \'{str(job.source)}\' in conversion cache.')
+                results[job] = job.target
+            else:
+                to_convert.append(job)
+        if to_convert:
+            converted = self._converter.convert(to_convert)
+            for job, target in converted.items():
+                if target and job.source in hashes:
+                    self._cache.store(hashes[job.source], target)
+            results.update(converted)
+        return results
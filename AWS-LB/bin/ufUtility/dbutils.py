@@ -1,7 +1,8 @@
 import base64
 import json
+import threading
 import time
-from typing import Dict, List, Union, Tuple, Any
+from typing import Dict, List, Union, Tuple, Any, Iterable
 
 import boto3 as boto3
 import pg8000 as pg8000
@@ -11,8 +12,20 @@ from pg8000 import Cursor, Connection
 from UfRecord import uf_column_map, UfRecord
 
 recipient_cache: Dict[str, Dict[str, str]] = {}
+# Most recipientids to look up in one query_recipients_info() query.
+RECIPIENTS_QUERY_SIZE = 1000
+# {(program, deployment): deploymentnumber}
+deployment_cache: Dict[Tuple[str, str], Union[str, None]] = {}
+
+# { recipients db column : recipient info key }
+_recipient_columns = {'recipientid': 'recipientid', 'project': 'program', 'partner': 'customer',
+                      'affiliate': 'affiliate', 'country': 'country', 'region': 'region', 'district': 'district',
+                      'communityname': 'community', 'groupname': 'group', 'agent': 'agent', 'language': 'language',
+                      'listening_model': 'listening_model'}
 
 _db_connection: Union[Connection, None] = None
+# The connection is shared by any worker threads (ufUtility.py --jobs), but may only be used by one at a time.
+_db_lock = threading.RLock()
 
 
 # noinspection SqlDialectInspection ,SqlNoDataSourceInspection
@@ -124,8 +137,9 @@ class DbUtils:
     @property
     def db_connection(self) -> Connection:
         global _db_connection
-        if not _db_connection:
-            self._get_db_connection()
+        with _db_lock:
+            if not _db_connection:
+                self._get_db_connection()
         return _db_connection
 
     def query_recipient_info(self, recipientid: str) -> Dict[str, str]:
@@ -137,42 +151,123 @@ class DbUtils:
         """
         if recipientid in recipient_cache:
             return recipient_cache[recipientid]
+        with _db_lock:
+            return self._query_recipient_info(recipientid)
 
+    def _query_recipient_info(self, recipientid: str) -> Dict[str, str]:
+        if recipientid in recipient_cache:
+            return recipient_cache[recipientid]
         cursor: Cursor = self.db_connection.cursor()
         cursor.paramstyle = 'named'
 
-        # { db column : dict key }
-        columns = {'recipientid': 'recipientid', 'project': 'program', 'partner': 'customer', 'affiliate': 'affiliate',
-                   'country': 'country', 'region': 'region',
-                   'district': 'district', 'communityname': 'community', 'groupname': 'group', 'agent': 'agent',
-                   'language': 'language', 'listening_model': 'listening_model'}
         # select recipientid, project, ... from recipients where recipientid = '0123abcd4567efgh';
-        command = f'select {",".join(columns.keys())} from recipients where recipientid=:recipientid;'
+        command = f'select {",".join(_recipient_columns.keys())} from recipients where recipientid=:recipientid;'
         values = {'recipientid': recipientid}
 
         recipient_info: Dict[str, str] = {}
         try:
-            result_keys: List[str] = list(columns.values())
             cursor.execute(command, values)
             for row in cursor:
-                # Copy the recipient info, translating from the database names to the local names.
-                for key in result_keys:
-                    recipient_info[key] = row[result_keys.index(key)]
+                recipient_info = self._recipient_info_from_row(row)
         except Exception:
             pass
         recipient_cache[recipientid] = recipient_info
         return recipient_info
 
+    def query_recipients_info(self, recipientids: Iterable[str]) -> Dict[str, Dict[str, str]]:
+        """
+        Given recipientids, return information about the recipients, like query_recipient_info(). Recipients
+        that are not already cached are looked up together, with one query per RECIPIENTS_QUERY_SIZE.
+        :param recipientids: to be found.
+        :return: a Dict[str,Dict[str,str]] of data about each recipient, by recipientid.
+        """
+        recipientids = set(recipientids)
+        with _db_lock:
+            missing = sorted(r for r in recipientids if r not in recipient_cache)
+            if missing:
+                cursor: Cursor = self.db_connection.cursor()
+                cursor.paramstyle = 'named'
+                command = f'select {",".join(_recipient_columns.keys())} from recipients ' \
+                          f'where recipientid = ANY(:recipientids);'
+                for start in range(0, len(missing), RECIPIENTS_QUERY_SIZE):
+                    chunk = missing[start:start + RECIPIENTS_QUERY_SIZE]
+                    found: Dict[str, Dict[str, str]] = {}
+                    try:
+                        cursor.execute(command, {'recipientids': chunk})
+                        for row in cursor:
+                            recipient_info = self._recipient_info_from_row(row)
+                            found[recipient_info['recipientid']] = recipient_info
+                    except Exception as ex:
+                        # The failed query aborted the transaction; roll it back, or every later query on the
+                        # connection fails too. Leave these recipients to be looked up individually.
+                        print(f'Failed to look up {len(chunk)} recipients: {str(ex)}')
+                        self.db_connection.rollback()
+                        continue
+                    for recipientid in chunk:
+                        recipient_cache[recipientid] = found.get(recipientid, {})
+                if self._verbose >= 2:
+                    print(f'Looked up {len(missing)} recipients.')
+            return {r: self._query_recipient_info(r) for r in recipientids}
+
+    @staticmethod
+    def _recipient_info_from_row(row) -> Dict[str, str]:
+        # Copy the recipient info, translating from the database names to the local names.
+        return {key: row[ix] for ix, key in enumerate(_recipient_columns.values())}
+
     def query_deployment_number(self, program: str, deployment: str) -> str:
-        cursor: Cursor = self.db_connection.cursor()
-        cursor.paramstyle = 'named'
+        key = (program, deployment)
+        if key in deployment_cache:
+            return deployment_cache[key]
+        with _db_lock:
+            cursor: Cursor = self.db_connection.cursor()
+            cursor.paramstyle = 'named'
 
-        command = 'select deploymentnumber from deployments where project=:program and deployment=:deployment limit 1;'
-        values = {'program': program, 'deployment': deployment}
+            command = 'select deploymentnumber from deployments where project=:program and deployment=:deployment limit 1;'
+            values = {'program': program, 'deployment': deployment}
 
-        cursor.execute(command, values)
-        for row in cursor:
-            return str(row[0])
+            deployment_number = None
+            cursor.execute(command, values)
+            for row in cursor:
+                deployment_number = str(row[0])
+                break
+            deployment_cache[key] = deployment_number
+            return deployment_number
+
+    def preload(self) -> None:
+        """
+        Loads the deployments and recipients tables, with one query each, so that query_deployment_number()
+        and query_recipient_info() are answered without a round trip to the database. Anything not found
+        in the preloaded tables is still looked up (once) in the database. Call again to refresh.
+        """
+        with _db_lock:
+            cursor: Cursor = self.db_connection.cursor()
+            start = time.time()
+
+            deployments: Dict[Tuple[str, str], Union[str, None]] = {}
+            cursor.execute('select project, deployment, deploymentnumber from deployments;')
+            for project, deployment, deploymentnumber in cursor:
+                # Like the "limit 1" of query_deployment_number(), the first one wins.
+                deployments.setdefault((project, deployment), str(deploymentnumber))
+
+            recipients: Dict[str, Dict[str, str]] = {}
+            cursor.execute(f'select {",".join(_recipient_columns.keys())} from recipients;')
+            for row in cursor:
+                recipient_info = self._recipient_info_from_row(row)
+                recipients[recipient_info['recipientid']] = recipient_info
+
+            deployment_cache.clear()
+            deployment_cache.update(deployments)
+            recipient_cache.clear()
+            recipient_cache.update(recipients)
+        if self._verbose >= 1:
+            print(f'Preloaded {len(deployments)} deployments and {len(recipients)} recipients in '
+                  f'{time.time() - start:.2f}s.')
+
+    def refresh(self) -> None:
+        """
+        Re-reads the deployments and recipients, for a long-running process that may have stale data.
+        """
+        self.preload()
 
     def insert_uf_records(self, uf_items: List[Tuple]) -> Any:
         cursor: Cursor = self.db_connection.cursor()
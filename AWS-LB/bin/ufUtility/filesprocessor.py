@@ -8,54 +8,142 @@ in all the directories, and in all of their sub-directories, etc.
 
 For each file, call a predicate to determine whether to process or skip the file,
 and if "process", call a passed function to perform the processing.
+
+The tree is walked with os.scandir, depth first, with the entries of each directory in sorted order. The
+files are processed as they are found, optionally on an Executor.
 """
+import os
+from collections import deque
+from concurrent.futures import Executor, Future, wait
 from pathlib import Path
-from typing import List, Callable, Tuple, Any
+from typing import List, Callable, Tuple, Any, Iterable, Iterator, Deque, Dict
+
+from instrumentation import Instrumentation, PHASE_PROCESS
+
+# What the walker found.
+WALK_FILE = 'file'
+WALK_DIR = 'dir'
+WALK_DIR_DONE = 'dir_done'
+WALK_MISSING = 'missing'
 
 
 class FilesProcessor:
     def __init__(self, files: List[Path]):
         self._files = files
 
+    @staticmethod
+    def walk(files: Iterable[Path]) -> Iterator[Tuple[str, Path]]:
+        """
+        Walks the given files and directories, and all of their sub-directories.
+        :param files: The files and directories to walk. Not modified.
+        :return: (WALK_FILE, path) for each file, (WALK_DIR, path) for each directory, before its contents,
+            (WALK_DIR_DONE, path) for each directory, after its contents, and (WALK_MISSING, path) for each path
+            that doesn't exist (or isn't a file or directory).
+        """
+        for file_spec in files:
+            if file_spec.is_dir():
+                yield from FilesProcessor._walk_dir(file_spec)
+            elif file_spec.is_file():
+                yield WALK_FILE, file_spec
+            else:
+                yield WALK_MISSING, file_spec
+
+    @staticmethod
+    def _walk_dir(directory: Path) -> Iterator[Tuple[str, Path]]:
+        yield WALK_DIR, directory
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            # The DirEntry knows its type from the directory listing; no stat() needed, except for symlinks.
+            if entry.is_dir():
+                yield from FilesProcessor._walk_dir(Path(entry.path))
+            elif entry.is_file():
+                yield WALK_FILE, Path(entry.path)
+            else:
+                yield WALK_MISSING, Path(entry.path)
+        yield WALK_DIR_DONE, directory
+
     def process_files(self, acceptor: Callable[[Path], bool] = lambda x: True,
                       processor: Callable[[Path], Any] = lambda x: None,
                       **kwargs) -> Tuple[int, int, int, int, int]:
         """
         Given a list Paths to a file or directory containing, process the file(s).
-        :param file_specs: A list of Pathss
         :param acceptor: a callback to determine if a file should be processed. Default returns true.
-        :return: a tuple of the counts of directories and files processed, and the files skipped.
+        :param processor: a callback to process a file. Returns False if there was an error with the file.
+        :param kwargs: 'files', to process instead of the files given to the constructor. 'limit', the most
+            files to process. 'executor', to run the processor on, and 'max_pending', the most files to have
+            submitted to the executor but not yet processed (default 100). 'on_dir', called with each
+            directory before any of its files are processed. 'on_dir_done', called with each directory once all of
+            its files have been processed, on the executor, if there is one. The acceptor and on_dir are always
+            called on the calling thread.
+        :return: a tuple of the counts of directories and files processed, the files skipped, the files
+            not found, and the files with errors.
         """
         verbose = kwargs.get('verbose', 0)
         limit = kwargs.get('limit', 1_000_000_000)
-        remaining = kwargs.get('files', self._files)
+        files = kwargs.get('files', self._files)
+        executor: Executor = kwargs.get('executor')
+        max_pending = kwargs.get('max_pending', 100)
+        on_dir: Callable[[Path], Any] = kwargs.get('on_dir')
+        on_dir_done: Callable[[Path], Any] = kwargs.get('on_dir_done')
+        pending: Deque[Future] = deque()
+        # {directory: [its files' futures]}, so that on_dir_done can wait for just those.
+        dir_pending: Dict[Path, List[Future]] = {}
         n_files: int = 0
         n_skipped: int = 0
         n_dirs: int = 0
         n_missing: int = 0
         n_errors: int = 0
 
-        while len(remaining) > 0:
-            file_spec: Path = remaining.pop()
-            if not file_spec.exists():
-                if file_spec in self._files:
+        def process(file_spec: Path) -> Any:
+            with Instrumentation().timer(PHASE_PROCESS):
+                process_result = processor(file_spec)
+            Instrumentation().file_done()
+            return process_result
+
+        def count_result(process_result: Any) -> None:
+            nonlocal n_errors
+            if process_result is False:
+                n_errors += 1
+
+        for kind, file_spec in self.walk(files):
+            if kind == WALK_MISSING:
+                if file_spec in files:
                     print(f'The given file \'{str(file_spec)}\' does not exist')
                 n_missing += 1
-            elif file_spec.is_file():
+            elif kind == WALK_FILE:
                 if acceptor(file_spec):
                     n_files += 1
-                    process_result = processor(file_spec)
-                    if process_result is False:
-                        n_errors += 1
+                    if executor:
+                        future = executor.submit(process, file_spec)
+                        pending.append(future)
+                        if on_dir_done:
+                            dir_pending.setdefault(file_spec.parent, []).append(future)
+                        # Don't let the walk get too far ahead of the executor.
+                        while len(pending) > max_pending:
+                            count_result(pending.popleft().result())
+                    else:
+                        count_result(process(file_spec))
                     if n_files >= limit:
                         if verbose:
                             print(f'Limit reached, quitting. {n_files} files.')
                         break
                 else:
                     n_skipped += 1
+            elif kind == WALK_DIR_DONE:
+                if not on_dir_done:
+                    continue
+                if executor:
+                    wait(dir_pending.pop(file_spec, []))
+                    pending.append(executor.submit(on_dir_done, file_spec))
+                else:
+                    on_dir_done(file_spec)
             else:
                 n_dirs += 1
                 if verbose > 1:
                     print(f'Adding files from directory \'{str(file_spec)}\'.')
-                remaining.extend([f for f in file_spec.iterdir()])
+                if on_dir:
+                    on_dir(file_spec)
+        while pending:
+            count_result(pending.popleft().result())
         return n_dirs, n_files, n_skipped, n_missing, n_errors
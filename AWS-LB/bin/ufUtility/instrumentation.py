@@ -0,0 +1,159 @@
+"""
+instrumentation.py
+
+Timing and counts of the phases of processing files, to see where a run spends its time.
+
+Phases are timed with the timer() context manager. For each phase, the count, total, minimum and maximum
+durations, and a histogram of the durations, are kept. The histogram buckets are powers of two microseconds.
+Phases can nest; a phase's time includes the time of any phases within it. Counters are kept with count().
+
+While files are being processed, the files/sec rate is printed every report_interval seconds. At the end,
+a summary can be printed, and written as JSON.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Union, Any, Iterator
+
+# Instrumented phases.
+PHASE_PROCESS = 'process_file'
+PHASE_METADATA = 'metadata_parse'
+PHASE_SIDECAR_UPDATE = 'sidecar_update'
+PHASE_DB_LOOKUP = 'db_lookup'
+PHASE_SIDECAR_SAVE = 'sidecar_save'
+PHASE_AUDIO_EXPORT = 'audio_export'
+PHASE_RECIPIENT_PREFETCH = 'recipient_prefetch'
+
+
+class _PhaseStats:
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns: Union[int, None] = None
+        self.max_ns = 0
+        # {bucket: count}; a duration of d microseconds is in bucket d.bit_length(), ie, d < 2**bucket.
+        self.buckets: Dict[int, int] = {}
+
+    def add(self, ns: int) -> None:
+        self.count += 1
+        self.total_ns += ns
+        self.min_ns = ns if self.min_ns is None else min(self.min_ns, ns)
+        self.max_ns = max(self.max_ns, ns)
+        bucket = (ns // 1000).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile_us(self, pct: float) -> int:
+        """
+        An upper bound of the given percentile, from the histogram.
+        """
+        needed = self.count * pct / 100
+        seen = 0
+        for bucket in sorted(self.buckets.keys()):
+            seen += self.buckets[bucket]
+            if seen >= needed:
+                return 2 ** bucket
+        return 0
+
+    def summary(self) -> Dict[str, Any]:
+        return {'count': self.count,
+                'total_ms': round(self.total_ns / 1e6, 3),
+                'mean_us': round(self.total_ns / self.count / 1e3, 1) if self.count else 0,
+                'min_us': round((self.min_ns or 0) / 1e3, 1),
+                'max_us': round(self.max_ns / 1e3, 1),
+                'p50_us': self.percentile_us(50),
+                'p95_us': self.percentile_us(95),
+                'p99_us': self.percentile_us(99),
+                # {upper bound in microseconds: count}
+                'histogram_us': {str(2 ** b): n for b, n in sorted(self.buckets.items())}}
+
+
+class Instrumentation:
+    _instance = None
+
+    # This class is a singleton. The first instantiation determines the reporting; with no arguments, the
+    # statistics are kept, but not reported.
+    def __new__(cls, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(Instrumentation, cls).__new__(cls)
+            cls._verbose = kwargs.get('verbose', 0)
+            cls._report_interval: float = kwargs.get('report_interval', 0)
+            cls._json_path: Union[Path, None] = kwargs.get('json_path')
+            cls._lock = threading.Lock()
+            cls._phases: Dict[str, _PhaseStats] = {}
+            cls._counters: Dict[str, int] = {}
+            cls._files = 0
+            cls._start_ns = time.perf_counter_ns()
+            cls._last_report_ns = cls._start_ns
+            cls._last_report_files = 0
+        return cls._instance
+
+    @contextmanager
+    def timer(self, phase: str) -> Iterator[None]:
+        """
+        Times the enclosed code as the given phase.
+        """
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            with self._lock:
+                stats = self._phases.get(phase)
+                if stats is None:
+                    stats = self._phases[phase] = _PhaseStats()
+                stats.add(elapsed)
+
+    def count(self, counter: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + n
+
+    def file_done(self) -> None:
+        """
+        Counts a processed file, and, every report_interval seconds, prints the rate at which files are being
+        processed.
+        """
+        with self._lock:
+            self._files += 1
+            if not self._report_interval:
+                return
+            now = time.perf_counter_ns()
+            if now - self._last_report_ns < self._report_interval * 1e9:
+                return
+            recent_rate = (self._files - self._last_report_files) / ((now - self._last_report_ns) / 1e9)
+            overall_rate = self._files / ((now - self._start_ns) / 1e9)
+            self._last_report_ns = now
+            self._last_report_files = n_files = self._files
+        print(f'Progress: {n_files:,} files, {recent_rate:,.1f} files/sec ({overall_rate:,.1f} overall).', flush=True)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            elapsed_s = (time.perf_counter_ns() - self._start_ns) / 1e9
+            return {'elapsed_s': round(elapsed_s, 3),
+                    'files': self._files,
+                    'files_per_sec': round(self._files / elapsed_s, 1) if elapsed_s else 0,
+                    'counters': dict(sorted(self._counters.items())),
+                    'phases': {phase: stats.summary() for phase, stats in sorted(self._phases.items())}}
+
+    def print(self) -> None:
+        summary = self.summary()
+        print(f'{summary["files"]:,} files in {summary["elapsed_s"]:,.1f}s, {summary["files_per_sec"]:,.1f} files/sec.')
+        lines: List[str] = []
+        for phase, stats in summary['phases'].items():
+            lines.append(f'  {phase:20} {stats["count"]:>9,} {stats["total_ms"]:>12,.1f}ms total, '
+                         f'mean {stats["mean_us"]:,.1f}us, p95 < {stats["p95_us"]:,}us, max {stats["max_us"]:,.1f}us')
+        for counter, n in summary['counters'].items():
+            lines.append(f'  {counter:20} {n:>9,}')
+        print('\n'.join(lines))
+
+    def close(self) -> None:
+        """
+        Prints the summary, if verbose, and writes it as JSON, if a file was given.
+        """
+        if self._verbose > 0:
+            self.print()
+        if self._json_path:
+            with open(self._json_path, 'w') as json_file:
+                json.dump(self.summary(), json_file, indent=2)
+                json_file.write('\n')
@@ -0,0 +1,108 @@
+"""
+mdindex.py
+
+A persistent index of the metadata of .a18 files, so that re-processing the same userrecordings directories
+doesn't re-read and re-parse every file.
+
+The index is a local SQLite file. An entry is keyed by the file's path, and is only used if the file's size
+and mtime are still what they were when the entry was made; otherwise the file is read again and the entry
+replaced. The cached metadata includes the computed SECONDS and DURATION.
+"""
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Tuple, Union
+
+# Commit after this many new or replaced entries, so that an interrupted run keeps most of its work.
+COMMIT_INTERVAL = 1000
+
+
+class MetadataIndex:
+    _instance = None
+
+    # This class is a singleton. The first instantiation determines the index file; with no index file,
+    # metadata is simply read from the .a18 files.
+    def __new__(cls, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(MetadataIndex, cls).__new__(cls)
+            cls._verbose = kwargs.get('verbose', 0)
+            cls._path: Union[Path, None] = kwargs.get('index_path')
+            cls._connection: Union[sqlite3.Connection, None] = None
+            cls._lock = threading.Lock()
+            cls._pending = 0
+            cls._hits = 0
+            cls._misses = 0
+            if cls._path:
+                cls._open()
+        return cls._instance
+
+    @classmethod
+    def _open(cls) -> None:
+        if cls._verbose > 1:
+            print(f'Using .a18 metadata index \'{str(cls._path)}\'.')
+        cls._connection = sqlite3.connect(str(cls._path), check_same_thread=False)
+        cls._connection.execute('CREATE TABLE IF NOT EXISTS a18_metadata (directory TEXT NOT NULL, name TEXT NOT NULL, '
+                                'size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, metadata TEXT NOT NULL, '
+                                'PRIMARY KEY (directory, name));')
+        cls._connection.commit()
+        # The entries of the most recently used directory, {name: (size, mtime_ns, metadata)}. Files are
+        # generally processed a directory at a time, so this replaces a query per file with one per directory.
+        cls._directory: Union[str, None] = None
+        cls._entries: Dict[str, Tuple[int, int, str]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self._connection is not None
+
+    def _directory_entries(self, directory: str) -> Dict[str, Tuple[int, int, str]]:
+        if directory != self._directory:
+            rows = self._connection.execute('SELECT name, size, mtime_ns, metadata FROM a18_metadata '
+                                            'WHERE directory=?;', (directory,))
+            self._entries = {name: (size, mtime_ns, md) for name, size, mtime_ns, md in rows}
+            self._directory = directory
+        return self._entries
+
+    def metadata(self, a18_path: Path, reader: Callable[[Path], Dict[str, str]]) -> Dict[str, str]:
+        """
+        Gets the metadata of an .a18 file, from the index if the index has a current entry for the file,
+        otherwise from the reader, and adds it to the index.
+        :param a18_path: The .a18 file.
+        :param reader: Function to read the metadata from the file, like MetadataReader.read_from_file.
+        :return: The metadata. The caller may modify it; the index keeps its own copy.
+        """
+        if not self._connection:
+            return reader(a18_path)
+        directory, name = os.path.split(os.path.abspath(a18_path))
+        stat = os.stat(a18_path)
+        with self._lock:
+            entry = self._directory_entries(directory).get(name)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            self._hits += 1
+            return json.loads(entry[2])
+
+        self._misses += 1
+        md = reader(a18_path)
+        md_json = json.dumps(md)
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO a18_metadata (directory, name, size, mtime_ns, metadata) '
+                                     'VALUES (?, ?, ?, ?, ?);', (directory, name, stat.st_size, stat.st_mtime_ns,
+                                                                 md_json))
+            if directory == self._directory:
+                self._entries[name] = (stat.st_size, stat.st_mtime_ns, md_json)
+            self._pending += 1
+            if self._pending >= COMMIT_INTERVAL:
+                self._connection.commit()
+                self._pending = 0
+        return md
+
+    def close(self) -> None:
+        if not self._connection:
+            return
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
+        if self._verbose > 0:
+            print(f'Metadata index: {self._hits} files from index, {self._misses} files read.')
@@ -0,0 +1,190 @@
+"""
+sidecarstore.py
+
+An optional consolidated store for sidecar (.properties) data: one append-only file per directory, in place
+of a .properties file per recording.
+
+The store is '.sidecars.jsonl' in the directory. Each line is a JSON object with the sidecar's file name, its
+header (comment) lines, and its properties. Saving a sidecar appends a line; the latest line for a name is the
+current sidecar. When a store is opened it is scanned once, to index the offset of the current line of each
+name, and when it is closed, it is compacted if most of its lines are out of date.
+
+A directory's store is read whenever it exists. Enabling stores (ufUtility.py --sidecar-store) only decides
+where sidecars are saved: with stores enabled, always in the store; otherwise, in the store only if it already
+has that sidecar, so that the store and a .properties file never disagree, and in a .properties file if not.
+
+The .properties files can be recreated from a store with export(), for anything that needs them.
+"""
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+STORE_NAME = '.sidecars.jsonl'
+
+
+def write_properties(path: Path, header: List[str], props: Dict[str, str]) -> None:
+    """
+    Writes a .properties file, atomically, via a .new file.
+    :param path: The .properties file.
+    :param header: Comment lines, written first.
+    :param props: The properties, written sorted by key.
+    """
+    temp_path = path.with_suffix('.new')
+    with open(temp_path, "w") as properties_file:
+        for h in header:
+            print(h, file=properties_file, end='\x0d\x0a')  # microsoft's original sin
+        for k in sorted(props.keys()):
+            print(f'{k}={props[k]}', file=properties_file, end='\x0d\x0a')
+    temp_path.replace(path)
+
+
+class SidecarStore:
+    _enabled = False
+    _stores: Dict[Path, 'SidecarStore'] = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, directory: Path):
+        """
+        Opens the store of a directory, and indexes it. Use for_path() to get the store for a sidecar.
+        """
+        self._directory = directory
+        self._path = Path(directory, STORE_NAME)
+        self._lock = threading.Lock()
+        # {name: (offset, length)} of the current line for each name.
+        self._index: Dict[str, Tuple[int, int]] = {}
+        self._lines = 0
+        self._file = None
+        self._reader: Union[int, None] = None
+        # The end of the last complete line. Anything after it is from a write that didn't finish.
+        self._size = 0
+        if self._path.exists():
+            with open(self._path, 'rb') as store_file:
+                for line in store_file:
+                    if not line.endswith(b'\n'):
+                        break
+                    self._index[json.loads(line)['name']] = (self._size, len(line))
+                    self._lines += 1
+                    self._size += len(line)
+
+    @classmethod
+    def enable(cls, enabled: bool = True) -> None:
+        """
+        Turns the store on or off. When off, for_writing() returns None for sidecars not already in a store, and
+        those sidecars are saved as .properties files. Call before any for_path().
+        """
+        cls._enabled = enabled
+
+    @classmethod
+    def for_path(cls, sidecar_path: Path) -> Union['SidecarStore', None]:
+        """
+        Gets the store of the given sidecar's directory, to read the sidecar from.
+        :param sidecar_path: The path of the .properties file that the store replaces.
+        :return: The store for the sidecar's directory, or None if stores aren't enabled and the directory
+            doesn't have one.
+        """
+        directory = sidecar_path.parent
+        with cls._stores_lock:
+            if directory not in cls._stores:
+                exists = cls._enabled or Path(directory, STORE_NAME).exists()
+                cls._stores[directory] = SidecarStore(directory) if exists else None
+            return cls._stores[directory]
+
+    @classmethod
+    def for_writing(cls, sidecar_path: Path) -> Union['SidecarStore', None]:
+        """
+        Gets the store to which to save the given sidecar.
+        :param sidecar_path: The path of the .properties file that the store replaces.
+        :return: The store for the sidecar's directory, or None if the sidecar is to be saved as a .properties file.
+        """
+        store = cls.for_path(sidecar_path)
+        if store is not None and (cls._enabled or sidecar_path.name in store):
+            return store
+        return None
+
+    @classmethod
+    def close_all(cls) -> None:
+        with cls._stores_lock:
+            for store in cls._stores.values():
+                if store:
+                    store.close()
+            cls._stores.clear()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def names(self) -> List[str]:
+        return list(self._index.keys())
+
+    def read(self, name: str) -> Union[Tuple[List[str], Dict[str, str]], None]:
+        """
+        Reads a sidecar.
+        :param name: The file name of the sidecar, like 'file1.properties'.
+        :return: (header, properties), or None if the store has no such sidecar.
+        """
+        with self._lock:
+            if name not in self._index:
+                return None
+            offset, length = self._index[name]
+            if self._file:
+                self._file.flush()
+            if self._reader is None:
+                self._reader = os.open(self._path, os.O_RDONLY)
+            record = json.loads(os.pread(self._reader, length, offset))
+        return record['header'], record['props']
+
+    def write(self, name: str, header: List[str], props: Dict[str, str]) -> None:
+        """
+        Saves a sidecar, replacing any earlier version.
+        :param name: The file name of the sidecar, like 'file1.properties'.
+        :param header: Comment lines.
+        :param props: The properties.
+        """
+        line = (json.dumps({'name': name, 'header': header, 'props': props}, sort_keys=True) + '\n').encode('utf-8')
+        with self._lock:
+            if self._file is None:
+                self._directory.mkdir(parents=True, exist_ok=True)
+                self._file = open(self._path, 'ab')
+                self._file.truncate(self._size)
+            self._file.write(line)
+            self._index[name] = (self._size, len(line))
+            self._lines += 1
+            self._size += len(line)
+
+    def export(self) -> int:
+        """
+        Writes each sidecar in the store as a .properties file, in the store's directory.
+        :return: The number of files written.
+        """
+        for name in self.names():
+            header, props = self.read(name)
+            write_properties(Path(self._directory, name), header, props)
+        return len(self._index)
+
+    def close(self) -> None:
+        """
+        Closes the store, first compacting it if more than half of its lines are old versions.
+        """
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+            if self._reader is not None:
+                os.close(self._reader)
+                self._reader = None
+            if self._lines > 2 * len(self._index):
+                self._compact()
+
+    def _compact(self) -> None:
+        temp_path = self._path.with_suffix('.new')
+        index: Dict[str, Tuple[int, int]] = {}
+        with open(self._path, 'rb') as store_file, open(temp_path, 'wb') as compacted:
+            for name, (offset, length) in sorted(self._index.items(), key=lambda item: item[1][0]):
+                store_file.seek(offset)
+                index[name] = (compacted.tell(), length)
+                compacted.write(store_file.read(length))
+        temp_path.replace(self._path)
+        self._index = index
+        self._lines = len(index)
+        self._size = sum(length for _, length in index.values())
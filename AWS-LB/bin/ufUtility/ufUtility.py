@@ -1,16 +1,23 @@
 import argparse
-import csv
+import sys
 import time
 from pathlib import Path
 from typing import Tuple, Union, Any
 
+# Modules shared with the other tools, like recipientindex.py, are deployed in the parent directory.
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
 from A18Processor import A18Processor
-from ArgParseActions import StorePathAction, StoreFileExtension
+from ArgParseActions import StorePathAction, StoreFileExtension, StoreFileExtensions
 from UfBundler import UfBundler
 from UfMetadata import UfMetadata
 from a18file import A18File
 from dbutils import DbUtils
 from filesprocessor import FilesProcessor
+from instrumentation import Instrumentation
+from mdindex import MetadataIndex
+from recipientindex import RecipientIndex
+from sidecarstore import SidecarStore, STORE_NAME
 
 args: Any = None
 
@@ -81,7 +88,7 @@ def _do_create_properties_files() -> Tuple[int, int, int, int, int]:
 
     def a18_processor(p: Path):
         community = p.parent.name
-        recipientid = recipients_map.get(community.upper())
+        recipientid = recipient_index.get(args.program, community)
         a18_file = A18File(p, verbose=args.verbose, dry_run=args.dry_run)
         kwargs = {
             'recipientid': recipientid,
@@ -92,29 +99,33 @@ def _do_create_properties_files() -> Tuple[int, int, int, int, int]:
         ret = a18_file.create_sidecar(**kwargs)
         return ret
 
-    recipients_map = {}
-    with open(args.map, 'r') as recipients_map_file:
-        csvreader = csv.DictReader(recipients_map_file)
-        for row in csvreader:
-            if row.get('project') == args.program:
-                recipients_map[row.get('directory')] = row.get('recipientid')
+    recipient_index: RecipientIndex = RecipientIndex.load(args.map)
 
     processor: FilesProcessor = FilesProcessor(args.files)
     ret = processor.process_files(a18_acceptor, a18_processor, limit=args.limit, verbose=args.verbose)
     return ret  # n_dirs, n_files, n_skipped, n_missing, n_errors
 
 
+def _a18_processor() -> A18Processor:
+    """
+    Creates an A18Processor for the files, with the audio conversion options.
+    """
+    return A18Processor(args.files, ffmpeg=args.ffmpeg, converter_command=args.converter, pipe=args.pipe,
+                        cache_dir=args.cache_dir, cache_max_bytes=args.cache_max_bytes, verbose=args.verbose)
+
+
 def _do_convert_audio_format() -> Tuple[int, int, int, int, int]:
     global args
-    processor: A18Processor = A18Processor(args.files)
-    ret = processor.convert_a18_files(format=args.format, limit=args.limit, verbose=args.verbose)
+    processor: A18Processor = _a18_processor()
+    ret = processor.convert_a18_files(format=args.format, limit=args.limit, verbose=args.verbose, jobs=args.jobs)
     return ret  # n_dirs, n_files, n_skipped, n_missing, n_errors
 
 
 def _do_extract_uf() -> Tuple[int, int, int, int, int]:
     global args
-    processor: A18Processor = A18Processor(args.files)
-    ret = processor.extract_uf_files(out_dir=args.out, no_db=args.no_db, format=args.format, limit=args.limit, verbose=args.verbose)
+    processor: A18Processor = _a18_processor()
+    ret = processor.extract_uf_files(out_dir=args.out, no_db=args.no_db, format=args.format, limit=args.limit,
+                                     verbose=args.verbose, jobs=args.jobs)
     propertiesProcessor.commit()
     return ret  # n_dirs, n_files, n_skipped, n_missing, n_errors
 
@@ -133,14 +144,54 @@ def _do_import_uf_metadata() -> Tuple[int, int, int, int, int]:
     return ret  # n_dirs, n_files, n_skipped, n_missing, n_errors
 
 
+def _do_export_sidecars() -> Tuple[int, int, int, int, int]:
+    """
+    Writes .properties files from the sidecar stores, for anything that needs the per-file layout.
+    :return: counts of files & directories processed.
+    """
+    global args
+
+    def store_acceptor(p: Path) -> bool:
+        return p.name == STORE_NAME
+
+    def store_processor(p: Path) -> None:
+        if args.dry_run:
+            print(f'Dry run, not exporting sidecars from \'{str(p)}\'.')
+            return
+        store = SidecarStore(p.parent)
+        n = store.export()
+        store.close()
+        if args.verbose > 0:
+            print(f'Exported {n} sidecars from \'{str(p)}\'.')
+
+    processor: FilesProcessor = FilesProcessor(args.files)
+    ret = processor.process_files(store_acceptor, store_processor, limit=args.limit, verbose=args.verbose)
+    return ret  # n_dirs, n_files, n_skipped, n_missing, n_errors
+
+
 def main():
     global args, dbUtils, propertiesProcessor
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('--verbose', '-v', action='count', default=0, help="More verbose output.")
     arg_parser.add_argument('--dry-run', '-n', action='store_true', default=False, help='Don\'t update anything.')
     arg_parser.add_argument('--ffmpeg', action='store_true', help='Use locally installed ffmpeg.')
+    arg_parser.add_argument('--converter', default=None, metavar='CMD',
+                            help='Command to decode a batch of .a18 files, in place of the abc container. {in} is '
+                                 'replaced by the source directory, {out} by the output directory, and {files} '
+                                 'by the file names. For each name.a18, it must write name.a18.wav, or name.a18 '
+                                 'with the desired extension, to {out}.')
     arg_parser.add_argument('--limit', type=int, default=999999999,
                             help='Stop after N files. Default is (virtually) unlimited.')
+    arg_parser.add_argument('--pipe', action='store_true', default=False,
+                            help='With --ffmpeg or --converter, pipe the decoded .wav files to ffmpeg through FIFOs, '
+                                 'rather than writing them to disk. The decoder must write each .wav in a single '
+                                 'sequential pass. Linux only.')
+    arg_parser.add_argument('--cache-dir', default=None, action=StorePathAction, metavar='DIR',
+                            help='Optional cache of converted audio, to avoid converting the same file again.')
+    arg_parser.add_argument('--cache-max-bytes', type=int, default=None, metavar='BYTES',
+                            help='Size limit of the --cache-dir cache. Default is 10 GB.')
+    arg_parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+                            help='Convert and extract with N worker threads. Default is 1.')
 
     subparsers = arg_parser.add_subparsers(dest="'Sub-command.'", required=True, help='Command descriptions')
 
@@ -156,9 +207,10 @@ def main():
                                 help='Files and directories to be converted.')
     convert_parser.add_argument('--out', action=StorePathAction,
                                 help='Output directory for converted files (default is adjacent to original file')
-    convert_parser.add_argument('--format', choices=['mp3', 'aac', 'wma', 'wav', 'ogg'], default='mp3',
-                                action=StoreFileExtension,
-                                help='Audio format desired for the convert option.')
+    convert_parser.add_argument('--format', allowed=['mp3', 'aac', 'wma', 'wav', 'ogg'], default='mp3',
+                                action=StoreFileExtensions, metavar='FORMAT[,FORMAT...]',
+                                help='Audio format(s) desired for the convert option, like mp3,ogg. Each file is '
+                                     'decoded once for all the formats.')
 
     # Create .properties files, where possible, for UF .a18 files.
     create_properties_parser = subparsers.add_parser('create_properties',
@@ -193,6 +245,13 @@ def main():
     import_parser.set_defaults(func=_do_import_uf_metadata)
     import_parser.add_argument('files', nargs='+', action=StorePathAction, help='Files and directories to be imported.')
 
+    # Write .properties files from sidecar stores.
+    export_sidecars_parser = subparsers.add_parser('export_sidecars',
+                                                   help='Write .properties files from sidecar stores.')
+    export_sidecars_parser.set_defaults(func=_do_export_sidecars)
+    export_sidecars_parser.add_argument('files', nargs='+', action=StorePathAction,
+                                        help='Files and directories with sidecar stores to be exported.')
+
     # bundle user feedback.
     bundle_parser = subparsers.add_parser('bundle', help='Bundle user feedback into manageable groups.')
     bundle_parser.set_defaults(func=_do_bundle)
@@ -225,6 +284,20 @@ def main():
                             help='Optional password, default from secrets store.')
     arg_parser.add_argument('--db-name', default='dashboard', metavar='DB',
                             help='Optional database name, default "dashboard".')
+    arg_parser.add_argument('--preload', action='store_true', default=False,
+                            help='Load the deployments and recipients tables at startup, rather than querying '
+                                 'the database for each file.')
+    arg_parser.add_argument('--sidecar-store', action='store_true', default=False,
+                            help='Save sidecars in one store file per directory, rather than a .properties file '
+                                 'per recording. Existing stores are read, and the sidecars in them updated, with '
+                                 'or without this option. The copies saved with exported audio are always '
+                                 '.properties files. See export_sidecars.')
+    arg_parser.add_argument('--progress', type=float, default=0, metavar='SECONDS',
+                            help='Report the files/sec processed every SECONDS seconds. Default 0, to not report.')
+    arg_parser.add_argument('--stats-json', default=None, action=StorePathAction, metavar='FILE',
+                            help='Write timings of the phases of processing, and other statistics, to FILE as JSON.')
+    arg_parser.add_argument('--md-index', default=None, action=StorePathAction, metavar='FILE',
+                            help='Optional SQLite file in which to cache .a18 metadata between runs.')
 
     args = arg_parser.parse_args()
     if args.verbose > 2:
@@ -240,11 +313,19 @@ def main():
     # Instantiate the db interface very early so that the connection parameters are set before the
     # database connection is needed.
     dbUtils = DbUtils(**dbArgs)
+    if args.preload:
+        dbUtils.preload()
     propertiesProcessor = UfMetadata()
+    MetadataIndex(index_path=args.md_index, verbose=args.verbose)
+    SidecarStore.enable(args.sidecar_store)
+    Instrumentation(report_interval=args.progress, json_path=args.stats_json, verbose=args.verbose)
 
     timer = -time.time_ns()
     n_dirs, n_files, n_skipped, n_missing, n_errors = args.func()
     timer += time.time_ns()
+    MetadataIndex().close()
+    SidecarStore.close_all()
+    Instrumentation().close()
 
     propertiesProcessor.print()
 
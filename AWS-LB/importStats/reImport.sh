@@ -50,6 +50,10 @@ function setDefaults() {
     if [ -z "${ufexporter-}" ]; then
         ufexporter=${bin}/ufUtility/ufUtility.py
     fi
+    if [ -z "${kv2db-}" ]; then
+        # If true, kv2csv.py streams playstatistics straight into the database, without a .csv file.
+        kv2db=false
+    fi
 
 }
 
@@ -319,22 +323,31 @@ function importAltStatistics() {
     # Gather the playstatistics.kvp files from the daily directory
     local playstatisticsFiles=$(find "${dailyDir}" -iname 'playstatistics.kvp')
     #
-    local extract=("${bin}/kv2csv.py" --2pass --columns @columns.txt --map ${recipientsmapfile} --output ${playstatisticsCsv} ${playstatisticsFiles})
-    ${verbose} && echo "${extract[@]}">>"${report}.tmp"
-    ${execute} && "${extract[@]}">>"${report}.tmp"
+    if ${kv2db}; then
+        # Stream into a temporary table, and merge into playstatistics, as below, but without the .csv file.
+        local extract=("${bin}/kv2csv.py" --2pass --columns @columns.txt --map ${recipientsmapfile} --copy-to-db playstatistics --merge-keys timestamp tbcdid project deployment talkingbookid contentid ${playstatisticsFiles})
+        ${verbose} && echo "${extract[@]}">>"${report}.tmp"
+        ${execute} && "${extract[@]}">>"${report}.tmp"
+    else
+        local extract=("${bin}/kv2csv.py" --2pass --columns @columns.txt --map ${recipientsmapfile} --output ${playstatisticsCsv} ${playstatisticsFiles})
+        ${verbose} && echo "${extract[@]}">>"${report}.tmp"
+        ${execute} && "${extract[@]}">>"${report}.tmp"
+    fi
 
     if $execute; then
-        # Import into db, and update playstatistics
-        IFS=${traditionalIFS}
-        ${psql} ${dbcxn}  <<EndOfQuery | tee -a "${report}.tmp"
-        \\timing
-        \\set ECHO all
-        create temporary table mstemp as select * from playstatistics where false;
-        \copy mstemp from '${playstatisticsCsv}' with delimiter ',' csv header;
-        delete from playstatistics d using mstemp t where d.timestamp=t.timestamp and d.tbcdid=t.tbcdid and d.project=t.project and d.deployment=t.deployment and d.talkingbookid=t.talkingbookid and d.contentid=t.contentid;
-        insert into playstatistics select * from mstemp on conflict do nothing;
+        if ! ${kv2db}; then
+            # Import into db, and update playstatistics
+            IFS=${traditionalIFS}
+            ${psql} ${dbcxn}  <<EndOfQuery | tee -a "${report}.tmp"
+            \\timing
+            \\set ECHO all
+            create temporary table mstemp as select * from playstatistics where false;
+            \copy mstemp from '${playstatisticsCsv}' with delimiter ',' csv header;
+            delete from playstatistics d using mstemp t where d.timestamp=t.timestamp and d.tbcdid=t.tbcdid and d.project=t.project and d.deployment=t.deployment and d.talkingbookid=t.talkingbookid and d.contentid=t.contentid;
+            insert into playstatistics select * from mstemp on conflict do nothing;
 EndOfQuery
-        IFS=${goodIFS}
+            IFS=${goodIFS}
+        fi
 
         echo '<div class="reportline">'>>"${report}"
         awk '{print "<p>"$0"</p>"}' "${report}.tmp" >>"${report}"
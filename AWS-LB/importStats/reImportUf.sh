@@ -11,6 +11,14 @@ fi
 if [ -z "${ufexporter-}" ]; then
     ufexporter=${stats_root}/AWS-LB/bin/ufUtility/ufUtility.py
 fi
+if [ -z "${ufmdindex-}" ]; then
+    # Cache of .a18 metadata, so that re-importing a day doesn't re-read every file.
+    ufmdindex=${stats_root}/uf-metadata-index.sqlite
+fi
+if [ -z "${ufcachedir-}" ]; then
+    # Cache of converted audio, so that re-importing a day doesn't re-encode every file.
+    ufcachedir=${stats_root}/uf-conversion-cache
+fi
 s3uf="s3://amplio-uf/collected"
 
 
@@ -28,7 +36,7 @@ function importUserFeedback() {
         mkdir -p ${tmpdir}
         echo "uf temp:${tmpdir}"
 
-        python3.8 ${ufexporter} -vv extract_uf ${recordingsDir} --out ${tmpdir}
+        python3.8 ${ufexporter} -vv --progress 60 --preload --md-index ${ufmdindex} --cache-dir ${ufcachedir} extract_uf ${recordingsDir} --out ${tmpdir}
         aws s3 mv --recursive ${tmpdir} ${s3uf}
 
         find ${tmpdir}
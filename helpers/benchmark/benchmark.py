@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+benchmark.py
+
+Performance benchmarks for the statistics converters in AWS-LB/bin.
+
+Generates synthetic, but realistic, playstatistics.kvp files, deploymentsAll.log files, and a matching
+recipients_map.csv, at a configurable scale. Then times kv2csv.py (in each of its modes) and tbsdeployed.py
+over that data, reporting rows/second and the peak RSS of each run. The a18 suite generates a directory of
+user recordings, and times reading their metadata with the batch reader, and with the baseline a18file.py
+from an earlier revision (by default, the one before the batch reader). The results are written as JSON,
+so that they can be compared between versions. Progress, and a table of the results, go to stderr.
+
+Example:
+    ./benchmark.py --rows 1000000 --files 200 --results results-1m.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Any, Tuple
+
+DEFAULT_BIN = Path(__file__).resolve().parents[2] / 'AWS-LB' / 'bin'
+DEFAULT_COLUMNS = Path(__file__).resolve().parents[2] / 'AWS-LB' / 'importStats' / 'columns.txt'
+REPO_DIR = Path(__file__).resolve().parents[2]
+A18FILE_PATH = 'AWS-LB/bin/ufUtility/a18file.py'
+
+LANGUAGES = ['en', 'dga', 'tw', 'ssl1', 'kus', 'ee']
+# Reads the metadata of the .a18 files listed in a file, with a18file.py from a given directory.
+# argv: ufUtility directory, mode ('baseline', one file at a time, or 'batch'), file with the list of .a18 files.
+A18_READER = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+from pathlib import Path
+from a18file import MetadataReader
+paths = [Path(line) for line in Path(sys.argv[3]).read_text().splitlines()]
+if sys.argv[2] == 'batch':
+    n = sum(1 for _, md in MetadataReader.read_from_files(paths) if md)
+else:
+    n = sum(1 for p in paths if MetadataReader.read_from_file(p))
+assert n == len(paths), f'only {n} of {len(paths)} files read'
+'''
+ACTIONS = ['update', 'update-fw', 'update', 'update', 'repair']
+
+
+class DataGenerator:
+    """
+    Generates the synthetic data. Everything is derived from a seeded random number generator, so a given
+    set of arguments always generates the same data.
+    """
+
+    def __init__(self, out_dir: Path, rows: int, files: int, projects: int, communities: int, seed: int = 1):
+        self._out_dir = out_dir
+        self._rows = rows
+        self._files = max(1, files)
+        self._random = random.Random(seed)
+        self._start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        # (project, community, recipientid)
+        self._recipients: List[Tuple[str, str, str]] = []
+        for p in range(projects):
+            project = f'PROJ-{p:03}'
+            for c in range(communities):
+                community = f'COMMUNITY {c:04} - {self._random.choice(["NORTH", "SOUTH", "EAST", "WEST"])}'
+                recipientid = uuid.UUID(int=self._random.getrandbits(128)).hex[:16]
+                self._recipients.append((project, community, recipientid))
+        self._talkingbooks = [f'B-{self._random.getrandbits(24):08X}' for _ in range(max(10, rows // 200))]
+
+    def write_recipients_map(self) -> Path:
+        path = Path(self._out_dir, 'recipients_map.csv')
+        with open(path, 'w') as map_file:
+            print('project,directory,recipientid', file=map_file)
+            for project, community, recipientid in self._recipients:
+                # About 10% of recipients are missing from the map, as in real life.
+                if self._random.random() < 0.9:
+                    print(f'{project},"{community}",{recipientid}', file=map_file)
+        return path
+
+    def _timestamp(self, seconds: int) -> datetime:
+        return self._start + timedelta(seconds=seconds)
+
+    def write_playstatistics(self) -> List[Path]:
+        """
+        Writes rows of play statistics, spread across self._files files in a year/month/day/tbcdid tree.
+        :return: The list of files written.
+        """
+        paths = []
+        rows_per_file = self._rows // self._files
+        extra = self._rows - rows_per_file * self._files
+        rnd = self._random
+        for f in range(self._files):
+            day = self._timestamp(f * 86400 // 4)
+            path = Path(self._out_dir, 'collected-data-processed', f'{day:%Y/%m/%d}', f'{f:05}', 'playstatistics.kvp')
+            path.parent.mkdir(parents=True, exist_ok=True)
+            project, community, recipientid = rnd.choice(self._recipients)
+            tbcdid = f'{rnd.randrange(1, 0x100):04X}'
+            deployment = f'{project}-21-{rnd.randrange(1, 5)}'
+            n = rows_per_file + (1 if f < extra else 0)
+            lines = []
+            for r in range(n):
+                ts = self._timestamp(f * 21600 + r)
+                started = rnd.randrange(0, 20)
+                completed = rnd.randrange(0, started + 1)
+                fields = [f'{ts:%Y%m%dT%H%M%S}.{r % 1000:03}Z', 'PLAYED',
+                          f'project:{project}', f'deployment:{deployment}',
+                          f'contentpackage:{deployment}-{rnd.choice(LANGUAGES)}', f'community:{community}',
+                          f'talkingbookid:{rnd.choice(self._talkingbooks)}',
+                          f'contentid:LB-2_{rnd.getrandbits(32):08x}_{rnd.randrange(0, 40)}',
+                          f'started:{started}', f'quarter:{completed + 2}', f'half:{completed + 1}',
+                          f'threequarters:{completed}', f'completed:{completed}',
+                          f'played_seconds:{rnd.randrange(0, 3600)}', 'survey_taken:0', 'survey_applied:0',
+                          'survey_useless:0', f'tbcdid:{tbcdid}', f'stats_timestamp:{ts:%Y%m%dT%H%M%S}.000Z',
+                          f'deployment_timestamp:{ts - timedelta(days=30):%Y%m%dT%H%M%S}.000Z']
+                # Most recipients must be looked up; some already have the recipientid.
+                if rnd.random() < 0.2:
+                    fields.append(f'recipientid:{recipientid}')
+                fields.append(f'deployment_uuid:{uuid.UUID(int=rnd.getrandbits(128))}')
+                lines.append(','.join(fields))
+            path.write_text('\n'.join(lines) + '\n')
+            paths.append(path)
+        return paths
+
+    def write_deployments(self) -> List[Path]:
+        """
+        Writes rows of deployments, spread across self._files deploymentsAll.log files.
+        :return: The list of files written.
+        """
+        paths = []
+        rows_per_file = self._rows // self._files
+        extra = self._rows - rows_per_file * self._files
+        rnd = self._random
+        for f in range(self._files):
+            day = self._timestamp(f * 86400 // 4)
+            path = Path(self._out_dir, 'collected-data-processed', f'{day:%Y/%m/%d}', f'{f:05}', 'deploymentsAll.log')
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tbcdid = f'{rnd.randrange(1, 0x100):04X}'
+            n = rows_per_file + (1 if f < extra else 0)
+            lines = []
+            for r in range(n):
+                project, community, recipientid = rnd.choice(self._recipients)
+                ts = self._timestamp(f * 21600 + r * 7)
+                deployment = f'{project}-21-{rnd.randrange(1, 5)}'
+                fields = [f'{ts:%Y-%m-%dT%H:%M:%S}.{r % 1000:03}', 'deployment', 'elapsedTime:0',
+                          f'action:{rnd.choice(ACTIONS)}', f'tbcdid:{tbcdid}', f'username:user{rnd.randrange(50)}',
+                          f'project:{project}', f'deployment:{deployment}',
+                          f'package:{deployment}-{rnd.choice(LANGUAGES)}', f'community:{community}',
+                          f'sn:{rnd.choice(self._talkingbooks)}', f'firmware:r{rnd.randrange(1200, 1300)}',
+                          f'location:{community.split(" - ")[0]}', f'timestamp:{ts:%Y%m%dT%H%M%S}.{r % 1000:03}Z',
+                          f'duration:{rnd.randrange(30, 90)}']
+                # Coordinates can't contain a comma, because the fields are separated by commas.
+                if rnd.random() < 0.3:
+                    fields.append(f'coordinates:({rnd.uniform(4, 11):.5f} {rnd.uniform(-3, 1):.5f})')
+                lines.append(','.join(fields))
+            path.write_text('\n'.join(lines) + '\n')
+            paths.append(path)
+        return paths
+
+
+    @staticmethod
+    def _a18_field(field_id: int, values: List[Any]) -> bytes:
+        # 16-bit id, 32-bit length, 8-bit number of values, then the values: 32-bit ints, or 16-bit length
+        # and UTF-8 bytes.
+        data = struct.pack('<b', len(values))
+        for value in values:
+            if isinstance(value, int):
+                data += struct.pack('<l', value)
+            else:
+                encoded = value.encode('utf-8')
+                data += struct.pack('<h', len(encoded)) + encoded
+        return struct.pack('<hl', field_id, len(data)) + data
+
+    def write_a18_files(self, count: int) -> List[Path]:
+        """
+        Writes .a18 user recordings, as the Talking Books do, 100 to a directory per community. The audio
+        is left as a hole in a sparse file; it is never read.
+        :return: The list of files written.
+        """
+        paths = []
+        rnd = self._random
+        for f in range(count):
+            project, community, recipientid = self._recipients[(f // 100) % len(self._recipients)]
+            path = Path(self._out_dir, 'userrecordings', project, community, f'uf-{f:06}.a18')
+            path.parent.mkdir(parents=True, exist_ok=True)
+            audio_len = rnd.randrange(8_000, 400_000)
+            fields = [self._a18_field(0, ['9-0']), self._a18_field(5, [community]),
+                      self._a18_field(10, [f'{project}-21-1_{rnd.getrandbits(32):08x}_{f}']),
+                      self._a18_field(11, [f'{project}-21-1']), self._a18_field(12, [rnd.choice(LANGUAGES)]),
+                      self._a18_field(25, [f'{self._timestamp(f * 60):%Y/%m/%d %H:%M}']),
+                      self._a18_field(23, ['A18']), self._a18_field(33, [rnd.randrange(0, 3)])]
+            with open(path, 'wb') as a18_file:
+                a18_file.write(struct.pack('<lh', audio_len, 16000))
+                a18_file.seek(audio_len + 4)
+                a18_file.write(struct.pack('<ll', 1, len(fields)) + b''.join(fields))
+            paths.append(path)
+        return paths
+
+
+def log(message: str) -> None:
+    # Progress goes to stderr, so that the JSON report on stdout can be parsed.
+    print(message, file=sys.stderr)
+
+
+def run_timed(command: List[str], cwd: Path) -> Dict[str, Any]:
+    """
+    Runs a command, and measures its elapsed time and peak RSS.
+    :param command: The command to run.
+    :param cwd: Directory in which to run it.
+    :return: a Dict with 'seconds', 'peak_rss_kb', and 'returncode'.
+    """
+    with tempfile.TemporaryFile() as stderr_file:
+        start = time.perf_counter()
+        proc = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=stderr_file)
+        # wait4 gives the resource usage of just this child.
+        _, status, rusage = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode('utf-8', errors='replace')
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS.
+    peak_rss_kb = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+    if proc.returncode != 0:
+        log(f'  {" ".join(command[:3])} ... failed ({proc.returncode}): {stderr.strip()[-500:]}')
+    return {'seconds': round(seconds, 3), 'peak_rss_kb': peak_rss_kb, 'returncode': proc.returncode}
+
+
+def kv2csv_mode_args(mode: str) -> List[str]:
+    """
+    Translates a mode name to kv2csv.py options. A mode is one or more of 'one-pass', '2pass', 'spill', or
+    'jobsN', joined with '+', like '2pass+jobs4'.
+    """
+    mode_args = []
+    for part in mode.split('+'):
+        if part.startswith('jobs'):
+            mode_args.extend(['--jobs', part[4:]])
+        elif part != 'one-pass':
+            mode_args.append(f'--{part}')
+    return mode_args
+
+
+def bench_kv2csv(args, work_dir: Path, generator: DataGenerator, map_path: Path) -> List[Dict[str, Any]]:
+    log(f'Generating {args.rows:,} rows of playstatistics in {args.files} files.')
+    files = [str(p) for p in generator.write_playstatistics()]
+    results = []
+    for mode in args.kv2csv_modes:
+        command = [sys.executable, str(Path(args.bin, 'kv2csv.py'))] + kv2csv_mode_args(mode) + \
+                  ['--columns', f'@{args.columns}', '+', '--map', str(map_path),
+                   '--output', str(Path(work_dir, 'playstatistics.csv'))] + files
+        log(f'Timing kv2csv.py {mode}.')
+        result = run_timed(command, work_dir)
+        result.update({'tool': 'kv2csv.py', 'mode': mode, 'rows': args.rows})
+        results.append(result)
+    return results
+
+
+def bench_tbsdeployed(args, work_dir: Path, generator: DataGenerator, map_path: Path) -> List[Dict[str, Any]]:
+    log(f'Generating {args.rows:,} rows of deployments in {args.files} files.')
+    files = [str(p) for p in generator.write_deployments()]
+    command = [sys.executable, str(Path(args.bin, 'tbsdeployed.py')), '--map', str(map_path),
+               '--output', str(Path(work_dir, 'tbsdeployed.csv'))] + files
+    log('Timing tbsdeployed.py.')
+    result = run_timed(command, work_dir)
+    result.update({'tool': 'tbsdeployed.py', 'mode': 'default', 'rows': args.rows})
+    return [result]
+
+
+def baseline_ufutility(args, work_dir: Path) -> Path:
+    """
+    Extracts the baseline ufUtility directory from git.
+    :return: the directory.
+    """
+    revision = args.a18_baseline
+    if not revision:
+        # The revision before the batch reader was added.
+        result = subprocess.run(['git', 'log', '--format=%H', '--reverse', '-S', 'def read_from_files', '--',
+                                 A18FILE_PATH], cwd=REPO_DIR, capture_output=True, check=True)
+        added = result.stdout.decode('utf-8').split()
+        if not added:
+            sys.exit('Can\'t find the revision that added the batch reader; use --a18-baseline.')
+        revision = added[0] + '^'
+    baseline_dir = Path(work_dir, 'baseline')
+    baseline_dir.mkdir(exist_ok=True)
+    archive = subprocess.run(['git', 'archive', revision, str(Path(A18FILE_PATH).parent)], cwd=REPO_DIR,
+                             capture_output=True, check=True)
+    subprocess.run(['tar', '-x', '-C', str(baseline_dir)], input=archive.stdout, check=True)
+    log(f'Baseline a18file.py from {revision}.')
+    return Path(baseline_dir, A18FILE_PATH).parent
+
+
+def bench_a18(args, work_dir: Path, generator: DataGenerator, map_path: Path) -> List[Dict[str, Any]]:
+    log(f'Generating {args.a18_files:,} .a18 user recordings.')
+    list_path = Path(work_dir, 'a18files.txt')
+    list_path.write_text('\n'.join(str(p) for p in generator.write_a18_files(args.a18_files)) + '\n')
+    ufutility_dirs = {'baseline': baseline_ufutility(args, work_dir), 'batch': Path(args.bin, 'ufUtility')}
+    results = []
+    for mode, ufutility_dir in ufutility_dirs.items():
+        command = [sys.executable, '-c', A18_READER, str(ufutility_dir), mode, str(list_path)]
+        log(f'Timing .a18 metadata, {mode}.')
+        result = run_timed(command, work_dir)
+        result.update({'tool': 'a18file.py', 'mode': mode, 'rows': args.a18_files})
+        results.append(result)
+    return results
+
+
+# name: function(args, work_dir, generator, map_path) -> list of results
+SUITES = {
+    'kv2csv': bench_kv2csv,
+    'tbsdeployed': bench_tbsdeployed,
+    'a18': bench_a18,
+}
+
+
+def git_revision(path: Path) -> str:
+    try:
+        result = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=path, capture_output=True)
+        return result.stdout.decode('utf-8').strip()
+    except Exception:
+        return ''
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark the statistics converters.')
+    arg_parser.add_argument('--rows', type=int, default=10_000, help='Rows of data to generate, per suite.')
+    arg_parser.add_argument('--files', type=int, default=20, help='Number of files across which to spread the rows.')
+    arg_parser.add_argument('--projects', type=int, default=20, help='Number of projects.')
+    arg_parser.add_argument('--communities', type=int, default=100, help='Number of communities per project.')
+    arg_parser.add_argument('--seed', type=int, default=1, help='Random seed for the generated data.')
+    arg_parser.add_argument('--suite', nargs='+', choices=list(SUITES.keys()), default=list(SUITES.keys()),
+                            help='Benchmarks to run.')
+    arg_parser.add_argument('--kv2csv-modes', nargs='+', default=['one-pass', '2pass'],
+                            help='kv2csv.py modes to time: one-pass, 2pass, spill, jobsN, or combined, like 2pass+jobs4.')
+    arg_parser.add_argument('--a18-files', type=int, default=20_000, help='Number of .a18 files for the a18 suite.')
+    arg_parser.add_argument('--a18-baseline', metavar='REV',
+                            help='Git revision of the a18file.py to compare with; default is the one before the '
+                                 'batch reader.')
+    arg_parser.add_argument('--bin', type=Path, default=DEFAULT_BIN, help='Directory with the tools to benchmark.')
+    arg_parser.add_argument('--columns', type=Path, default=DEFAULT_COLUMNS, help='The columns.txt file.')
+    arg_parser.add_argument('--work-dir', type=Path, help='Directory for generated data; default is a temp dir.')
+    arg_parser.add_argument('--keep', action='store_true', help='Keep the generated data.')
+    arg_parser.add_argument('--label', default='', help='Label to identify this run in the results.')
+    arg_parser.add_argument('--results', type=Path,
+                            help='JSON file for the results; default is stdout. Progress goes to stderr.')
+    args = arg_parser.parse_args()
+
+    work_dir = args.work_dir or Path(tempfile.mkdtemp(prefix='lb-benchmark-'))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    results = []
+    try:
+        generator = DataGenerator(work_dir, args.rows, args.files, args.projects, args.communities, args.seed)
+        map_path = generator.write_recipients_map()
+        for suite in args.suite:
+            results.extend(SUITES[suite](args, work_dir, generator, map_path))
+    finally:
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    for result in results:
+        result['rows_per_sec'] = round(result['rows'] / result['seconds']) if result['seconds'] else None
+        log(f'{result["tool"]:>15} {result["mode"]:<12} {result["rows"]:>12,} rows {result["seconds"]:>9.2f}s '
+            f'{result["rows_per_sec"] or 0:>10,} rows/s {result["peak_rss_kb"]:>10,} KB peak RSS')
+
+    report = {
+        'label': args.label,
+        'revision': git_revision(args.bin),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'parameters': {'rows': args.rows, 'files': args.files, 'projects': args.projects,
+                       'communities': args.communities, 'a18_files': args.a18_files, 'seed': args.seed},
+        'results': results
+    }
+    if args.results:
+        with open(args.results, 'w') as results_file:
+            json.dump(report, results_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
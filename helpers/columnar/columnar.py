@@ -0,0 +1,132 @@
+"""
+columnar.py
+
+Writes tabular data as a Parquet file: typed, compressed, and written in row groups. Used by kv2csv.py and
+tbsdeployed.py as an alternative to comma-joined text.
+
+Rows are given as lists of strings, exactly as they would be written to a .csv file. Each column is converted
+to the type named for it in column_types (default 'string'); empty values become nulls, as they do when a .csv
+is loaded with COPY. A value that can't be converted to its column's type is an error, with strict; otherwise
+it also becomes a null, and is counted, per column, in coerced, to be reported with coercion_summary().
+Requires pyarrow.
+"""
+from datetime import datetime
+from typing import Dict, List, Callable, Any, Union
+
+import pyarrow
+import pyarrow.parquet
+
+TIMESTAMP_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y%m%dT%H%M%S.%fZ', '%Y%m%dT%H%M%S.%f',
+                     '%Y%m%dT%H%M%SZ']
+
+
+# The converters return None for an empty value, and raise ValueError for one that can't be converted.
+def _to_int(v: str) -> Union[int, None]:
+    return int(v) if v else None
+
+
+def _to_float(v: str) -> Union[float, None]:
+    return float(v) if v else None
+
+
+def _to_bool(v: str) -> Union[bool, None]:
+    if not v:
+        return None
+    lower = v.lower()
+    if lower in ('t', 'true', 'y', 'yes', '1'):
+        return True
+    if lower in ('f', 'false', 'n', 'no', '0'):
+        return False
+    raise ValueError(v)
+
+
+def _to_timestamp(v: str) -> Union[datetime, None]:
+    if not v:
+        return None
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(v, fmt)
+        except ValueError:
+            pass
+    raise ValueError(v)
+
+
+# type name: (pyarrow type, converter from str)
+_TYPES: Dict[str, Any] = {
+    'string': (pyarrow.string(), lambda v: v if v else None),
+    'int64': (pyarrow.int64(), _to_int),
+    'float64': (pyarrow.float64(), _to_float),
+    'bool': (pyarrow.bool_(), _to_bool),
+    'timestamp': (pyarrow.timestamp('ms'), _to_timestamp),
+}
+
+
+class ParquetOutput:
+    def __init__(self, filename: str, column_names: List[str], column_types: Dict[str, str] = None,
+                 row_group_size: int = 100_000, compression: str = 'zstd', strict: bool = False):
+        """
+        Opens a Parquet file for writing.
+        :param filename: The file to be written.
+        :param column_names: The names of the columns, in order.
+        :param column_types: Optional {column name: type name}, type name one of string, int64, float64, bool,
+                        or timestamp. Columns not named are strings.
+        :param row_group_size: Number of rows to buffer and write together, as one row group.
+        :param compression: Parquet compression codec.
+        :param strict: If True, a value that can't be converted to its column's type raises ValueError. Otherwise
+                        it is written as a null, and counted in coerced.
+        """
+        column_types = column_types or {}
+        self._column_names = list(column_names)
+        self._type_names = [column_types.get(name, 'string') for name in self._column_names]
+        self._types = [_TYPES[type_name] for type_name in self._type_names]
+        self._schema = pyarrow.schema(
+            [pyarrow.field(name, t[0]) for name, t in zip(self._column_names, self._types)])
+        self._row_group_size = row_group_size
+        self._writer = pyarrow.parquet.ParquetWriter(filename, self._schema, compression=compression)
+        self._rows: List[List[str]] = []
+        self._strict = strict
+        self.num_rows = 0
+        # {column name: number of values that couldn't be converted, and were written as nulls}
+        self.coerced: Dict[str, int] = {}
+
+    def add_row(self, vals: List[str]) -> None:
+        self._rows.append(vals)
+        if len(self._rows) >= self._row_group_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._rows:
+            return
+        arrays = []
+        for ix, (arrow_type, convert) in enumerate(self._types):
+            try:
+                converted = [convert(row[ix]) for row in self._rows]
+            except ValueError:
+                # Something didn't convert; do the column again, a value at a time, to find what.
+                converted = [self._convert_checked(ix, convert, row[ix]) for row in self._rows]
+            arrays.append(pyarrow.array(converted, type=arrow_type))
+        self._writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self._schema))
+        self.num_rows += len(self._rows)
+        self._rows = []
+
+    def _convert_checked(self, ix: int, convert: Callable[[str], Any], v: str) -> Any:
+        try:
+            return convert(v)
+        except ValueError:
+            name = self._column_names[ix]
+            if self._strict:
+                raise ValueError('Column {}: "{}" is not a valid {}.'.format(name, v, self._type_names[ix])) from None
+            self.coerced[name] = self.coerced.get(name, 0) + 1
+            return None
+
+    def coercion_summary(self) -> List[str]:
+        """
+        Describes the values that couldn't be converted to their columns' types, and were written as nulls.
+        :return: A line per column with any such values; none if there were none.
+        """
+        return ['Column {}: {} values that are not a valid {} were written as nulls.'.format(
+            name, n, self._type_names[self._column_names.index(name)]) for name, n in sorted(self.coerced.items())]
+
+    def close(self) -> None:
+        self._flush()
+        self._writer.close()
@@ -0,0 +1,5 @@
+#!/usr/bin/env bash
+
+file="columnar.py"
+
+cp -v "${file}" "../../AWS-LB/bin/${file}"
@@ -1,5 +1,8 @@
 #!/usr/bin/env bash
 
+# kv2csv.py finds recipientindex.py beside it when deployed; here it's in a sibling directory.
+export PYTHONPATH="../recipientindex${PYTHONPATH:+:${PYTHONPATH}}"
+
 function main() {
     clean
     create
@@ -8,7 +11,10 @@ function main() {
 }
 
 function clean() {
-    rm -f aa.kvp bb.kvp ab.csv ab2.csv ba.csv ba2.csv recip.kvp recip.csv recip.expected recip.map
+    rm -f aa.kvp bb.kvp ab.csv ab2.csv ba.csv ba2.csv abs.csv bas.csv recip.kvp recip.csv recip.expected recip.map
+    rm -f late.kvp late.csv lates.csv fixed.csv fixed2.csv abj.csv abj2.csv latej.csv
+    rm -f inc.csv inc.manifest full.csv .recip.*.idx
+    rm -f copy.csv copy.expected
 }
 
 function create() {
@@ -43,6 +49,11 @@ timestamp,project,community,value,recipientid
 20180304T121003.100-10,proj4,random directory name,provided,c5678
 EndOfData
 
+cat >late.kvp << EndOfData
+20180304T121000.100-10,op1,project:proj1,community:some directory name,value:lookup
+20180304T121001.000-10,op2,project:proj3,community:different directory name,value:late,recipientid:c5678,extra:x
+EndOfData
+
 cat >recip.map << EndOfData
 recipientid,project,directory
 a1234,proj1,"some directory name"
@@ -60,9 +71,89 @@ function test() {
     cmp ba.csv ba2.csv
     echo Next cmp should differ>/dev/null
     cmp ab.csv ba.csv
+    ./kv2csv.py aa.kvp bb.kvp --spill --out abs.csv
+    ./kv2csv.py bb.kvp aa.kvp --spill --out bas.csv
+    cmp ab.csv abs.csv
+    cmp ba.csv bas.csv
+    ./kv2csv.py late.kvp --map recip.map --out late.csv --columns timestamp +
+    ./kv2csv.py late.kvp --map recip.map --spill --out lates.csv --columns timestamp +
+    cmp late.csv lates.csv
+    ./kv2csv.py aa.kvp bb.kvp --columns one eleven seven --out fixed.csv
+    ./kv2csv.py aa.kvp bb.kvp --columns one eleven seven --2pass --out fixed2.csv
+    cmp fixed.csv fixed2.csv
+    ./kv2csv.py aa.kvp bb.kvp late.kvp --jobs 2 --out abj.csv
+    ./kv2csv.py aa.kvp bb.kvp late.kvp --out ab.csv
+    cmp ab.csv abj.csv
+    ./kv2csv.py aa.kvp bb.kvp late.kvp --jobs 2 --2pass --out abj2.csv
+    cmp ab.csv abj2.csv
+    ./kv2csv.py late.kvp recip.kvp --map recip.map --jobs 2 --spill --out latej.csv --columns timestamp +
+    ./kv2csv.py late.kvp recip.kvp --map recip.map --out late.csv --columns timestamp +
+    cmp late.csv latej.csv
+    ./kv2csv.py aa.kvp bb.kvp --columns timestamp one eleven --out full.csv
+    ./kv2csv.py aa.kvp --columns timestamp one eleven --manifest inc.manifest --append --out inc.csv
+    ./kv2csv.py aa.kvp bb.kvp --columns timestamp one eleven --manifest inc.manifest --append --out inc.csv
+    ./kv2csv.py aa.kvp bb.kvp --columns timestamp one eleven --manifest inc.manifest --append --out inc.csv
+    cmp full.csv inc.csv
     ./kv2csv.py recip.kvp --map recip.map --out recip.csv --columns timestamp +
     cmp recip.expected recip.csv
+    ./kv2csv.py recip.kvp --map recip.map --spill --out recip.csv --columns timestamp +
+    cmp recip.expected recip.csv
+    ./kv2csv.py aa.kvp bb.kvp --columns one eleven seven --no-header --out copy.expected
+    copy_to_db copy.csv aa.kvp bb.kvp --columns one eleven seven --copy-to-db playstatistics
+    cmp copy.expected copy.csv
     set +x
 }
 
+# Runs kv2csv.py --copy-to-db against a stand-in connection that hands the COPY stream to pg8000's own
+# COPY IN handling. The data that pg8000 would send to the server is written to the file named by \$1.
+function copy_to_db() {
+    python3 - "$@" <<'EndOfPython'
+import importlib.util, io, struct, sys
+import pg8000.core
+
+class Server:
+    def __init__(self):
+        self._sock = io.BytesIO()
+        self._client_encoding = 'utf8'
+    _send_message = pg8000.core.CoreConnection._send_message
+    def data(self):
+        # CopyData messages: 'd', int32 length (including itself), data.
+        buf, pos, out = self._sock.getvalue(), 0, b''
+        while pos < len(buf):
+            code, length = buf[pos:pos + 1], struct.unpack('!i', buf[pos + 1:pos + 5])[0]
+            if code == pg8000.core.COPY_DATA:
+                out += buf[pos + 5:pos + 1 + length]
+            pos += 1 + length
+        return out
+
+class Cursor:
+    rowcount = 0
+    def execute(self, command, stream=None):
+        if stream is not None:
+            server = Server()
+            pg8000.core.CoreConnection.handle_COPY_IN_RESPONSE(server, struct.pack('!bh', 0, 0),
+                                                              pg8000.core.Context(command, stream=stream))
+            data = server.data()
+            self.rowcount = data.count(b'\n')
+            with open(copy_out, 'wb') as copy_file:
+                copy_file.write(data)
+
+class Connection:
+    def cursor(self):
+        return Cursor()
+    def commit(self):
+        pass
+    def close(self):
+        pass
+
+copy_out = sys.argv[1]
+sys.argv = ['kv2csv.py'] + sys.argv[2:]
+spec = importlib.util.spec_from_file_location('kv2csv', 'kv2csv.py')
+kv2csv = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(kv2csv)
+kv2csv.get_db_connection = lambda args: Connection()
+kv2csv.main()
+EndOfPython
+}
+
 main "$@"
\ No newline at end of file
@@ -0,0 +1,5 @@
+#!/usr/bin/env bash
+
+file="recipientindex.py"
+
+cp -v "${file}" "../../AWS-LB/bin/${file}"
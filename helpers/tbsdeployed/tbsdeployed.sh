@@ -32,7 +32,9 @@ function configure() {
     extractfile="tbdataoperations.csv"
     extractfilter="tbsdeployed.py"
     deploymentsfile="tbsdeployed.csv"
+    upsertfile="tbsdeployed-upsert.sql"
     recipientsmapfile="recipients_map.csv"
+    watermarkfile="tbsdeployed-watermark.json"
 
     echo $(date)>log.txt
     verbose=true
@@ -90,10 +92,10 @@ EndOfQuery
 }
 
 function collectAllDeployments() {
-    # Gather the deploymentsAll.log files from 2017-October
-    #deploymentsLogs=$(find ${dropbox}/collected-data-processed/2017 -iname 'deploymentsAll.log')
-    #
-    local extract=(python ${extractfilter} --tbdata ${extractfile} --map ${recipientsmapfile}  --output ${deploymentsfile} ${deploymentsLogs})
+    # Gather the deploymentsAll.log files from 2017-October; tbdataoperations has the deployments before that.
+    local extract=(python ${extractfilter} --tbdata ${extractfile} --batch 10000 --map ${recipientsmapfile}  --output ${deploymentsfile}
+        --scan ${dropbox}/collected-data-processed --since 2017-10-01 --upsert-sql ${upsertfile}
+        --watermark ${watermarkfile})
     ${verbose} && echo "${extract[@]}"
     ${execute} && "${extract[@]}"
 }
@@ -117,20 +119,14 @@ EndOfQuery
 }
 
 function importTable() {
-    # Import into db, and update tbsdeployed
-    ${psql} ${dbcxn}  <<EndOfQuery >>log.txt
-    \\timing
-    \\set ECHO queries
-
-    create temporary table tbtemp as select * from tbsdeployed where false;
-
-    \copy tbtemp from '${deploymentsfile}' with delimiter ',' csv header;
-
-    delete from tbsdeployed d using tbtemp t where d.talkingbookid=t.talkingbookid and d.deployedtimestamp=t.deployedtimestamp;
-
-    insert into tbsdeployed select * from tbtemp on conflict do nothing;
-
-EndOfQuery
+    # Import into db, and update tbsdeployed. tbsdeployed.py wrote the upsert, with the duplicates removed.
+    # Only once that succeeds are the new watermarks kept; otherwise the next run reads the same deployments.
+    if ${psql} ${dbcxn} -f ${upsertfile} >>log.txt; then
+        [ -e ${watermarkfile}.new ] && mv ${watermarkfile}.new ${watermarkfile}
+    else
+        echo "Upsert failed; keeping the old watermarks."
+        rm -f ${watermarkfile}.new
+    fi
 }
 
 